@@ -0,0 +1,24 @@
+"""
+Command line entry point of the app: `python -m uploader serve [options]`.
+"""
+
+import argparse
+import logging
+
+from uploader import serve
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    format="%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s",
+)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="uploader")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve.add_arguments(
+        commands.add_parser("serve", help="serve the app with Gunicorn")
+    )
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve.main(args)
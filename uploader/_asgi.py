@@ -0,0 +1,22 @@
+"""
+ASGI wrapper for Uvicorn to serve the app (see `uploader/asgi.py`).
+"""
+import sys
+from pathlib import Path
+
+file = Path(__file__)
+parent = file.parent
+ROOT = None
+for parent in file.parents:
+    if parent.name == "ChunkChariot":
+        ROOT = parent
+sys.path.append(str(ROOT))
+
+from uploader.asgi import create_asgi_app
+from uploader.helpers import utils
+
+# Get the configuration file path
+config_file = utils.get_config_file_path()
+
+# Create the ASGI app instance
+app = create_asgi_app(config_file=config_file)
@@ -15,7 +15,7 @@ for parent in file.parents:
 sys.path.append(str(ROOT))
 
 import logging
-from typing import Optional
+from typing import Any, Dict, Optional
 
 import flask
 import flask_login
@@ -23,12 +23,28 @@ from flask_bootstrap import Bootstrap5
 from flask_wtf import CSRFProtect
 
 from uploader import orchestrator
+from uploader.finalizer import FinalizeWorker
 from uploader.helpers import utils, cli
+from uploader.janitor import Janitor
 from uploader.models.user import User
-from uploader.helpers.config import config
+from uploader.helpers.config import Settings, config, install_reload_signal, on_reload
 
 MODULE_NAME = "uploader.app"
 
+# App config keys read per request, updated when the settings are reloaded
+RELOADABLE_CONFIG = (
+    "TUS_EXPIRATION_S",
+    "DEDUPE",
+    "COMPRESSION_CODECS",
+    "ADMISSION_CONTROL",
+    "UPLOAD_LIMITS",
+    "CHUNKING",
+    "DURABILITY",
+    "GROUP_COMMIT",
+    "GROUP_COMMIT_DELAY_S",
+    "DROP_CACHE_ABOVE",
+)
+
 logger = logging.getLogger(MODULE_NAME)
 logargs = {
     "level": logging.DEBUG,
@@ -42,12 +58,109 @@ app: Optional[flask.Flask] = None
 login_manager: Optional[flask_login.LoginManager] = None
 
 
-def create_app(config_file: Path) -> flask.Flask:
+def start_background_workers(config_file: Path) -> None:
+    """
+    Starts the finalize worker and janitor threads, if configured to run in
+    the app processes.
+
+    Threads do not survive a fork, so a server that creates the app before
+    forking its workers (`uploader serve --preload`) calls this in each worker
+    instead.
+
+    Args:
+        config_file (Path): The path to the config file.
+    """
+    if orchestrator.get_finalize_mode(config_file=config_file) == "background":
+        FinalizeWorker.from_config(config_file=config_file).start()
+    if orchestrator.get_janitor_mode(config_file=config_file) == "background":
+        Janitor.from_config(config_file=config_file).start()
+
+    return None
+
+
+def get_app_config(config_file: Path) -> Dict[str, Any]:
+    """
+    Returns the settings the app keeps in its config.
+
+    Args:
+        config_file (Path): The path to the config file.
+
+    Returns:
+        Dict[str, Any]: The settings, by app config key.
+    """
+    durability = orchestrator.get_durability(config_file=config_file)
+
+    return {
+        "STORAGE_PATH": str(orchestrator.get_storage_path(config_file=config_file)),
+        "CHUNK_PATH": str(orchestrator.get_chunk_path(config_file=config_file)),
+        "CHUNK_MODE": orchestrator.get_chunk_mode(config_file=config_file),
+        "FINALIZE_MODE": orchestrator.get_finalize_mode(config_file=config_file),
+        "DIGEST_ALGORITHM": orchestrator.get_digest_algorithm(
+            config_file=config_file
+        ),
+        "TUS_EXPIRATION_S": orchestrator.get_tus_expiration(config_file=config_file),
+        "DEDUPE": orchestrator.get_dedupe(config_file=config_file),
+        "STORAGE_LAYOUT": orchestrator.get_storage_layout(config_file=config_file),
+        "COMPRESSION_CODECS": orchestrator.get_compression_codecs(
+            config_file=config_file
+        ),
+        "STORAGE_BACKEND": orchestrator.get_storage_backend(config_file=config_file),
+        "ADMISSION_CONTROL": orchestrator.get_admission_control(
+            config_file=config_file
+        ),
+        "UPLOAD_LIMITS": orchestrator.get_upload_limits(config_file=config_file),
+        "CHUNKING": orchestrator.get_chunking(config_file=config_file),
+        "DURABILITY": durability["mode"],
+        "GROUP_COMMIT": durability["group_commit"],
+        "GROUP_COMMIT_DELAY_S": durability["group_commit_delay_s"],
+        "DROP_CACHE_ABOVE": orchestrator.get_drop_cache_above(
+            config_file=config_file
+        ),
+        "HOSTNAME": cli.get_hostname(),
+    }
+
+
+def reload_app_config(flask_app: flask.Flask, config_file: Path) -> Dict[str, Any]:
+    """
+    Updates the app's config from reloaded settings.
+
+    Only the settings read per request (`RELOADABLE_CONFIG`) are updated.
+    Changes to the others (where uploads are stored, and how) would strand
+    the uploads in flight, and are only logged: they need a restart.
+
+    Args:
+        flask_app (flask.Flask): The app.
+        config_file (Path): The path to the config file.
+
+    Returns:
+        Dict[str, Any]: The settings that were updated.
+    """
+    app_config = get_app_config(config_file=config_file)
+
+    updated = {}
+    for key, value in app_config.items():
+        if flask_app.config.get(key) == value:
+            continue
+        if key in RELOADABLE_CONFIG:
+            flask_app.config[key] = value
+            updated[key] = value
+        else:
+            logger.warning(f"{key} changed in {config_file}, restart to apply it")
+
+    if updated:
+        logger.info(f"Reloaded settings: {updated}")
+
+    return updated
+
+
+def create_app(config_file: Path, start_workers: bool = True) -> flask.Flask:
     """
     Creates a Flask app.
 
     Args:
         config_file (Path): The path to the config file.
+        start_workers (bool): Whether to start the background workers (see
+            `start_background_workers`).
 
     Returns:
         flask.Flask: The Flask app.
@@ -70,17 +183,23 @@ def create_app(config_file: Path) -> flask.Flask:
         # logger.debug(f"Loading user: {user_email}")
         return User.find_by_email_query(user_email)  # type: ignore
 
-    storage_path = orchestrator.get_storage_path(config_file=config_file)
-    chunk_path = orchestrator.get_chunk_path(config_file=config_file)
-    hostname = cli.get_hostname()
+    app_config = get_app_config(config_file=config_file)
 
-    logger.info(f"Using storage path: {storage_path}")
-    logger.info(f"Using chunk path: {chunk_path}")
+    logger.info(f"Using storage path: {app_config['STORAGE_PATH']}")
+    logger.info(f"Using chunk path: {app_config['CHUNK_PATH']}")
+    logger.info(f"Using chunk mode: {app_config['CHUNK_MODE']}")
+    logger.info(f"Using finalize mode: {app_config['FINALIZE_MODE']}")
+    logger.info(f"Using durability: {app_config['DURABILITY']}")
 
     app.secret_key = orchestrator.get_secret_key(config_file=config_file)
-    app.config["STORAGE_PATH"] = str(storage_path)
-    app.config["CHUNK_PATH"] = str(chunk_path)
-    app.config["HOSTNAME"] = hostname
+    app.config.update(app_config)
+
+    def apply_settings(settings: Settings) -> None:
+        if settings.path != config_file:
+            return
+        reload_app_config(app, config_file=config_file)  # type: ignore[arg-type]
+
+    on_reload(apply_settings)
 
     login_manager.init_app(app)
     login_manager.login_view = "auth.login"  # type: ignore
@@ -98,6 +217,10 @@ def create_app(config_file: Path) -> flask.Flask:
     app.register_blueprint(healthcheck_bp, url_prefix="/")
 
     from uploader.blueprints.upload import (  # pylint: disable=import-outside-toplevel
+        tus_create,
+        tus_resource,
+        upload,
+        upload_batch,
         upload_bp,
     )
 
@@ -113,8 +236,17 @@ def create_app(config_file: Path) -> flask.Flask:
             max_age=86400,
         )
 
+    if start_workers:
+        start_background_workers(config_file=config_file)
+
     Bootstrap5(app)
-    CSRFProtect(app)
+    csrf = CSRFProtect(app)
+    # The chunk and tus endpoints stream their body, and check the CSRF header
+    # themselves
+    csrf.exempt(upload)
+    csrf.exempt(upload_batch)
+    csrf.exempt(tus_create)
+    csrf.exempt(tus_resource)
 
     return app
 
@@ -126,6 +258,7 @@ if __name__ == "__main__":
     utils.configure_logging(
         config_file=config_file, module_name=MODULE_NAME, logger=logger
     )
+    install_reload_signal()
     config_params = config(path=config_file, section="flask")
     flask_app_port = int(config_params["web_app_port"])
 
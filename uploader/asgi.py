@@ -0,0 +1,234 @@
+"""
+ASGI variant of the app, for high-concurrency ingest.
+
+With sync workers, a slow client sending a chunk holds a whole worker (or
+thread) for as long as the chunk takes to arrive. Here, chunk uploads
+(`POST /upload/upload`) are received on an event loop instead: the body is
+read with `await`, and only the short steps that touch the disk or the
+database (checking the request, writing each block, recording the chunk)
+run in a thread pool. A worker can then hold thousands of slow uploads at
+once, bounded by memory (one `FEED_SIZE` buffer per upload) rather than by
+threads.
+
+Every other route (including the healthcheck, tus and the pages) is served
+by the Flask app, in the thread pool, so the routes and the Dropzone wire
+protocol are unchanged.
+
+Needs the optional `starlette` and `a2wsgi` packages, and an ASGI server
+such as `uvicorn` (see `uploader/_asgi.py`).
+"""
+
+import io
+import logging
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, TypeVar
+
+import flask
+import flask_login
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+
+from uploader.app import create_app
+from uploader.blueprints.upload import (
+    UploadReceiver,
+    acquire_upload_slot,
+    record_ingest,
+    release_upload_slot,
+)
+from uploader.helpers import multipart
+from uploader.helpers.admission import InsufficientStorage
+
+logger = logging.getLogger(__name__)
+
+# Bytes of the body buffered before they are handed to a thread to be parsed
+# and written, trading memory per upload for fewer thread hops
+FEED_SIZE = 256 * 1024  # 256 KB
+
+T = TypeVar("T")
+
+
+def get_wsgi_environ(scope: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Builds the WSGI environ of an ASGI HTTP request, without its body.
+
+    Args:
+        scope (Dict[str, Any]): The ASGI connection scope.
+
+    Returns:
+        Dict[str, Any]: The WSGI environ.
+    """
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ: Dict[str, Any] = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        header = name.decode("latin-1").upper().replace("-", "_")
+        if header in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = header
+        else:
+            key = f"HTTP_{header}"
+        decoded = value.decode("latin-1")
+        environ[key] = f"{environ[key]},{decoded}" if key in environ else decoded
+
+    return environ
+
+
+def to_starlette_response(response: flask.Response) -> Response:
+    """
+    Converts a (non-streamed) Flask response to a Starlette response.
+
+    Args:
+        response (flask.Response): The Flask response.
+
+    Returns:
+        Response: The Starlette response.
+    """
+    return Response(
+        content=response.get_data(),
+        status_code=response.status_code,
+        headers={
+            key: value
+            for key, value in response.headers.items()
+            if key.lower() != "content-length"
+        },
+    )
+
+
+class AsyncUploadEndpoint:
+    """
+    Receives Dropzone chunks (`POST /upload/upload`) on the event loop.
+
+    The checks, parsing and writes are those of the WSGI view (see
+    `UploadReceiver`), run in the thread pool under a Flask request context
+    built from the ASGI request.
+
+    Attributes:
+        flask_app (flask.Flask): The Flask app.
+    """
+
+    def __init__(self, flask_app: flask.Flask):
+        self.flask_app = flask_app
+
+    async def upload(self, request: Request) -> Response:
+        """
+        Receives an upload request (see `UploadReceiver`).
+
+        Args:
+            request (Request): The request.
+
+        Returns:
+            Response: The response.
+        """
+        environ = get_wsgi_environ(request.scope)
+
+        def in_context(func: Callable[..., T], *args: Any) -> T:
+            with self.flask_app.request_context(environ):
+                return func(*args)
+
+        async def run(func: Callable[..., T], *args: Any) -> T:
+            return await run_in_threadpool(in_context, func, *args)
+
+        def begin() -> Any:
+            if not flask_login.current_user.is_authenticated:
+                return self.flask_app.login_manager.unauthorized()  # type: ignore
+            lease = acquire_upload_slot()
+            if isinstance(lease, flask.Response):
+                return lease
+            receiver = UploadReceiver()
+            rejected = receiver.check()
+            if rejected is not None:
+                release_upload_slot(lease)
+                return rejected
+            return lease, receiver
+
+        begun = await run(begin)
+        if isinstance(begun, flask.Response):
+            # Rejected before the body is read, an ASGI server does not even
+            # send '100 Continue' to clients that wait for it
+            return to_starlette_response(begun)
+        lease, receiver = begun
+        started_at = time.monotonic()
+
+        try:
+            parser = multipart.StreamingFormParser(
+                boundary=receiver.boundary,
+                open_file=receiver.open_file,
+                max_form_memory_size=receiver.max_form_memory_size,
+            )
+            try:
+                buffer = bytearray()
+                async for data in request.stream():
+                    buffer.extend(data)
+                    if len(buffer) >= FEED_SIZE:
+                        await run(parser.feed, bytes(buffer))
+                        buffer.clear()
+                if buffer:
+                    await run(parser.feed, bytes(buffer))
+                await run(parser.finish)
+            except (InsufficientStorage, ValueError) as err:
+                await run(parser.abort)
+                return to_starlette_response(await run(receiver.reject, err))
+            except BaseException as err:
+                # e.g. the client disconnected
+                await run(parser.abort)
+                await run(receiver.reject, err)
+                raise
+
+            def complete() -> flask.Response:
+                response = receiver.complete()
+                record_ingest(started_at, response)
+                return response
+
+            return to_starlette_response(await run(complete))
+        finally:
+            await run(release_upload_slot, lease)
+
+
+def create_asgi_app(config_file: Path, start_workers: bool = True) -> Starlette:
+    """
+    Creates the ASGI app.
+
+    Args:
+        config_file (Path): The path to the config file.
+        start_workers (bool): Whether to start the background workers (see
+            `start_background_workers`).
+
+    Returns:
+        Starlette: The ASGI app.
+    """
+    flask_app = create_app(config_file=config_file, start_workers=start_workers)
+
+    asgi_app = Starlette(
+        routes=[
+            Route(
+                "/upload/upload",
+                AsyncUploadEndpoint(flask_app).upload,
+                methods=["POST"],
+            ),
+            Mount("/", app=WSGIMiddleware(flask_app)),  # type: ignore
+        ]
+    )
+    logger.info("Created ASGI app, receiving uploads on the event loop")
+
+    return asgi_app
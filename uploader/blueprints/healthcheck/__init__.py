@@ -7,6 +7,7 @@ from datetime import datetime
 import flask
 import flask_login
 
+from uploader.helpers import cache, db
 from uploader.models import Metadata
 
 healthcheck_bp = flask.Blueprint(
@@ -40,3 +41,21 @@ def healthcheck() -> flask.Response:
             server_time=current_time,
         )
     )
+
+
+@healthcheck_bp.route("/stats/db", methods=["GET"])
+def db_pool() -> flask.Response:
+    """
+    Returns the state of this worker process's database connection pools
+    (see `db.get_pool_stats`), for monitoring.
+    """
+    return flask.jsonify({"pools": db.get_pool_stats()})
+
+
+@healthcheck_bp.route("/stats/cache", methods=["GET"])
+def lookup_cache() -> flask.Response:
+    """
+    Returns the state of this worker process's lookup caches (see
+    `cache.get_cache_stats`), for monitoring.
+    """
+    return flask.jsonify({"caches": cache.get_cache_stats()})
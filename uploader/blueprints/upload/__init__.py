@@ -7,23 +7,57 @@ Allows uploading files.
 # https://codecalamity.com/uploading-large-files-by-chunking-featuring-python-flask-and-dropzone-js/
 # https://stackoverflow.com/questions/44727052/handling-large-file-uploads-with-flask
 
+import base64
+import functools
 import logging
+import mimetypes
+import os
+import secrets
+import time
 import uuid
+import zlib
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import flask
 import flask_login
-import pandas as pd
+import itsdangerous
+import wtforms
+from flask_wtf import csrf as flask_wtf_csrf
+from werkzeug import exceptions as werkzeug_exceptions
+from werkzeug import http as werkzeug_http
 from werkzeug import utils as werkzeug_utils
 
+from uploader import finalizer, storage
 from uploader.blueprints.upload.models import UploadedFileView, UploadForm
-from uploader.helpers import cli
+from uploader.helpers import (
+    admission,
+    cli,
+    compression,
+    digest,
+    durability,
+    files,
+    ingest,
+    manifest,
+    multipart,
+    pagecache,
+    tus,
+)
+from uploader.helpers.admission import InsufficientStorage, ReservationLedger
+from uploader.helpers.ingest import IngestMeter
+from uploader.helpers.limits import Lease, RateLimited, UploadLimiter
+from uploader.helpers.manifest import ChunkManifest
+from uploader.helpers.multipart import FileSink
+from uploader.helpers.tus import TusUpload
 from uploader.models import Metadata
+from uploader.models.blob import BLOBS_DIR_NAME, Blob
+from uploader.models.finalize_job import FinalizeJob
 from uploader.models.submission import Submission
 from uploader.models.submitted_files_map import SubmittedFilesMap
 from uploader.models.uploaded_file import UploadedFile
 from uploader.models.user import User
+from uploader.storage import StorageBackend
+from uploader.storage.s3 import MIN_PART_SIZE
 
 logger = logging.getLogger(__name__)
 
@@ -31,24 +65,320 @@ upload_bp = flask.Blueprint(
     "upload", __name__, url_prefix="/upload", template_folder="templates"
 )
 
+# The blocks a client must send to prove it holds a stored file, and how long
+# it has to answer (see `blob`)
+BLOB_CHALLENGE_BLOCKS = 2
+BLOB_CHALLENGE_MAX_AGE_S = 300
+
+
+def get_storage_file_path(file_uuid: str, file_name: str) -> Path:
+    """
+    Returns the path to store an uploaded file at, following the app's
+    storage layout.
+
+    Args:
+        file_uuid (str): The UUID of the file.
+        file_name (str): The (secure) name of the file.
+
+    Returns:
+        Path: The path to the file.
+    """
+    shard_depth, shard_width = flask.current_app.config["STORAGE_LAYOUT"]
+
+    return files.get_storage_file_path(
+        Path(flask.current_app.config["STORAGE_PATH"]),
+        file_uuid,
+        file_name,
+        shard_depth=shard_depth,
+        shard_width=shard_width,
+    )
+
+
+def get_storage_backend() -> StorageBackend:
+    """
+    Returns the storage backend uploaded files are written to.
+
+    Returns:
+        StorageBackend: The storage backend.
+    """
+    return storage.get_backend(name=flask.current_app.config["STORAGE_BACKEND"])
+
+
+def get_reservation_ledger() -> Optional[ReservationLedger]:
+    """
+    Returns the ledger of disk space reserved by uploads in flight.
+
+    Returns:
+        Optional[ReservationLedger]: The ledger, or None if admission
+            control is disabled.
+    """
+    admission_control = flask.current_app.config["ADMISSION_CONTROL"]
+    if admission_control is None:
+        return None
+
+    min_free, reservation_ttl = admission_control
+
+    return ReservationLedger(
+        Path(flask.current_app.config["CHUNK_PATH"]),
+        min_free=min_free,
+        ttl_s=reservation_ttl,
+    )
+
+
+def get_required_space(
+    total_size: int, file_path: Optional[Path] = None
+) -> List[Tuple[Path, int, Optional[Path]]]:
+    """
+    Returns where an upload needs disk space, and how much.
+
+    Args:
+        total_size (int): The size of the file in bytes.
+        file_path (Optional[Path]): The path to the file, if known.
+
+    Returns:
+        List[Tuple[Path, int, Optional[Path]]]: See
+            `admission.get_required_space`.
+    """
+    storage_path = None
+    chunk_mode = "direct"
+    if flask.current_app.config["STORAGE_BACKEND"] == "local":
+        storage_path = Path(flask.current_app.config["STORAGE_PATH"])
+        chunk_mode = flask.current_app.config["CHUNK_MODE"]
+
+    return admission.get_required_space(
+        total_size,
+        chunk_path=Path(flask.current_app.config["CHUNK_PATH"]),
+        storage_path=storage_path,
+        chunk_mode=chunk_mode,
+        file_path=file_path,
+    )
+
+
+def insufficient_storage_response(err: InsufficientStorage) -> flask.Response:
+    """
+    Returns the response that rejects an upload for lack of disk space.
+
+    Args:
+        err (InsufficientStorage): The error.
+
+    Returns:
+        flask.Response: A response object.
+    """
+    logger.warning(f"Rejected an upload: {err} on {err.path}")
+    response = flask.Response(status=507, response=str(err))
+    # The request body is not read, do not reuse the connection
+    response.headers["Connection"] = "close"
+
+    return response
+
+
+def release_reservation(upload_id: str) -> None:
+    """
+    Releases the disk space reserved by an upload that was discarded.
+
+    Args:
+        upload_id (str): The ID of the upload.
+    """
+    ledger = get_reservation_ledger()
+    if ledger is not None:
+        ledger.release(upload_id)
+
+    return None
+
+
+def sync_upload_file(path: Path) -> None:
+    """
+    Flushes a file (or directory) of an upload in progress to stable storage.
+    Concurrent requests for the chunks of a file share their flushes if
+    `[upload] group_commit` is on (see `helpers/durability.py`).
+
+    Args:
+        path (Path): The path to the file or directory.
+    """
+    durability.sync_file(
+        path,
+        delay_s=flask.current_app.config["GROUP_COMMIT_DELAY_S"],
+        grouped=flask.current_app.config["GROUP_COMMIT"],
+    )
+
+    return None
+
 
-def is_download_complete(dz_path: str, total_chunks: int) -> bool:
+def get_blobs_path() -> Optional[Path]:
     """
-    Check if the download is complete by verifying the number of chunk files.
+    Returns the root of the content-addressed store.
+
+    Returns:
+        Optional[Path]: The root of the store, or None if uploads are not
+            deduplicated.
+    """
+    if not flask.current_app.config.get("DEDUPE"):
+        return None
+
+    return Path(flask.current_app.config["STORAGE_PATH"]) / BLOBS_DIR_NAME
+
+
+def get_codec(data_type: Optional[str]) -> Optional[str]:
+    """
+    Returns the codec to compress files of the given data type with.
+
+    Args:
+        data_type (Optional[str]): The data type, from `UploadForm.data_type`.
+
+    Returns:
+        Optional[str]: The codec, or None to store the files uncompressed.
+    """
+    if not data_type:
+        return None
+
+    return flask.current_app.config["COMPRESSION_CODECS"].get(data_type)
+
+
+def finalize_or_queue(job_data: Dict[str, Any]) -> bool:
+    """
+    Finalizes a fully received upload, or queues it for the finalize workers,
+    depending on the app's finalize mode.
 
     Args:
-        dz_path (str): The directory path where chunk files are stored.
-        total_chunks (int): The total number of chunks expected.
+        job_data (Dict[str, Any]): Describes the upload (see
+            `finalizer.finalize_upload`).
 
     Returns:
-        bool: True if the number of chunk files matches the total_chunks, False otherwise.
+        bool: True if the upload was queued, False if it was finalized.
     """
-    chunk_path: Path = Path(dz_path)
-    if not chunk_path.exists():
+    if flask.current_app.config["FINALIZE_MODE"] == "inline":
+        finalizer.finalize_upload(job_data)
         return False
 
-    chunk_files = [int(f.name) for f in chunk_path.iterdir()]
-    return len(chunk_files) == total_chunks
+    # Hand the upload over to the finalize workers, and return at once
+    FinalizeJob(dz_uuid=job_data["file_uuid"], job_data=job_data).save()
+    logger.debug(f"Queued {job_data['file_name']} for finalization")
+
+    return True
+
+
+def get_upload_limiter() -> Optional[UploadLimiter]:
+    """
+    Returns the limiter of the users' upload requests.
+
+    Returns:
+        Optional[UploadLimiter]: The limiter, or None if uploads are not
+            limited.
+    """
+    upload_limits = flask.current_app.config["UPLOAD_LIMITS"]
+    if upload_limits is None:
+        return None
+
+    return UploadLimiter(
+        Path(flask.current_app.config["CHUNK_PATH"]),
+        max_concurrent=upload_limits["max_concurrent"],
+        max_concurrent_per_user=upload_limits["max_concurrent_per_user"],
+        bandwidth=upload_limits["bandwidth"],
+        burst=upload_limits["burst"],
+    )
+
+
+def acquire_upload_slot() -> Union[Optional[Lease], flask.Response]:
+    """
+    Takes one of the current user's upload slots for the current request.
+
+    Returns:
+        Union[Optional[Lease], flask.Response]: The slot (None if uploads are
+            not limited), or a 429 response with a Retry-After header if the
+            user is over their limits.
+    """
+    limiter = get_upload_limiter()
+    if limiter is None:
+        return None
+
+    current_user: User = flask_login.current_user  # type: ignore
+    try:
+        return limiter.acquire(current_user.username, flask.request.content_length or 0)
+    except RateLimited as err:
+        logger.debug(f"Limited {current_user.username}: {err}")
+        response = flask.Response(status=429, response=str(err))
+        response.headers["Retry-After"] = str(err.retry_after)
+        # The request body is not read, do not reuse the connection
+        response.headers["Connection"] = "close"
+        return response
+
+
+def release_upload_slot(lease: Optional[Lease]) -> None:
+    """
+    Releases an upload slot taken with `acquire_upload_slot`.
+
+    Args:
+        lease (Optional[Lease]): The slot.
+    """
+    limiter = get_upload_limiter()
+    if limiter is not None and lease is not None:
+        limiter.release(lease)
+
+    return None
+
+
+def get_ingest_meter() -> IngestMeter:
+    """
+    Returns the meter of the recent ingest throughput.
+
+    Returns:
+        IngestMeter: The meter.
+    """
+    return IngestMeter(
+        Path(flask.current_app.config["CHUNK_PATH"]),
+        window_s=flask.current_app.config["CHUNKING"]["window_s"],
+    )
+
+
+def record_ingest(started_at: float, response: flask.Response) -> None:
+    """
+    Records the throughput of an upload request, if it was received whole.
+
+    Args:
+        started_at (float): When the request started, from `time.monotonic`.
+        response (flask.Response): The response to the request.
+    """
+    if 200 <= response.status_code < 300:
+        get_ingest_meter().record(
+            flask.request.content_length or 0, time.monotonic() - started_at
+        )
+
+    return None
+
+
+def limit_uploads(view: Callable[..., flask.Response]) -> Callable[..., flask.Response]:
+    """
+    Holds one of the current user's upload slots while a view receives an
+    upload (POST or PATCH), and rejects the request with 429 and a
+    Retry-After header if the user is over their limits. The throughput of
+    the requests that get through is recorded (see `record_ingest`).
+
+    Args:
+        view (Callable[..., flask.Response]): The view function.
+
+    Returns:
+        Callable[..., flask.Response]: The limited view function.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args: Any, **kwargs: Any) -> flask.Response:
+        if flask.request.method not in ("POST", "PATCH"):
+            return view(*args, **kwargs)
+
+        lease = acquire_upload_slot()
+        if isinstance(lease, flask.Response):
+            return lease
+
+        started_at = time.monotonic()
+        try:
+            response = view(*args, **kwargs)
+        finally:
+            release_upload_slot(lease)
+        record_ingest(started_at, response)
+
+        return response
+
+    return wrapper
 
 
 @upload_bp.route("/", methods=["GET", "POST"])
@@ -123,97 +453,1197 @@ def upload_file() -> flask.Response:
         )
 
 
+class UploadReceiver:
+    """
+    Receives one upload request: a Dropzone chunk, or a whole file.
+
+    The request body is parsed while it is read from the client, and the file
+    part is written straight to its destination. Dropzone sends the `dz*`
+    fields ahead of the file part, so they are known by the time the file
+    data arrives.
+
+    With a remote storage backend, each chunk is sent on to the backend as
+    one part of the file, and nothing is assembled locally.
+
+    With admission control enabled, an upload is only accepted if there is
+    disk space for the whole file. The upload form sends the file's size
+    and ID in the `X-Upload-Length` and `X-Upload-Id` headers, so that
+    requests are rejected before their body is read.
+
+    The body is fed to `open_file` by a multipart parser, which the WSGI view
+    (`upload`) drives from the request stream and the ASGI app (see
+    `uploader/asgi.py`) from its receive loop. Every method needs a request
+    context.
+
+    Attributes:
+        boundary (bytes): The multipart boundary, set by `check`.
+        max_form_memory_size (int): The memory budget for form fields.
+    """
+
+    def __init__(self):
+        self.chunk_path = Path(flask.current_app.config["CHUNK_PATH"])
+        self.backend = get_storage_backend()
+        self.chunk_mode = flask.current_app.config["CHUNK_MODE"]
+        if self.backend.name != "local":
+            # Remote backends are written to in parts, there is nothing to
+            # concatenate
+            self.chunk_mode = "direct"
+        self.digest_algorithm = flask.current_app.config["DIGEST_ALGORITHM"]
+        self.durability = flask.current_app.config["DURABILITY"]
+        if self.backend.name != "local":
+            # Parts are durable once the backend acknowledges them
+            self.durability = "none"
+        self.ledger = get_reservation_ledger()
+        self.max_form_memory_size = (
+            flask.current_app.config.get("MAX_FORM_MEMORY_SIZE")
+            or multipart.MAX_FORM_MEMORY_SIZE
+        )
+        self.boundary = b""
+        self.upload_state: Dict[str, Any] = {}
+
+    def check_form(self) -> Optional[flask.Response]:
+        """
+        Checks the CSRF token and content type of the request.
+
+        Returns:
+            Optional[flask.Response]: The response that rejects the request,
+                or None if the body can be read.
+        """
+        csrf_error = check_csrf_header()
+        if csrf_error is not None:
+            return flask.Response(status=400, response=csrf_error)
+
+        boundary = flask.request.mimetype_params.get("boundary")
+        if flask.request.mimetype != "multipart/form-data" or not boundary:
+            return flask.Response(
+                status=400,
+                response="Expected a multipart/form-data request",
+            )
+        self.boundary = boundary.encode("latin-1")
+
+        return None
+
+    def check(self) -> Optional[flask.Response]:
+        """
+        Checks the request before its body is read.
+
+        Returns:
+            Optional[flask.Response]: The response that rejects the request,
+                or None if the body can be read.
+        """
+        rejected = self.check_form()
+        if rejected is not None:
+            return rejected
+
+        if self.ledger is not None:
+            try:
+                upload_length = int(
+                    flask.request.headers.get("X-Upload-Length")
+                    or flask.request.content_length
+                    or 0
+                )
+            except ValueError:
+                upload_length = 0
+            try:
+                self.ledger.check(
+                    flask.request.headers.get("X-Upload-Id"),
+                    get_required_space(upload_length),
+                )
+            except InsufficientStorage as err:
+                return insufficient_storage_response(err)
+
+        return None
+
+    def open_file(self, name: str, filename: str, fields: Dict[str, str]) -> FileSink:
+        """
+        Opens the sink the file part is written to (see `multipart.OpenFile`).
+
+        Raises:
+            ValueError: If the request is not a valid upload.
+            InsufficientStorage: If there is not enough disk space for it.
+        """
+        backend = self.backend
+        ledger = self.ledger
+        upload_state = self.upload_state
+        if name != "file" or upload_state:
+            raise ValueError(f"Unexpected file part {name}")
+
+        file_name = werkzeug_utils.secure_filename(filename)
+        upload_state["file_name"] = file_name
+        upload_state["codec"] = get_codec(fields.get("data_type"))
+
+        dz_uuid = fields.get("dzuuid")
+        if not dz_uuid:
+            # Assume this file has not been chunked
+            file_uuid = str(uuid.uuid4())
+            upload_state["file_uuid"] = file_uuid
+            if ledger is not None:
+                ledger.admit(
+                    file_uuid, get_required_space(flask.request.content_length or 0)
+                )
+            if backend.name == "local":
+                file_path = get_storage_file_path(file_uuid, file_name)
+                upload_state["part_path"] = file_path
+                sink: FileSink = files.OffsetWriter(
+                    file_path,
+                    0,
+                    drop_cache_above=flask.current_app.config["DROP_CACHE_ABOVE"],
+                    create=True,
+                )
+            else:
+                file_path = Path(backend.get_key(file_uuid, file_name))
+                upload_handle = backend.begin_upload(str(file_path), -1, 1)
+                upload_state["upload_handle"] = upload_handle
+                sink = backend.open_part(str(file_path), upload_handle, 1, 0)
+            upload_state["file_path"] = file_path
+            upload_state["sink"] = digest.DigestWriter(
+                sink, offset=0, algorithm=self.digest_algorithm
+            )
+            return upload_state["sink"]
+
+        # Chunked download
+        try:
+            uuid.UUID(dz_uuid)
+        except ValueError as err:
+            # It names the chunk directory and the stored file
+            raise ValueError(f"Invalid dzuuid {dz_uuid!r}") from err
+
+        try:
+            current_chunk = int(fields["dzchunkindex"])
+            total_chunks = int(fields["dztotalchunkcount"])
+        except KeyError as err:
+            raise ValueError(f"Missing key {err}") from err
+        except ValueError as err:
+            raise ValueError("Invalid chunk index or total count") from err
+
+        try:
+            total_file_size = int(fields["dztotalfilesize"])
+            chunk_size = int(fields["dzchunksize"])
+            chunk_byte_offset = int(fields["dzchunkbyteoffset"])
+        except KeyError as err:
+            raise ValueError(f"Missing key {err}") from err
+        except ValueError as err:
+            raise ValueError("Invalid chunk size, file size or byte offset") from err
+
+        # Chunks must tile the file, or they could overlap or leave gaps
+        chunk_offset, chunk_length = manifest.get_chunk_range(
+            current_chunk, total_chunks, chunk_size, total_file_size
+        )
+        if chunk_byte_offset != chunk_offset:
+            raise ValueError(
+                f"Chunk {current_chunk} starts at byte {chunk_offset}, "
+                f"not {chunk_byte_offset}"
+            )
+
+        upload_state["file_uuid"] = dz_uuid
+        if backend.name == "local":
+            file_path = get_storage_file_path(dz_uuid, file_name)
+            if ledger is not None:
+                ledger.admit(dz_uuid, get_required_space(total_file_size, file_path))
+        else:
+            file_path = Path(backend.get_key(dz_uuid, file_name))
+            if ledger is not None:
+                ledger.admit(dz_uuid, get_required_space(total_file_size))
+
+        # Save chunks in a directory named after the dz_uuid
+        # This is to avoid conflicts when multiple files are being uploaded
+        #
+        # The directory will be deleted once all the chunks are downloaded
+        save_dir = self.chunk_path / dz_uuid
+        save_dir.mkdir(exist_ok=True, parents=True)
+
+        upload_state["file_path"] = file_path
+        upload_state["save_dir"] = save_dir
+        upload_state["current_chunk"] = current_chunk
+        upload_state["total_chunks"] = total_chunks
+        upload_state["chunk_length"] = chunk_length
+
+        chunk_manifest = ChunkManifest(save_dir)
+        chunk_manifest.check_layout(total_chunks, chunk_size, total_file_size)
+        upload_state["chunk_lock"] = chunk_manifest.lock_chunk(current_chunk)
+        if chunk_manifest.is_received(current_chunk):
+            # e.g. a retry after a lost response: writing it again could
+            # leave its data and its block hashes out of step
+            logger.debug(f"Chunk {current_chunk} of {dz_uuid} already received")
+            upload_state["received"] = True
+            upload_state["sink"] = multipart.DiscardSink()
+            return upload_state["sink"]
+
+        # Hash the chunk's blocks on the way through, see helpers/digest.py
+        def hashed(sink: FileSink) -> FileSink:
+            upload_state["sink"] = digest.DigestWriter(
+                sink,
+                offset=chunk_offset,
+                algorithm=self.digest_algorithm,
+                file_size=total_file_size,
+                leaves_path=save_dir / digest.LEAVES_NAME,
+            )
+            return upload_state["sink"]
+
+        if self.chunk_mode == "direct":
+            # Write the chunk straight into the final file, as one of its parts
+            key = str(upload_state["file_path"])
+            upload_handle = storage.begin_upload_once(
+                backend, save_dir, key, total_file_size, total_chunks
+            )
+            upload_state["upload_handle"] = upload_handle
+            logger.debug(
+                f"Writing chunk {current_chunk} of {total_chunks} "
+                f"at offset {chunk_offset}"
+            )
+            return hashed(
+                backend.open_part(
+                    key, upload_handle, current_chunk + 1, chunk_offset, chunk_length
+                )
+            )
+
+        # Save the individual chunk, under a temporary name until it is complete
+        part_path = save_dir / f"{current_chunk}.part"
+        upload_state["part_path"] = part_path
+        logger.debug(f"Uploading chunk {current_chunk} of {total_chunks}")
+        return hashed(open(part_path, "wb", buffering=files.BUFFER_SIZE))
+
+    def release_chunk(self) -> None:
+        """
+        Releases the lock on receiving the chunk, if held.
+        """
+        chunk_lock = self.upload_state.pop("chunk_lock", None)
+        if chunk_lock is not None:
+            chunk_lock.close()
+
+        return None
+
+    def reject(self, err: BaseException) -> flask.Response:
+        """
+        Discards what was written of a rejected request.
+
+        Args:
+            err (BaseException): Why the request was rejected, e.g. a ValueError,
+                an InsufficientStorage error or a client disconnect.
+
+        Returns:
+            flask.Response: A response object.
+        """
+        upload_state = self.upload_state
+        try:
+            sink = upload_state.get("sink")
+            if isinstance(sink, digest.DigestWriter) and sink.leaves_path is not None:
+                # A retry of the chunk may write other bytes than these
+                sink.discard()
+        finally:
+            self.release_chunk()
+        if isinstance(err, InsufficientStorage):
+            return insufficient_storage_response(err)
+
+        part_path = upload_state.get("part_path")
+        if part_path is not None and part_path.exists():
+            part_path.unlink()
+        if "save_dir" not in upload_state and "upload_handle" in upload_state:
+            self.backend.abort(
+                str(upload_state["file_path"]), upload_state["upload_handle"]
+            )
+        if "save_dir" not in upload_state and self.ledger is not None:
+            self.ledger.release(upload_state.get("file_uuid", ""))
+        return flask.Response(
+            status=400,
+            response=str(err),
+        )
+
+    def sync_chunk(self) -> None:
+        """
+        Flushes the data of the received chunk, and the hashes of its blocks,
+        to stable storage (see `sync_upload_file`).
+        """
+        upload_state = self.upload_state
+
+        if self.chunk_mode == "direct":
+            file_path = upload_state["file_path"]
+            sync_upload_file(file_path)
+            sync_upload_file(file_path.parent)
+        else:
+            sync_upload_file(upload_state["part_path"])
+
+        leaves_path = upload_state["save_dir"] / digest.LEAVES_NAME
+        if leaves_path.exists():
+            sync_upload_file(leaves_path)
+
+        return None
+
+    def complete(self) -> flask.Response:
+        """
+        Records the received file or chunk, once the whole body is read, and
+        finalizes the upload if it was the last chunk.
+
+        Returns:
+            flask.Response: A response object.
+        """
+        backend = self.backend
+        upload_state = self.upload_state
+        if not upload_state:
+            return flask.Response(
+                status=301,
+                response="No file provided",
+            )
+
+        file_uuid = upload_state["file_uuid"]
+        file_name = upload_state["file_name"]
+        file_path = upload_state["file_path"]
+
+        if "save_dir" not in upload_state:
+            file_size = None
+            if backend.name != "local":
+                backend.complete(str(file_path), upload_state["upload_handle"], 1)
+                file_size = backend.get_size(str(file_path))
+            try:
+                finalizer.register_upload(
+                    file_uuid=file_uuid,
+                    file_name=file_name,
+                    file_path=file_path,
+                    file_digest=upload_state["sink"].digest(),
+                    blobs_path=get_blobs_path(),
+                    codec=upload_state["codec"],
+                    storage_backend=backend.name,
+                    file_size=file_size,
+                    sync=self.durability != "none",
+                )
+            finally:
+                if self.ledger is not None:
+                    self.ledger.release(file_uuid)
+
+            return flask.Response(
+                status=200,
+                response="File uploaded successfully",
+            )
+
+        save_dir = upload_state["save_dir"]
+        current_chunk = upload_state["current_chunk"]
+        total_chunks = upload_state["total_chunks"]
+
+        received = upload_state.get("received", False)
+        written = upload_state["sink"].written
+        if not received and written != upload_state["chunk_length"]:
+            return self.reject(
+                ValueError(
+                    f"Chunk {current_chunk} has {written} bytes, "
+                    f"expected {upload_state['chunk_length']}"
+                )
+            )
+
+        sync_chunk = self.durability == "chunk" and not received
+        chunk_manifest = ChunkManifest(save_dir)
+        try:
+            if sync_chunk:
+                self.sync_chunk()
+            if self.chunk_mode != "direct" and not received:
+                upload_state["part_path"].rename(save_dir / str(current_chunk))
+
+            # Only the request that completes the upload gets to finalize it
+            try:
+                completed = chunk_manifest.mark_received(current_chunk, total_chunks)
+            except ValueError as err:
+                return flask.Response(
+                    status=400,
+                    response=str(err),
+                )
+            if sync_chunk:
+                # The chunk is never asked for again once it is acknowledged
+                sync_upload_file(chunk_manifest.path)
+                sync_upload_file(save_dir)
+                sync_upload_file(save_dir.parent)
+        finally:
+            self.release_chunk()
+
+        if not completed:
+            return flask.Response(
+                status=200,
+                response="Chunk uploaded successfully",
+            )
+
+        job_data: Dict[str, Any] = {
+            "file_uuid": str(file_uuid),
+            "file_name": file_name,
+            "file_path": str(file_path),
+            "save_dir": str(save_dir),
+            "total_chunks": total_chunks,
+            "chunk_mode": self.chunk_mode,
+            "digest_algorithm": self.digest_algorithm,
+            "durability": self.durability,
+            "drop_cache_above": flask.current_app.config["DROP_CACHE_ABOVE"],
+        }
+        blobs_path = get_blobs_path()
+        if blobs_path is not None:
+            job_data["blobs_path"] = str(blobs_path)
+        if upload_state["codec"] is not None:
+            job_data["codec"] = upload_state["codec"]
+        if backend.name != "local":
+            job_data["storage"] = backend.name
+            job_data["upload_handle"] = upload_state["upload_handle"]
+
+        try:
+            queued = finalize_or_queue(job_data)
+        except Exception:
+            chunk_manifest.release_claim()
+            raise
+
+        if queued:
+            return flask.Response(
+                status=202,
+                response="Upload queued for finalization",
+            )
+
+        return flask.Response(
+            status=200,
+            response="Chunk uploaded successfully",
+        )
+
+
 @upload_bp.route("/upload", methods=["POST"])
 @flask_login.login_required
+@limit_uploads
 def upload() -> flask.Response:
     """
-    Uploads a file to the server.
+    Uploads a file to the server (see `UploadReceiver`).
 
     Returns:
         flask.Response: A response object.
     """
+    receiver = UploadReceiver()
+    rejected = receiver.check()
+    if rejected is not None:
+        return rejected
 
-    file = flask.request.files.get("file")
-    if not file:
-        return flask.Response(
-            status=301,
-            response="No file provided",
+    try:
+        multipart.parse_form(
+            stream=flask.request.stream,
+            boundary=receiver.boundary,
+            open_file=receiver.open_file,
+            max_form_memory_size=receiver.max_form_memory_size,
         )
+    except (InsufficientStorage, ValueError) as err:
+        return receiver.reject(err)
+    except werkzeug_exceptions.BadRequest as err:
+        # e.g. the client disconnected (ClientDisconnected): discard what was
+        # written, which no chunk directory would lead the janitor to
+        receiver.reject(err)
+        raise
 
-    storage_path = Path(flask.current_app.config["STORAGE_PATH"])
-    chunk_path = Path(flask.current_app.config["CHUNK_PATH"])
+    return receiver.complete()
+
+
+class BatchChunk:
+    """
+    One chunk of a batched upload request (see `upload_batch`), written
+    through its own `UploadReceiver`.
+
+    A chunk that is rejected (when opened, written or closed) is discarded
+    without failing the rest of the request, and a chunk that is received
+    whole is recorded as soon as its part ends.
+
+    Attributes:
+        ack (Dict[str, Any]): The acknowledgement of the chunk: its upload
+            'uuid' and chunk 'index', the 'status' it got, and an 'error'
+            message if it was rejected.
+    """
+
+    def __init__(self, fields: Dict[str, str]):
+        self.receiver = UploadReceiver()
+        self.ack: Dict[str, Any] = {"uuid": fields.get("dzuuid")}
+        try:
+            self.ack["index"] = int(fields.get("dzchunkindex", ""))
+        except ValueError:
+            self.ack["index"] = fields.get("dzchunkindex")
+        self._sink: Optional[FileSink] = None
+
+    def __repr__(self) -> str:
+        return f"<BatchChunk {self.ack['uuid']}:{self.ack['index']}>"
+
+    def open(self, name: str, filename: str, fields: Dict[str, str]) -> None:
+        """
+        Opens the sink of the chunk (see `UploadReceiver.open_file`).
+        """
+        try:
+            self._sink = self.receiver.open_file(name, filename, fields)
+        except (InsufficientStorage, ValueError) as err:
+            self._reject(err)
+
+    def _reject(self, err: Exception) -> None:
+        self._sink = None
+        response = self.receiver.reject(err)
+        self.ack["status"] = response.status_code
+        self.ack["error"] = response.get_data(as_text=True)
+
+    def write(self, data: bytes) -> None:
+        """
+        Writes a block of the chunk, or discards it if the chunk was rejected.
+        """
+        if self._sink is None:
+            return
+        try:
+            self._sink.write(data)
+        except (InsufficientStorage, ValueError) as err:
+            self._close_sink()
+            self._reject(err)
+
+    def _close_sink(self) -> None:
+        try:
+            self._sink.close()  # type: ignore
+        except ValueError:
+            pass
+
+    def close(self) -> None:
+        """
+        Records the chunk once all of its data has been written.
+        """
+        if self._sink is None:
+            return
+        try:
+            self._sink.close()
+        except (InsufficientStorage, ValueError) as err:
+            self._reject(err)
+            return
+        self._sink = None
+
+        response = self.receiver.complete()
+        self.ack["status"] = response.status_code
+        if response.status_code >= 400:
+            self.ack["error"] = response.get_data(as_text=True)
+
+    def abort(self) -> None:
+        """
+        Rejects the chunk, its part cut short by the end of the body (see
+        `StreamingFormParser.abort`).
+        """
+        if self._sink is not None:
+            self._close_sink()
+            self._reject(ValueError("Unexpected end of multipart body"))
+
+
+@upload_bp.route("/batch", methods=["POST"])
+@flask_login.login_required
+@limit_uploads
+def upload_batch() -> flask.Response:
+    """
+    Uploads several chunks, of one or more files, in one request, sparing the
+    per-request costs (session, CSRF, limits) that dominate for small chunks
+    on fast networks.
 
-    dz_uuid = flask.request.form.get("dzuuid")
-    if not dz_uuid:
-        # Assume this file has not been chunked
-        file_uuid = uuid.uuid4()
-        file_name = werkzeug_utils.secure_filename(file.filename)  # type: ignore
-        file_path = storage_path / f"{file_uuid}_{file_name}"
-        with open(file_path, "wb") as f:
-            file.save(f)
-
-        uploaded_file = UploadedFile(
-            uuid=str(file_uuid), file_name=file_name, file_path=file_path
+    The body is a multipart form with one `file` part per chunk, each
+    preceded by the same `dz*` (and `data_type`) fields as a chunk sent to
+    `/upload/upload`. Each chunk is acknowledged on its own, so a client can
+    resend just the chunks that failed.
+
+    Returns:
+        flask.Response: A JSON response with the acknowledgement of each
+            chunk, in the order they were sent (see `BatchChunk`). 400 if the
+            body is malformed, with the chunks received up to that point.
+    """
+    rejected = UploadReceiver().check_form()
+    if rejected is not None:
+        return rejected
+    boundary = flask.request.mimetype_params["boundary"].encode("latin-1")
+
+    chunks: List[BatchChunk] = []
+
+    def open_file(name: str, filename: str, fields: Dict[str, str]) -> FileSink:
+        chunk = BatchChunk(fields)
+        chunks.append(chunk)
+        chunk.open(name, filename, fields)
+        return chunk
+
+    status = 200
+    try:
+        multipart.parse_form(
+            stream=flask.request.stream,
+            boundary=boundary,
+            open_file=open_file,
+            max_form_memory_size=(
+                flask.current_app.config.get("MAX_FORM_MEMORY_SIZE")
+                or multipart.MAX_FORM_MEMORY_SIZE
+            ),
+            scoped_fields=True,
         )
-        uploaded_file.save(config_file=flask.current_app.config["CONFIG_FILE"])
+    except ValueError as err:
+        logger.debug(f"Malformed batch after {len(chunks)} chunk(s): {err}")
+        status = 400
 
-        return flask.Response(
-            status=200,
-            response="File uploaded successfully",
+    logger.debug(f"Received a batch of {len(chunks)} chunk(s)")
+
+    response = flask.jsonify({"chunks": [chunk.ack for chunk in chunks]})
+    response.status_code = status
+
+    return response
+
+
+@upload_bp.route("/limits", methods=["GET"])
+@flask_login.login_required
+def limits() -> flask.Response:
+    """
+    Returns the upload limits, and the current user's usage of them.
+
+    Returns:
+        flask.Response: A JSON response with the 'limits' and the 'usage'
+            (see `UploadLimiter.usage`), both None if uploads are not
+            limited, and the disk space 'reserved' by uploads in flight.
+    """
+    current_user: User = flask_login.current_user  # type: ignore
+
+    limiter = get_upload_limiter()
+    ledger = get_reservation_ledger()
+
+    return flask.jsonify(
+        {
+            "limits": limiter.get_limits() if limiter is not None else None,
+            "usage": (
+                limiter.usage(current_user.username) if limiter is not None else None
+            ),
+            "reserved": ledger.usage() if ledger is not None else None,
+        }
+    )
+
+
+@upload_bp.route("/chunking", methods=["GET"])
+@flask_login.login_required
+def chunking() -> flask.Response:
+    """
+    Returns how the current user's client should chunk its uploads, from the
+    recent ingest throughput and the current load (see `helpers/ingest.py`).
+
+    Returns:
+        flask.Response: A JSON response with the recommended 'chunk_size' in
+            bytes, 'chunk_concurrency' (chunks of a file sent at once) and
+            'parallel_uploads' (files uploaded at once), and the 'measured'
+            ingest (see `IngestMeter.stats`).
+    """
+    current_user: User = flask_login.current_user  # type: ignore
+    chunking_config = dict(flask.current_app.config["CHUNKING"])
+    if get_storage_backend().name == "s3":
+        # Chunks are uploaded as parts, which must be at least 5 MB
+        chunking_config["min_chunk_size"] = max(
+            chunking_config["min_chunk_size"], 2 * MIN_PART_SIZE
+        )
+
+    stats = get_ingest_meter().stats()
+    limiter = get_upload_limiter()
+    if limiter is not None:
+        usage = limiter.usage(current_user.username)
+        recommended = ingest.recommend(
+            stats,
+            chunking_config,
+            budget=usage["fair_share"],
+            capacity=limiter.max_concurrent,
+            in_flight=usage["total_active"],
+        )
+    else:
+        recommended = ingest.recommend(
+            stats, chunking_config, budget=int(chunking_config["max_connections"])
+        )
+
+    return flask.jsonify({**recommended, "measured": stats})
+
+
+@upload_bp.route("/status/<dz_uuid>", methods=["GET"])
+@flask_login.login_required
+def status(dz_uuid: str) -> flask.Response:
+    """
+    Returns the finalization status of an upload.
+
+    Args:
+        dz_uuid (str): The Dropzone UUID of the upload.
+
+    Returns:
+        flask.Response: A JSON response with the 'status' of the upload
+            ('queued', 'running', 'done' or 'failed') and the 'error' of the
+            last failed attempt, if any.
+    """
+    job = FinalizeJob.find_by_uuid_query(dz_uuid=dz_uuid)
+    if job is not None:
+        return flask.jsonify(
+            {"uuid": dz_uuid, "status": job.status, "error": job.error or None}
         )
 
-    # Chunked download
+    # Finalized inline, or not chunked at all
+    if UploadedFile.find_by_uuid_query(uuid=dz_uuid) is not None:
+        return flask.jsonify({"uuid": dz_uuid, "status": "done", "error": None})
+
+    return flask.make_response(
+        flask.jsonify({"uuid": dz_uuid, "status": "unknown", "error": None}), 404
+    )
+
+
+def get_blob_challenge_serializer() -> itsdangerous.URLSafeTimedSerializer:
+    """
+    Returns the serializer that signs the challenges of `blob`, so that they
+    need no server-side state.
+
+    Returns:
+        itsdangerous.URLSafeTimedSerializer: The serializer.
+    """
+    return itsdangerous.URLSafeTimedSerializer(
+        flask.current_app.secret_key, salt="blob-challenge"  # type: ignore
+    )
+
+
+def check_blob_proof(
+    file_digest: str, file_size: int, payload: Dict[str, Any]
+) -> bool:
+    """
+    Checks the answer to a challenge issued by `blob`: the signed 'token'
+    of the challenge, the 'leaves' of the file (hex), and the 'blocks' it
+    asked for (base64, by index).
+
+    Args:
+        file_digest (str): The content digest of the file.
+        file_size (int): The size of the file in bytes.
+        payload (Dict[str, Any]): The JSON body of the request.
+
+    Returns:
+        bool: True if the current user proved they hold the file.
+    """
+    current_user: User = flask_login.current_user  # type: ignore
     try:
-        current_chunk = int(flask.request.form["dzchunkindex"])
-        total_chunks = int(flask.request.form["dztotalchunkcount"])
-    except KeyError as err:
-        return flask.Response(
-            status=400,
-            response=f"Missing key {err}",
+        challenge = get_blob_challenge_serializer().loads(
+            payload["token"], max_age=BLOB_CHALLENGE_MAX_AGE_S
         )
+        leaves = bytes.fromhex(payload["leaves"])
+        blocks = {
+            int(block_index): base64.b64decode(payload["blocks"][str(block_index)])
+            for block_index in challenge["blocks"]
+        }
+    except (itsdangerous.BadData, KeyError, TypeError, ValueError):
+        return False
+
+    if (
+        challenge.get("user") != current_user.username
+        or challenge.get("digest") != file_digest
+        or challenge.get("size") != file_size
+    ):
+        return False
+
+    return digest.check_possession(file_digest, file_size, leaves, blocks)
+
+
+@upload_bp.route("/blobs/<file_digest>", methods=["GET", "POST"])
+@flask_login.login_required
+def blob(file_digest: str) -> flask.Response:
+    """
+    Checks whether a file with the given content digest is already stored,
+    so that clients can skip uploading it again.
+
+    The digest is not a secret (downloads carry it), so the content is only
+    found for users who prove they hold it: by having submitted a file with
+    that digest, or by answering a challenge.
+
+    GET only answers the question, for the user's own files. POST, with a
+    JSON body holding the 'file_name' and the 'size' of the file, registers
+    a new file that shares the stored blob, and returns its 'uuid' as if the
+    file had been uploaded. Unless the user submitted a file with the digest,
+    the first POST is answered with a 403 and a 'challenge': the 'blocks' of
+    the file to send, and a 'token' to send them with (see
+    `check_blob_proof`). The challenge does not tell whether the content is
+    stored.
+
+    Args:
+        file_digest (str): The content digest, e.g. 'sha256-tree:9f86d08...'.
+
+    Returns:
+        flask.Response: A JSON response, with a 404 status if the content
+            is not stored.
+    """
+    blobs_path = get_blobs_path()
+    label, value = digest.parse_digest(file_digest)
+    try:
+        bytes.fromhex(value)
     except ValueError:
-        return flask.Response(
-            status=400,
-            response="Invalid chunk index or total count",
+        value = ""
+    if label not in digest.ALGORITHMS.values() or len(value) != 64:
+        return flask.make_response(
+            flask.jsonify({"digest": file_digest, "error": "Invalid digest"}), 400
         )
 
-    # Save chunks in a directory named after the dz_uuid
-    # This is to avoid conflicts when multiple files are being uploaded
-    #
-    # The directory will be deleted once all the chunks are downloaded
-    save_dir = chunk_path / dz_uuid
+    current_user: User = flask_login.current_user  # type: ignore
+    owned = blobs_path is not None and SubmittedFilesMap.user_owns_digest(
+        user_name=current_user.username, digest=file_digest
+    )
 
-    if not save_dir.exists():
-        save_dir.mkdir(exist_ok=True, parents=True)
+    if flask.request.method == "GET":
+        stored = None
+        if owned:
+            stored = Blob.find_by_digest_query(digest=file_digest)
+        if stored is None:
+            return flask.make_response(
+                flask.jsonify({"digest": file_digest, "exists": False}), 404
+            )
+        return flask.jsonify(
+            {"digest": file_digest, "exists": True, "size": stored.size_bytes}
+        )
 
-    # Save the individual chunk
-    with open(save_dir / str(current_chunk), "wb") as f:
-        file.save(f)
-        logger.debug(f"Uploading chunk {current_chunk} of {total_chunks}")
+    payload = flask.request.get_json(silent=True) or {}
+    file_name = werkzeug_utils.secure_filename(str(payload.get("file_name", "")))
+    if not file_name:
+        return flask.make_response(
+            flask.jsonify({"digest": file_digest, "error": "Missing file_name"}), 400
+        )
+
+    if not owned:
+        try:
+            file_size = int(payload["size"])
+        except (KeyError, TypeError, ValueError):
+            file_size = -1
+        if file_size < 0:
+            return flask.make_response(
+                flask.jsonify({"digest": file_digest, "error": "Missing size"}), 400
+            )
 
-    completed = is_download_complete(str(save_dir), total_chunks)
-
-    # Concat all the files into the final file when all are downloaded
-    if completed:
-        logger.debug(f"All chunks downloaded for {file.filename}. Concatenating...")
-        file_uuid = dz_uuid
-        file_name = werkzeug_utils.secure_filename(file.filename)  # type: ignore
-        file_path = storage_path / f"{file_uuid}_{file_name}"
-        with open(file_path, "wb") as f:
-            for file_number in range(total_chunks):
-                f.write((save_dir / str(file_number)).read_bytes())
-        logger.info(f"{file.filename} has been uploaded")
-
-        uploaded_file = UploadedFile(
-            uuid=str(file_uuid), file_name=file_name, file_path=file_path
+        if "token" not in payload:
+            block_count = digest.get_block_count(file_size)
+            block_indexes = sorted(
+                secrets.SystemRandom().sample(
+                    range(block_count), min(BLOB_CHALLENGE_BLOCKS, block_count)
+                )
+            )
+            token = get_blob_challenge_serializer().dumps(
+                {
+                    "user": current_user.username,
+                    "digest": file_digest,
+                    "size": file_size,
+                    "blocks": block_indexes,
+                }
+            )
+            return flask.make_response(
+                flask.jsonify(
+                    {
+                        "digest": file_digest,
+                        "challenge": {"token": token, "blocks": block_indexes},
+                    }
+                ),
+                403,
+            )
+
+        if not check_blob_proof(file_digest, file_size, payload):
+            return flask.make_response(
+                flask.jsonify({"digest": file_digest, "error": "Invalid proof"}), 403
+            )
+
+        # The leaves only prove the size to within a block
+        stored = None
+        if blobs_path is not None:
+            stored = Blob.find_by_digest_query(digest=file_digest)
+        if stored is None or stored.original_size != file_size:
+            return flask.make_response(
+                flask.jsonify({"digest": file_digest, "exists": False}), 404
+            )
+
+    acquired = None
+    if blobs_path is not None:
+        acquired = Blob.acquire(
+            digest=file_digest, file_path=None, blobs_path=blobs_path
+        )
+    if acquired is None:
+        return flask.make_response(
+            flask.jsonify({"digest": file_digest, "exists": False}), 404
         )
-        uploaded_file.save()
 
-        cli.remove_directory(save_dir)
+    file_uuid = str(uuid.uuid4())
+    try:
+        UploadedFile(
+            uuid=file_uuid,
+            file_name=file_name,
+            file_path=acquired.blob_path,
+            digest=file_digest,
+            codec=acquired.codec,
+            original_size=acquired.original_size,
+        ).save()
+    except Exception:
+        acquired.release()
+        raise
+    logger.info(f"{file_name} matches stored blob {file_digest}, skipped its upload")
 
-    return flask.Response(
-        status=200,
-        response="Chunk uploaded successfully",
+    return flask.jsonify({"digest": file_digest, "exists": True, "uuid": file_uuid})
+
+
+def check_csrf_header() -> Optional[str]:
+    """
+    Checks the CSRF token in the X-CSRF-Token header of the request.
+
+    The streaming endpoints are exempt from CSRFProtect, which would parse
+    (and spool) the whole body to look for a token field, and call this
+    instead.
+
+    Returns:
+        Optional[str]: Why the token was rejected, or None if it is valid.
+    """
+    try:
+        flask_wtf_csrf.validate_csrf(flask.request.headers.get("X-CSRF-Token"))
+    except wtforms.ValidationError as err:
+        return f"CSRF validation failed: {err}"
+
+    return None
+
+
+def tus_response(status: int, headers: Optional[Dict[str, str]] = None) -> flask.Response:
+    """
+    Returns an empty response with the headers every tus response carries.
+
+    Args:
+        status (int): The status code.
+        headers (Optional[Dict[str, str]]): Additional headers.
+
+    Returns:
+        flask.Response: A response object.
+    """
+    response = flask.Response(status=status)
+    response.headers["Tus-Resumable"] = tus.TUS_VERSION
+    response.headers["Cache-Control"] = "no-store"
+    for key, value in (headers or {}).items():
+        response.headers[key] = value
+
+    return response
+
+
+def load_tus_upload(upload_id: str) -> Union[TusUpload, flask.Response]:
+    """
+    Loads a tus upload owned by the current user, or returns the error
+    response to send instead.
+
+    Args:
+        upload_id (str): The ID of the upload.
+
+    Returns:
+        Union[TusUpload, flask.Response]: The upload, or an error response.
+    """
+    if flask.request.headers.get("Tus-Resumable") != tus.TUS_VERSION:
+        return tus_response(412, {"Tus-Version": tus.TUS_VERSION})
+
+    chunk_path = Path(flask.current_app.config["CHUNK_PATH"])
+    current_user: User = flask_login.current_user  # type: ignore
+
+    tus_upload = TusUpload.load(chunk_path, upload_id)
+    if tus_upload is None or tus_upload.owner != current_user.username:
+        return tus_response(404)
+
+    if tus_upload.is_expired:
+        tus_upload.delete()
+        release_reservation(tus_upload.upload_id)
+        return tus_response(410)
+
+    return tus_upload
+
+
+def finalize_tus_upload(tus_upload: TusUpload) -> None:
+    """
+    Hands a complete tus upload over to be finalized (see
+    `finalize_or_queue`), and records that it was, so that it happens once.
+    Call while holding the upload's lock.
+
+    Args:
+        tus_upload (TusUpload): The complete upload.
+    """
+    tus_upload.finalizing = True
+    tus_upload.save()
+    job_data: Dict[str, Any] = {
+        "file_uuid": tus_upload.upload_id,
+        "file_name": tus_upload.file_name,
+        "file_path": str(tus_upload.file_path),
+        "save_dir": str(tus_upload.save_dir),
+        "total_chunks": 1,
+        "chunk_mode": "direct",
+        "digest_algorithm": flask.current_app.config["DIGEST_ALGORITHM"],
+        "durability": flask.current_app.config["DURABILITY"],
+        "drop_cache_above": flask.current_app.config["DROP_CACHE_ABOVE"],
+    }
+    blobs_path = get_blobs_path()
+    if blobs_path is not None:
+        job_data["blobs_path"] = str(blobs_path)
+    codec = get_codec(tus_upload.data_type)
+    if codec is not None:
+        job_data["codec"] = codec
+    try:
+        finalize_or_queue(job_data)
+    except Exception:
+        if tus_upload.save_dir.exists():
+            tus_upload.finalizing = False
+            tus_upload.save()
+        raise
+
+    return None
+
+
+@upload_bp.route("/tus/", methods=["OPTIONS", "POST"])
+@flask_login.login_required
+def tus_create() -> flask.Response:
+    """
+    tus endpoint: advertises the server's capabilities (OPTIONS), and
+    creates new uploads (POST).
+
+    Returns:
+        flask.Response: A response object.
+    """
+    if flask.request.method == "OPTIONS":
+        return tus_response(
+            204,
+            {
+                "Tus-Version": tus.TUS_VERSION,
+                "Tus-Extension": ",".join(tus.TUS_EXTENSIONS),
+            },
+        )
+
+    if flask.request.headers.get("Tus-Resumable") != tus.TUS_VERSION:
+        return tus_response(412, {"Tus-Version": tus.TUS_VERSION})
+
+    if check_csrf_header() is not None:
+        return tus_response(400)
+
+    backend = get_storage_backend()
+    if backend.name != "local":
+        # tus uploads are written to (and registered from) the local disk
+        logger.warning(f"Rejected a tus upload: not supported with {backend}")
+        response = tus_response(501)
+        response.set_data("tus uploads need the local storage backend")
+        return response
+
+    try:
+        length = int(flask.request.headers["Upload-Length"])
+        metadata = tus.parse_metadata(flask.request.headers.get("Upload-Metadata"))
+    except (KeyError, ValueError):
+        return tus_response(400)
+    if length < 0:
+        return tus_response(400)
+
+    file_name = werkzeug_utils.secure_filename(
+        metadata.get("filename") or metadata.get("name") or "upload"
+    )
+    current_user: User = flask_login.current_user  # type: ignore
+
+    tus_upload = TusUpload.create(
+        chunk_path=Path(flask.current_app.config["CHUNK_PATH"]),
+        storage_path=Path(flask.current_app.config["STORAGE_PATH"]),
+        storage_layout=flask.current_app.config["STORAGE_LAYOUT"],
+        file_name=file_name,
+        length=length,
+        owner=current_user.username,
+        expiration_s=flask.current_app.config["TUS_EXPIRATION_S"],
+        data_type=metadata.get("data_type"),
+    )
+    logger.debug(f"Created tus upload {tus_upload}")
+
+    ledger = get_reservation_ledger()
+    if ledger is not None:
+        try:
+            ledger.admit(
+                tus_upload.upload_id,
+                admission.get_required_space(
+                    length,
+                    chunk_path=tus_upload.save_dir.parent,
+                    storage_path=tus_upload.file_path.parent,
+                    chunk_mode="direct",
+                    file_path=tus_upload.file_path,
+                ),
+            )
+        except InsufficientStorage as err:
+            tus_upload.delete()
+            logger.warning(f"Rejected a tus upload: {err} on {err.path}")
+            return tus_response(507)
+
+    if tus_upload.is_complete:
+        # An empty upload gets no PATCH to complete it
+        with tus_upload.lock():
+            finalize_tus_upload(tus_upload)
+
+    return tus_response(
+        201,
+        {
+            "Location": flask.url_for(
+                "upload.tus_resource", upload_id=tus_upload.upload_id
+            ),
+            "Upload-Expires": werkzeug_http.http_date(tus_upload.expires_at),
+        },
+    )
+
+
+@upload_bp.route("/tus/<upload_id>", methods=["HEAD", "PATCH", "DELETE"])
+@flask_login.login_required
+@limit_uploads
+def tus_resource(upload_id: str) -> flask.Response:
+    """
+    tus endpoint: reports the offset of an upload (HEAD), appends data to it
+    (PATCH) and terminates it (DELETE).
+
+    Once all the bytes are received, the upload is finalized and registered
+    as an UploadedFile under the upload ID, like a Dropzone upload.
+
+    Args:
+        upload_id (str): The ID of the upload.
+
+    Returns:
+        flask.Response: A response object.
+    """
+    loaded = load_tus_upload(upload_id)
+    if isinstance(loaded, flask.Response):
+        return loaded
+    tus_upload: TusUpload = loaded
+
+    if flask.request.method != "HEAD" and check_csrf_header() is not None:
+        return tus_response(400)
+
+    if flask.request.method == "HEAD":
+        return tus_response(
+            200,
+            {
+                "Upload-Offset": str(tus_upload.offset),
+                "Upload-Length": str(tus_upload.length),
+                "Upload-Expires": werkzeug_http.http_date(tus_upload.expires_at),
+            },
+        )
+
+    if flask.request.method == "DELETE":
+        try:
+            with tus_upload.lock():
+                tus_upload.refresh()
+                if tus_upload.is_complete or tus_upload.finalizing:
+                    # Its file is being (or was) registered
+                    return tus_response(409)
+                tus_upload.delete()
+        except tus.TusUploadLocked:
+            return tus_response(423)
+        release_reservation(tus_upload.upload_id)
+        return tus_response(204)
+
+    if flask.request.mimetype != "application/offset+octet-stream":
+        return tus_response(415)
+    try:
+        offset = int(flask.request.headers["Upload-Offset"])
+    except (KeyError, ValueError):
+        return tus_response(400)
+
+    try:
+        with tus_upload.lock():
+            try:
+                tus_upload.append(
+                    stream=flask.request.stream,
+                    offset=offset,
+                    expiration_s=flask.current_app.config["TUS_EXPIRATION_S"],
+                    digest_algorithm=flask.current_app.config["DIGEST_ALGORITHM"],
+                    sync=flask.current_app.config["DURABILITY"] == "chunk",
+                    drop_cache_above=flask.current_app.config["DROP_CACHE_ABOVE"],
+                )
+            except ValueError as err:
+                logger.debug(f"Rejected tus PATCH for {upload_id}: {err}")
+                status_code = 409 if offset != tus_upload.offset else 400
+                return tus_response(status_code)
+
+            # A PATCH at the end of a complete upload (e.g. a retry after a
+            # lost response) must not hand it over again
+            if tus_upload.is_complete and not tus_upload.finalizing:
+                finalize_tus_upload(tus_upload)
+    except tus.TusUploadLocked:
+        return tus_response(423)
+
+    return tus_response(
+        204,
+        {
+            "Upload-Offset": str(tus_upload.offset),
+            "Upload-Expires": werkzeug_http.http_date(tus_upload.expires_at),
+        },
     )
 
 
@@ -234,7 +1664,7 @@ def history() -> flask.Response:
     )
 
     uploaded_files_list: List[UploadedFileView] = []
-    for _, row in uploaded_files.iterrows():
+    for row in uploaded_files:
         submission_data: Dict[str, Any] = row["submission_data"]
         uploaded_file_view = UploadedFileView(
             uuid=row["uuid"],
@@ -269,8 +1699,8 @@ def delete(uuid: str) -> flask.Response:
     Returns:
         flask.Response: A response object.
     """
-    uploaded_file_df: pd.DataFrame = SubmittedFilesMap.get_file_by_uuid(uuid=uuid)
-    if uploaded_file_df.empty:
+    uploaded_file = SubmittedFilesMap.get_file_by_uuid(uuid=uuid)
+    if uploaded_file is None:
         flask.flash("Invalid file UUID", "error")
         return flask.redirect(flask.url_for("upload.history"))
 
@@ -280,6 +1710,178 @@ def delete(uuid: str) -> flask.Response:
     return flask.redirect(flask.url_for("upload.history"))
 
 
+def send_local_file(
+    uploaded_file: UploadedFile, etag: Optional[str] = None
+) -> flask.Response:
+    """
+    Sends a file from the local disk, read front to back with the kernel's
+    read-ahead, and with `sendfile` where the server supports it (e.g.
+    Gunicorn). Files of at least `[upload] drop_cache_above` MB are dropped
+    from the page cache once sent (see `helpers/pagecache.py`).
+
+    Args:
+        uploaded_file (UploadedFile): The file.
+        etag (Optional[str]): The strong ETag of the file, or None to derive
+            one from its path, size and modification time.
+
+    Returns:
+        flask.Response: A response object, answering conditional and range
+            requests.
+    """
+    file_path = Path(uploaded_file.file_path)
+    stream = pagecache.SequentialReader(file_path)
+    file_stat = os.fstat(stream.fileno())
+    drop_cache_above = flask.current_app.config["DROP_CACHE_ABOVE"]
+    stream.drop_cache = (
+        drop_cache_above is not None and file_stat.st_size >= drop_cache_above
+    )
+    if etag is None:
+        # As `send_file` derives it from a path
+        check = zlib.adler32(str(file_path).encode()) & 0xFFFFFFFF
+        etag = f"{file_stat.st_mtime}-{file_stat.st_size}-{check}"
+
+    # Sent as an open file, so `send_file` cannot stat it
+    response = flask.send_file(
+        stream,
+        as_attachment=True,
+        download_name=uploaded_file.file_name,
+        etag=etag,
+        last_modified=file_stat.st_mtime,
+        conditional=False,
+    )
+    response.content_length = file_stat.st_size
+    try:
+        return response.make_conditional(
+            flask.request, accept_ranges=True, complete_length=file_stat.st_size
+        )
+    except werkzeug_exceptions.RequestedRangeNotSatisfiable:
+        stream.close()
+        raise
+
+
+def send_remote_file(uploaded_file: UploadedFile) -> flask.Response:
+    """
+    Streams a file from a remote storage backend, or the single byte range
+    the request asks for.
+
+    Args:
+        uploaded_file (UploadedFile): The file to send.
+
+    Returns:
+        flask.Response: A response object.
+    """
+    backend = storage.get_backend(name=uploaded_file.storage)
+    key = str(uploaded_file.file_path)
+    file_size = backend.get_size(key)
+
+    start, stop = 0, file_size
+    byte_range = flask.request.range
+    if byte_range is not None:
+        range_for_length = byte_range.range_for_length(file_size)
+        if range_for_length is None:
+            response = flask.Response(status=416)
+            response.headers["Content-Range"] = f"bytes */{file_size}"
+            return response
+        start, stop = range_for_length
+
+    def generate():
+        if stop <= start:
+            return
+        stream = backend.open_range(key, start, stop - start)
+        try:
+            while True:
+                data = stream.read(multipart.READ_SIZE)
+                if not data:
+                    break
+                yield data
+        finally:
+            stream.close()
+
+    response = flask.Response(
+        generate(),
+        mimetype=mimetypes.guess_type(uploaded_file.file_name)[0]
+        or "application/octet-stream",
+    )
+    response.headers.set(
+        "Content-Disposition", "attachment", filename=uploaded_file.file_name
+    )
+    response.headers["Accept-Ranges"] = "bytes"
+    response.content_length = stop - start
+    if byte_range is not None:
+        response.status_code = 206
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{file_size}"
+
+    if uploaded_file.digest is not None:
+        _, digest_value = digest.parse_digest(uploaded_file.digest)
+        response.set_etag(digest_value)
+        response.headers[digest.HEADER_NAME] = digest.digest_header(
+            uploaded_file.digest
+        )
+        if byte_range is None:
+            response.make_conditional(flask.request)
+
+    return response
+
+
+def send_compressed_file(uploaded_file: UploadedFile) -> flask.Response:
+    """
+    Streams a file that is stored compressed, decompressing it on the way,
+    or the single byte range the request asks for.
+
+    A range is found by decompressing the file from its start, so a range
+    near the end of a large file costs about as much as the whole file.
+    Files stored before their original size was recorded are sent whole,
+    without a length.
+
+    Args:
+        uploaded_file (UploadedFile): The file to send.
+
+    Returns:
+        flask.Response: A response object.
+    """
+    file_size = uploaded_file.original_size
+
+    start, stop = 0, file_size
+    byte_range = flask.request.range if file_size is not None else None
+    if byte_range is not None:
+        range_for_length = byte_range.range_for_length(file_size)
+        if range_for_length is None:
+            response = flask.Response(status=416)
+            response.headers["Content-Range"] = f"bytes */{file_size}"
+            return response
+        start, stop = range_for_length
+
+    response = flask.Response(
+        compression.iter_decompressed(
+            uploaded_file.file_path,
+            uploaded_file.codec,  # type: ignore
+            start=start,
+            stop=stop,
+        ),
+        mimetype=mimetypes.guess_type(uploaded_file.file_name)[0]
+        or "application/octet-stream",
+    )
+    response.headers.set(
+        "Content-Disposition", "attachment", filename=uploaded_file.file_name
+    )
+    if file_size is not None:
+        response.headers["Accept-Ranges"] = "bytes"
+        response.content_length = stop - start  # type: ignore
+        if byte_range is not None:
+            response.status_code = 206
+            response.headers["Content-Range"] = (
+                f"bytes {start}-{stop - 1}/{file_size}"  # type: ignore
+            )
+
+    if uploaded_file.digest is not None:
+        _, digest_value = digest.parse_digest(uploaded_file.digest)
+        response.set_etag(digest_value)
+        if byte_range is None:
+            response.make_conditional(flask.request)
+
+    return response
+
+
 @upload_bp.route("/download/<uuid>", methods=["GET"])
 @flask_login.login_required
 def retrieve(uuid: str) -> flask.Response:
@@ -297,8 +1899,21 @@ def retrieve(uuid: str) -> flask.Response:
         flask.flash("Invalid file UUID", "error")
         return flask.redirect(flask.url_for("upload.history"))
 
-    return flask.send_file(
-        uploaded_file.file_path,
-        as_attachment=True,
-        download_name=uploaded_file.file_name,
-    )
+    if uploaded_file.storage != "local":
+        return send_remote_file(uploaded_file)
+
+    if uploaded_file.codec is not None:
+        # Stored compressed, decompress while sending
+        response = send_compressed_file(uploaded_file)
+        if uploaded_file.digest is None:
+            return response
+    elif uploaded_file.digest is None:
+        return send_local_file(uploaded_file)
+    else:
+        # The content digest doubles as a strong ETag, so clients can skip
+        # downloading files they already have
+        _, digest_value = digest.parse_digest(uploaded_file.digest)
+        response = send_local_file(uploaded_file, etag=digest_value)
+    response.headers[digest.HEADER_NAME] = digest.digest_header(uploaded_file.digest)
+
+    return response
@@ -0,0 +1,451 @@
+"""
+Finalizes uploads once all their chunks have been received.
+
+Depending on `[finalize] mode` in the config file, uploads are finalized:
+- 'inline': by the request that delivers the last chunk.
+- 'background': by worker threads started in each app process.
+- 'external': by a dedicated process (see `uploader/scripts/finalizer.py`).
+
+In the last two modes, the last chunk only queues a FinalizeJob, and the
+upload form polls the status endpoint until the job is done.
+
+Files of the data types listed in the `[compression]` section are compressed
+(see `helpers/compression.py`). With `[upload] dedupe` enabled, finalized
+files are then moved into the content-addressed store (see `models/blob.py`),
+and files whose content is already stored are dropped in favour of the
+existing blob.
+
+Uploads to a remote storage backend (see `uploader/storage`) are completed
+there, and stored as uploaded.
+"""
+
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from uploader import storage
+from uploader.helpers import assembly, cli, compression, digest, durability, pagecache
+from uploader.helpers.admission import ReservationLedger
+from uploader.helpers.config import config, get_settings
+from uploader.helpers.manifest import ChunkManifest
+from uploader.models.blob import Blob
+from uploader.models.finalize_job import FinalizeJob
+from uploader.models.uploaded_file import UploadedFile
+
+logger = logging.getLogger(__name__)
+
+
+def register_upload(
+    file_uuid: str,
+    file_name: str,
+    file_path: Path,
+    file_digest: str,
+    blobs_path: Optional[Path] = None,
+    codec: Optional[str] = None,
+    storage_backend: str = "local",
+    file_size: Optional[int] = None,
+    sync: bool = False,
+    config_file: Optional[Path] = None,
+) -> UploadedFile:
+    """
+    Registers a finalized file as an UploadedFile.
+
+    If `codec` is given, the file is compressed first, unless it looks
+    already compressed. If `blobs_path` is given, the file is stored in the
+    content-addressed store, and the UploadedFile points to its (possibly
+    shared) blob, keyed by a digest hashed from the stored file. Neither
+    applies to files in a remote storage backend.
+
+    Args:
+        file_uuid (str): The UUID of the file.
+        file_name (str): The (secure) name of the file.
+        file_path (Path): The path to the finalized file.
+        file_digest (str): The content digest of the file, as hashed while
+            it was uploaded.
+        blobs_path (Optional[Path]): The root of the content-addressed store,
+            or None to keep the file where it is.
+        codec (Optional[str]): The codec to compress the file with, or None.
+        storage_backend (str): The storage backend the file is in, with
+            `file_path` as its key.
+        file_size (Optional[int]): The size of the file, needed if it is not
+            on the local disk.
+        sync (bool): Whether to flush the stored file to stable storage
+            before registering it (see `helpers/durability.py`).
+        config_file (Optional[Path]): The path to the config file.
+
+    Returns:
+        UploadedFile: The registered file.
+    """
+    if storage_backend != "local":
+        uploaded_file = UploadedFile(
+            uuid=file_uuid,
+            file_name=file_name,
+            file_path=file_path,
+            digest=file_digest,
+            storage=storage_backend,
+            file_size=file_size,
+            original_size=file_size,
+        )
+        uploaded_file.save(config_file=config_file)
+        return uploaded_file
+
+    # Kept to serve the file with a length (and ranges) once it is compressed
+    original_size = file_path.stat().st_size
+
+    if blobs_path is not None:
+        # Blobs are shared by every file with the same digest, so it is
+        # hashed from the file itself rather than taken from the hashes
+        # computed while the upload streamed in
+        stored_digest = digest.hash_file(file_path, digest.get_algorithm(file_digest))
+        if stored_digest != file_digest:
+            logger.warning(
+                f"{file_uuid} has digest {stored_digest}, not {file_digest} "
+                "as hashed on upload"
+            )
+        file_digest = stored_digest
+
+    stored_path = file_path
+    used_codec = None
+    if codec is not None and not (
+        blobs_path is not None
+        and Blob.find_by_digest_query(digest=file_digest, config_file=config_file)
+    ):
+        used_codec = compression.maybe_compress(file_path, codec)
+        if used_codec is not None:
+            stored_path = compression.get_compressed_path(file_path, used_codec)
+
+    if sync:
+        # On stable storage before any row points at it
+        durability.sync_new_file(stored_path)
+
+    if blobs_path is None:
+        uploaded_file = UploadedFile(
+            uuid=file_uuid,
+            file_name=file_name,
+            file_path=stored_path,
+            digest=file_digest,
+            codec=used_codec,
+            original_size=original_size,
+        )
+        uploaded_file.save(config_file=config_file)
+    else:
+        blob = Blob.acquire(
+            digest=file_digest,
+            file_path=stored_path,
+            blobs_path=blobs_path,
+            codec=used_codec,
+            original_size=original_size,
+            sync=sync,
+            config_file=config_file,
+        )
+        if blob is None:
+            raise FileNotFoundError(f"Cannot store {stored_path} as a blob")
+        try:
+            uploaded_file = UploadedFile(
+                uuid=file_uuid,
+                file_name=file_name,
+                file_path=blob.blob_path,
+                digest=file_digest,
+                codec=blob.codec,
+                original_size=original_size,
+            )
+            uploaded_file.save(config_file=config_file)
+        except Exception:
+            blob.release(config_file=config_file)
+            raise
+
+        # The blob holds the data now (or already did, for a duplicate)
+        stored_path.unlink()
+
+    if stored_path != file_path:
+        file_path.unlink()
+
+    return uploaded_file
+
+
+def finalize_upload(
+    job_data: Dict[str, Any], config_file: Optional[Path] = None
+) -> None:
+    """
+    Assembles the uploaded file (if needed), registers it as an UploadedFile
+    and removes its chunk directory.
+
+    Safe to run more than once for the same upload, so that an interrupted
+    finalization can be retried.
+
+    Args:
+        job_data (Dict[str, Any]): Describes the upload. Has the keys
+            'file_uuid', 'file_name', 'file_path', 'save_dir', 'total_chunks',
+            'chunk_mode' and 'digest_algorithm', and optionally 'blobs_path'
+            if the upload is deduplicated, 'codec' if it is compressed,
+            'durability' if it is flushed to stable storage,
+            'drop_cache_above' if it is kept out of the page cache, and
+            'storage' and 'upload_handle' if it is stored remotely.
+        config_file (Optional[Path]): The path to the config file.
+    """
+    file_uuid = job_data["file_uuid"]
+    file_name = job_data["file_name"]
+    file_path = Path(job_data["file_path"])
+    save_dir = Path(job_data["save_dir"])
+    total_chunks = int(job_data["total_chunks"])
+    drop_cache_above = job_data.get("drop_cache_above")
+
+    if job_data.get("storage", "local") != "local":
+        finalize_remote_upload(job_data, config_file=config_file)
+        return None
+
+    if job_data["chunk_mode"] != "direct":
+        logger.debug(f"All chunks downloaded for {file_name}. Concatenating...")
+        chunk_files = [
+            save_dir / str(file_number) for file_number in range(total_chunks)
+        ]
+        if all(chunk_file.exists() for chunk_file in chunk_files):
+            assembly.assemble(
+                chunk_files, file_path, drop_cache_above=drop_cache_above
+            )
+        elif not file_path.exists():
+            raise FileNotFoundError(f"Missing chunks for {file_name} in {save_dir}")
+
+    registered = UploadedFile.find_by_uuid_query(uuid=file_uuid, config_file=config_file)
+    if registered is not None:
+        logger.warning(f"{file_name} ({file_uuid}) is already registered")
+        if registered.file_path != file_path and file_path.exists():
+            # Stored as a blob by an attempt that did not get to clean up
+            file_path.unlink()
+    else:
+        file_digest = digest.finalize_digest(
+            file_path=file_path,
+            leaves_path=save_dir / digest.LEAVES_NAME,
+            algorithm=job_data.get("digest_algorithm", "sha256"),
+        )
+        blobs_path = job_data.get("blobs_path")
+        uploaded_file = register_upload(
+            file_uuid=file_uuid,
+            file_name=file_name,
+            file_path=file_path,
+            file_digest=file_digest,
+            blobs_path=Path(blobs_path) if blobs_path else None,
+            codec=job_data.get("codec"),
+            sync=job_data.get("durability", "none") != "none",
+            config_file=config_file,
+        )
+        stored_path = Path(uploaded_file.file_path)
+        if (
+            drop_cache_above is not None
+            and stored_path.stat().st_size >= drop_cache_above
+        ):
+            # e.g. pages read back to hash blocks missing a hash
+            pagecache.drop_file(stored_path)
+    logger.info(f"{file_name} has been uploaded")
+
+    if save_dir.exists():
+        cli.remove_directory(save_dir)
+    ReservationLedger(save_dir.parent).release(file_uuid)
+
+    return None
+
+
+def finalize_remote_upload(
+    job_data: Dict[str, Any], config_file: Optional[Path] = None
+) -> None:
+    """
+    Completes an upload to a remote storage backend, whose parts were
+    written as they arrived, and registers it as an UploadedFile.
+
+    Args:
+        job_data (Dict[str, Any]): Describes the upload (see `finalize_upload`).
+        config_file (Optional[Path]): The path to the config file.
+    """
+    file_uuid = job_data["file_uuid"]
+    file_name = job_data["file_name"]
+    key = job_data["file_path"]
+    save_dir = Path(job_data["save_dir"])
+
+    backend = storage.get_backend(name=job_data["storage"], config_file=config_file)
+    backend.complete(key, job_data["upload_handle"], int(job_data["total_chunks"]))
+
+    registered = UploadedFile.find_by_uuid_query(uuid=file_uuid, config_file=config_file)
+    if registered is not None:
+        logger.warning(f"{file_name} ({file_uuid}) is already registered")
+    else:
+        file_size = backend.get_size(key)
+
+        def read_block(offset: int, size: int) -> bytes:
+            stream = backend.open_range(key, offset, size)
+            try:
+                return stream.read()
+            finally:
+                stream.close()
+
+        file_digest = digest.finalize_digest_with(
+            read_block=read_block,
+            file_size=file_size,
+            leaves_path=save_dir / digest.LEAVES_NAME,
+            algorithm=job_data.get("digest_algorithm", "sha256"),
+        )
+        register_upload(
+            file_uuid=file_uuid,
+            file_name=file_name,
+            file_path=Path(key),
+            file_digest=file_digest,
+            storage_backend=backend.name,
+            file_size=file_size,
+            config_file=config_file,
+        )
+    logger.info(f"{file_name} has been uploaded to {backend}")
+
+    if save_dir.exists():
+        cli.remove_directory(save_dir)
+    ReservationLedger(save_dir.parent).release(file_uuid)
+
+    return None
+
+
+def process_job(
+    job: FinalizeJob, max_attempts: int, config_file: Optional[Path] = None
+) -> None:
+    """
+    Runs a claimed FinalizeJob, and records its outcome.
+
+    Args:
+        job (FinalizeJob): The claimed job.
+        max_attempts (int): The number of attempts before the job is failed.
+        config_file (Optional[Path]): The path to the config file.
+    """
+    logger.debug(f"Finalizing {job.dz_uuid} (attempt {job.attempts})")
+    try:
+        finalize_upload(job.job_data, config_file=config_file)
+    except Exception as e:  # pylint: disable=broad-except
+        retry = job.attempts < max_attempts
+        logger.error(f"Failed to finalize {job.dz_uuid}: {e} (retry: {retry})")
+        job.mark_failed(error=str(e), retry=retry, config_file=config_file)
+        if not retry:
+            # Let a re-sent chunk claim (and queue) the upload again
+            ChunkManifest(Path(job.job_data["save_dir"])).release_claim()
+        return None
+
+    job.mark_done(config_file=config_file)
+
+    return None
+
+
+class FinalizeWorker:
+    """
+    Pool of threads that claim and run queued FinalizeJobs.
+
+    The number of threads bounds how many uploads this process assembles at
+    once, so many uploads finishing together do not saturate the disk.
+
+    Attributes:
+        config_file (Path): The path to the config file.
+        workers (int): The number of worker threads.
+        poll_interval_s (float): Seconds to wait when the queue is empty.
+        stale_after_s (int): Seconds after which a running job is claimed again.
+        max_attempts (int): The number of attempts before a job is failed.
+    """
+
+    def __init__(
+        self,
+        config_file: Path,
+        workers: int = 1,
+        poll_interval_s: float = 2.0,
+        stale_after_s: int = 3600,
+        max_attempts: int = 3,
+    ):
+        self.config_file = config_file
+        self.workers = workers
+        self.poll_interval_s = poll_interval_s
+        self.stale_after_s = stale_after_s
+        self.max_attempts = max_attempts
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def __repr__(self) -> str:
+        return f"<FinalizeWorker workers={self.workers}>"
+
+    @staticmethod
+    def from_config(config_file: Path) -> "FinalizeWorker":
+        """
+        Creates a FinalizeWorker from the `[finalize]` section of the config file.
+
+        Args:
+            config_file (Path): The path to the config file.
+
+        Returns:
+            FinalizeWorker: The worker.
+        """
+        try:
+            params = config(path=config_file, section="finalize")
+        except ValueError:
+            params = {}
+
+        return FinalizeWorker(
+            config_file=config_file,
+            workers=int(params.get("workers", 1)),
+            poll_interval_s=float(params.get("poll_interval", 2.0)),
+            stale_after_s=int(params.get("stale_after", 3600)),
+            max_attempts=int(params.get("max_attempts", 3)),
+        )
+
+    def run_once(self) -> bool:
+        """
+        Claims and runs a single job.
+
+        Returns:
+            bool: True if a job was run, False if the queue was empty.
+        """
+        job = FinalizeJob.claim_next(
+            stale_after_s=self.stale_after_s, config_file=self.config_file
+        )
+        if job is None:
+            return False
+
+        process_job(job, max_attempts=self.max_attempts, config_file=self.config_file)
+
+        return True
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                ran = self.run_once()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error(f"Finalize worker error: {e}")
+                ran = False
+            if not ran:
+                self._stop.wait(self.poll_interval_s)
+
+    def start(self) -> None:
+        """
+        Starts the worker threads in the background.
+        """
+        for index in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, name=f"finalize-worker-{index}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+        logger.info(f"Started {self.workers} finalize worker(s)")
+
+    def run_forever(self) -> None:
+        """
+        Runs the worker threads until `stop` is called (or interrupted).
+        """
+        self.start()
+        try:
+            while not self._stop.is_set():
+                self._stop.wait(1)
+                # Reloads the settings if the file changed, or on SIGHUP
+                get_settings(self.config_file)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def stop(self) -> None:
+        """
+        Asks the worker threads to stop once their current job is done.
+        """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
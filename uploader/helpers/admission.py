@@ -0,0 +1,296 @@
+"""
+Disk space admission control for uploads.
+
+Before an upload is accepted, the space it will need is checked against the
+free space of the chunk path and the storage path, minus the space already
+reserved by uploads in flight. Accepted uploads keep a reservation in a
+small ledger (`chunk_path/.reservations`) until they are finalized, deleted
+or idle for longer than the reservation TTL.
+
+Every update takes an exclusive `flock` on the ledger, so reservations are
+shared by all worker processes on the host.
+"""
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+LEDGER_NAME = ".reservations"
+
+
+class InsufficientStorage(Exception):
+    """
+    Raised when there is not enough free space to accept an upload.
+
+    Attributes:
+        path (Path): The path that is short of space.
+        required (int): The bytes the upload needs on its filesystem.
+        available (int): The bytes free and not reserved there.
+    """
+
+    def __init__(self, path: Path, required: int, available: int):
+        super().__init__(
+            f"Not enough free space for this upload: it needs "
+            f"{required / (1024 * 1024):.1f} MB, "
+            f"{max(available, 0) / (1024 * 1024):.1f} MB available"
+        )
+        self.path = path
+        self.required = required
+        self.available = available
+
+
+def get_required_space(
+    total_size: int,
+    chunk_path: Path,
+    storage_path: Optional[Path],
+    chunk_mode: str,
+    file_path: Optional[Path] = None,
+) -> List[Tuple[Path, int, Optional[Path]]]:
+    """
+    Returns where an upload needs space, and how much.
+
+    Args:
+        total_size (int): The size of the file in bytes.
+        chunk_path (Path): The path uploaded chunks are stored in.
+        storage_path (Optional[Path]): The path the file is stored in, or
+            None if it is not stored on the local disk.
+        chunk_mode (str): 'chunked' or 'direct' (see `get_chunk_mode`).
+        file_path (Optional[Path]): The path to the file, if known.
+
+    Returns:
+        List[Tuple[Path, int, Optional[Path]]]: The path, bytes needed and
+            the file the bytes are allocated to (if any) on each filesystem.
+    """
+    required: List[Tuple[Path, int, Optional[Path]]] = []
+    if chunk_mode != "direct":
+        # Chunks are kept until they are concatenated into the final file
+        required.append((chunk_path, total_size, None))
+    if storage_path is not None:
+        required.append((storage_path, total_size, file_path))
+
+    return required
+
+
+def get_free_space(path: Path) -> int:
+    """
+    Returns the bytes available to unprivileged users on a filesystem.
+
+    Args:
+        path (Path): A path on the filesystem.
+
+    Returns:
+        int: The free space in bytes.
+    """
+    stat = os.statvfs(path)
+
+    return stat.f_bavail * stat.f_frsize
+
+
+def _get_allocated(file_path: Optional[str]) -> int:
+    if file_path is None:
+        return 0
+    try:
+        return os.stat(file_path).st_blocks * 512
+    except FileNotFoundError:
+        return 0
+
+
+class ReservationLedger:
+    """
+    Space reserved by the uploads in flight.
+
+    Attributes:
+        path (Path): The path to the ledger file.
+        min_free (int): Bytes to always leave free on each filesystem.
+        ttl_s (int): Seconds without activity after which a reservation
+            expires.
+    """
+
+    def __init__(self, chunk_path: Path, min_free: int = 0, ttl_s: int = 60 * 60):
+        self.path = chunk_path / LEDGER_NAME
+        self.min_free = min_free
+        self.ttl_s = ttl_s
+
+    def __repr__(self) -> str:
+        return f"<ReservationLedger {self.path}>"
+
+    def __str__(self) -> str:
+        return self.__repr__()
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[Dict[str, Any]]:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = b""
+            while True:
+                block = os.read(fd, 64 * 1024)
+                if not block:
+                    break
+                data += block
+            try:
+                reservations = json.loads(data) if data else {}
+            except ValueError:
+                logger.warning(f"Corrupt reservation ledger {self.path}, resetting")
+                reservations = {}
+            before = dict(reservations)
+
+            yield reservations
+
+            if reservations != before:
+                encoded = json.dumps(reservations).encode("utf-8")
+                os.pwrite(fd, encoded, 0)
+                os.ftruncate(fd, len(encoded))
+        finally:
+            # Closing the descriptor releases the lock
+            os.close(fd)
+
+    @staticmethod
+    def _prune(reservations: Dict[str, Any], now: float) -> None:
+        for upload_id in [
+            upload_id
+            for upload_id, reservation in reservations.items()
+            if reservation["expires_at"] < now
+        ]:
+            logger.info(f"Reservation of {upload_id} expired")
+            del reservations[upload_id]
+
+    @staticmethod
+    def _get_reserved(reservations: Dict[str, Any]) -> Dict[int, int]:
+        # Space allocated to a file already shows in the free space, e.g. a
+        # preallocated file in the 'direct' chunk mode
+        reserved: Dict[int, int] = {}
+        for reservation in reservations.values():
+            for device, size, file_path in reservation["required"]:
+                outstanding = max(size - _get_allocated(file_path), 0)
+                reserved[device] = reserved.get(device, 0) + outstanding
+
+        return reserved
+
+    def _check(
+        self,
+        reservations: Dict[str, Any],
+        required: List[Tuple[Path, int, Optional[Path]]],
+        now: float,
+    ) -> List[Tuple[int, int, Optional[str]]]:
+        self._prune(reservations, now)
+        reserved = self._get_reserved(reservations)
+
+        needed: Dict[int, Tuple[Path, int]] = {}
+        entries: List[Tuple[int, int, Optional[str]]] = []
+        for path, size, file_path in required:
+            device = os.stat(path).st_dev
+            allocated_to = str(file_path) if file_path else None
+            outstanding = max(size - _get_allocated(allocated_to), 0)
+            needed_path, needed_size = needed.get(device, (path, 0))
+            needed[device] = (needed_path, needed_size + outstanding)
+            entries.append((device, size, allocated_to))
+
+        for device, (path, size) in needed.items():
+            available = get_free_space(path) - reserved.get(device, 0) - self.min_free
+            if size > available:
+                raise InsufficientStorage(path, size, available)
+
+        return entries
+
+    def check(
+        self,
+        upload_id: Optional[str],
+        required: List[Tuple[Path, int, Optional[Path]]],
+    ) -> None:
+        """
+        Checks that an upload would be admitted, without reserving space.
+        Uploads that already have a reservation always are.
+
+        Args:
+            upload_id (Optional[str]): The ID of the upload, if known.
+            required (List[Tuple[Path, int, Optional[Path]]]): Where the upload
+                needs space (see `get_required_space`).
+
+        Raises:
+            InsufficientStorage: If any filesystem lacks the space.
+        """
+        with self._locked() as reservations:
+            if upload_id is not None and upload_id in reservations:
+                return None
+            self._check(reservations, required, time.time())
+
+        return None
+
+    def admit(
+        self, upload_id: str, required: List[Tuple[Path, int, Optional[Path]]]
+    ) -> None:
+        """
+        Reserves space for an upload, or renews its reservation if it
+        already has one.
+
+        Args:
+            upload_id (str): The ID of the upload (its UUID).
+            required (List[Tuple[Path, int, Optional[Path]]]): Where the upload
+                needs space (see `get_required_space`).
+
+        Raises:
+            InsufficientStorage: If any filesystem lacks the space.
+        """
+        now = time.time()
+        with self._locked() as reservations:
+            reservation = reservations.get(upload_id)
+            if reservation is not None:
+                # Renewed once half of its TTL has passed, to spare writes
+                if reservation["expires_at"] - now < self.ttl_s / 2:
+                    reservations[upload_id] = {
+                        **reservation,
+                        "expires_at": now + self.ttl_s,
+                    }
+                return None
+
+            entries = self._check(reservations, required, now)
+            reservations[upload_id] = {
+                "expires_at": now + self.ttl_s,
+                "required": entries,
+            }
+            logger.debug(f"Reserved space for {upload_id}: {entries}")
+
+        return None
+
+    def release(self, upload_id: str) -> bool:
+        """
+        Releases the reservation of an upload.
+
+        Args:
+            upload_id (str): The ID of the upload.
+
+        Returns:
+            bool: True if the upload had a reservation.
+        """
+        if not self.path.exists():
+            return False
+
+        with self._locked() as reservations:
+            released = reservations.pop(upload_id, None) is not None
+
+        if released:
+            logger.debug(f"Released the reservation of {upload_id}")
+
+        return released
+
+    def usage(self) -> Dict[str, int]:
+        """
+        Returns the reservations currently held.
+
+        Returns:
+            Dict[str, int]: The number of 'uploads' with a reservation and the
+                total 'reserved_bytes' still to be written.
+        """
+        with self._locked() as reservations:
+            self._prune(reservations, time.time())
+            reserved = self._get_reserved(reservations)
+
+        return {"uploads": len(reservations), "reserved_bytes": sum(reserved.values())}
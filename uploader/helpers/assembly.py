@@ -0,0 +1,187 @@
+"""
+Assembles uploaded chunk files into the final file.
+
+Strategies are tried from cheapest to most expensive:
+- 'rename': a single chunk is moved into place.
+- 'reflink': chunks are cloned into the final file (Btrfs, XFS, ...), sharing
+    their blocks instead of copying them.
+- 'copy_file_range' / 'sendfile': the kernel copies the data, without it
+    passing through Python.
+- 'buffered': the data is copied through a userspace buffer.
+
+Each strategy falls back to the next one when the platform or filesystem
+does not support it. Final files of at least `drop_cache_above` bytes are
+written back and dropped from the page cache as they are assembled (see
+`helpers/pagecache.py`).
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import struct
+from pathlib import Path
+from typing import List, Optional
+
+from uploader.helpers import pagecache
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = 1024 * 1024  # 1 MB
+
+STRATEGIES = ["reflink", "copy_file_range", "sendfile", "buffered"]
+
+# Linux FICLONERANGE ioctl, see ioctl_ficlonerange(2)
+_FICLONERANGE = 0x4020940D
+_FILE_CLONE_RANGE = struct.Struct("=qQQQ")  # src_fd, src_offset, src_length, dest_offset
+
+# Errors meaning "not supported here", after which the next strategy is tried
+_UNSUPPORTED_ERRNOS = {
+    errno.EBADF,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EPERM,
+    errno.EXDEV,
+}
+
+
+def _reflink(src_fd: int, dest_fd: int, offset: int, length: int) -> None:
+    fcntl.ioctl(
+        dest_fd, _FICLONERANGE, _FILE_CLONE_RANGE.pack(src_fd, 0, length, offset)
+    )
+
+
+def _copy_file_range(src_fd: int, dest_fd: int, offset: int, length: int) -> None:
+    copied = 0
+    while copied < length:
+        count = os.copy_file_range(  # type: ignore[attr-defined]
+            src_fd, dest_fd, length - copied, copied, offset + copied
+        )
+        if count == 0:
+            raise OSError(errno.EIO, "Unexpected end of chunk file")
+        copied += count
+
+
+def _sendfile(src_fd: int, dest_fd: int, offset: int, length: int) -> None:
+    os.lseek(dest_fd, offset, os.SEEK_SET)
+    copied = 0
+    while copied < length:
+        count = os.sendfile(dest_fd, src_fd, copied, length - copied)
+        if count == 0:
+            raise OSError(errno.EIO, "Unexpected end of chunk file")
+        copied += count
+
+
+def _buffered(src_fd: int, dest_fd: int, offset: int, length: int) -> None:
+    copied = 0
+    while copied < length:
+        data = os.pread(src_fd, min(BUFFER_SIZE, length - copied), copied)
+        if not data:
+            raise OSError(errno.EIO, "Unexpected end of chunk file")
+        view = memoryview(data)
+        while view:
+            count = os.pwrite(dest_fd, view, offset + copied)
+            copied += count
+            view = view[count:]
+
+
+_COPY_FUNCTIONS = {
+    "reflink": _reflink,
+    "copy_file_range": _copy_file_range,
+    "sendfile": _sendfile,
+    "buffered": _buffered,
+}
+
+
+def _available_strategies() -> List[str]:
+    strategies = []
+    for strategy in STRATEGIES:
+        if strategy == "reflink" and os.uname().sysname != "Linux":
+            continue
+        if strategy == "copy_file_range" and not hasattr(os, "copy_file_range"):
+            continue
+        if strategy == "sendfile" and not hasattr(os, "sendfile"):
+            continue
+        strategies.append(strategy)
+
+    return strategies
+
+
+def assemble(
+    chunk_files: List[Path], file_path: Path, drop_cache_above: Optional[int] = None
+) -> str:
+    """
+    Concatenates chunk files, in order, into a new file.
+
+    The chunk files are left in place, except when a single chunk is renamed
+    into place.
+
+    Args:
+        chunk_files (List[Path]): The chunk files, in order.
+        file_path (Path): The path to the final file.
+        drop_cache_above (Optional[int]): The size from which the final file
+            is kept out of the page cache, or None.
+
+    Returns:
+        str: The (last) strategy used.
+    """
+    if len(chunk_files) == 1:
+        try:
+            os.rename(chunk_files[0], file_path)
+            return "rename"
+        except OSError as e:
+            # e.g. the chunk and storage paths are on different filesystems
+            logger.debug(f"Cannot rename {chunk_files[0]} to {file_path}: {e}")
+
+    strategies = _available_strategies()
+    strategy_index = 0
+
+    drop_cache = drop_cache_above is not None and (
+        sum(chunk_file.stat().st_size for chunk_file in chunk_files)
+        >= drop_cache_above
+    )
+
+    dest_fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    window = pagecache.WritebackWindow(dest_fd, 0) if drop_cache else None
+    try:
+        offset = 0
+        for chunk_file in chunk_files:
+            src_fd = os.open(chunk_file, os.O_RDONLY)
+            try:
+                length = os.fstat(src_fd).st_size
+                if hasattr(os, "POSIX_FADV_SEQUENTIAL"):
+                    pagecache.advise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                while length:
+                    strategy = strategies[strategy_index]
+                    try:
+                        _COPY_FUNCTIONS[strategy](src_fd, dest_fd, offset, length)
+                        break
+                    except OSError as e:
+                        if (
+                            e.errno not in _UNSUPPORTED_ERRNOS
+                            or strategy_index == len(strategies) - 1
+                        ):
+                            raise
+                        logger.debug(f"Assembly with {strategy} not supported: {e}")
+                        strategy_index += 1
+            finally:
+                os.close(src_fd)
+            offset += length
+            if window is not None:
+                window.advance(offset)
+
+        # Copies past a hole (or a failed clone) may leave the size short
+        if os.fstat(dest_fd).st_size != offset:
+            os.ftruncate(dest_fd, offset)
+        if window is not None:
+            window.close(offset)
+    finally:
+        os.close(dest_fd)
+
+    strategy = strategies[strategy_index]
+    logger.debug(f"Assembled {len(chunk_files)} chunks into {file_path} ({strategy})")
+
+    return strategy
+
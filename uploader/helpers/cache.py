@@ -0,0 +1,514 @@
+"""
+Read-through caches of the models' lookups, per process (see
+`read_through`), so that e.g. the user of each request, chunk uploads
+included, is not looked up in the database every time.
+
+Each cache keeps the rows it was given for up to `[cache] ttl` seconds, and
+at most `[cache] max_entries` of them, evicting the least recently used.
+Lookups that find nothing are not cached. Writes through the models
+invalidate the keys they change:
+- in the process that made them, once committed.
+- in the other processes (e.g. the other Gunicorn workers), with
+    `[cache] invalidation = notify`: the write sends a PostgreSQL `NOTIFY` in
+    its transaction, delivered once it commits to a thread in each process
+    that `LISTEN`s for them (see `InvalidationListener`). Until that thread
+    listens, and while it reconnects, nothing is cached.
+
+With `invalidation = local` (e.g. behind a PgBouncer pooling transactions,
+which does not keep a session's `LISTEN`), the other processes see a change
+once their entries expire. Changes made to the database by hand are seen
+once the entries expire, either way.
+"""
+
+import functools
+import json
+import logging
+import os
+import select
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from uploader.helpers import db, statements
+from uploader.helpers.config import Settings, config, on_reload
+from uploader.helpers.statements import Statement
+
+logger = logging.getLogger(__name__)
+
+# The channel invalidations are sent on
+CHANNEL = "uploader_cache"
+# Seconds the listener waits for a notification before checking its connection
+LISTEN_TIMEOUT_S = 30.0
+# Bytes of keys sent per notification, below PostgreSQL's limit of 8000
+MAX_PAYLOAD_SIZE = 7000
+
+NOTIFY = statements.register("cache_notify", "SELECT pg_notify($1, $2)")
+
+_caches: Dict[Tuple[Path, str], "TTLCache"] = {}
+_options: Dict[Path, Dict[str, Any]] = {}
+_listeners: Dict[Path, "InvalidationListener"] = {}
+_lock = threading.Lock()
+
+
+class TTLCache:
+    """
+    A cache of up to `max_entries` values, each kept for `ttl_s` seconds,
+    evicting the least recently used first. Safe to use from several threads.
+
+    Attributes:
+        name (str): The name of the cache, e.g. 'users'.
+        max_entries (int): The number of values kept at most.
+        ttl_s (float): The seconds a value is kept for.
+        hits (int): The lookups answered from the cache.
+        misses (int): The lookups that were not.
+        evictions (int): The values evicted to make room for others.
+        expirations (int): The values found expired.
+        invalidations (int): The values invalidated.
+    """
+
+    def __init__(self, name: str, max_entries: int, ttl_s: float):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"<TTLCache {self.name} ({len(self._entries)} entries)>"
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def generation(self) -> int:
+        """
+        A counter increased by each invalidation, to be read before loading
+        a value and given to `put`, so that a value loaded before it was
+        invalidated is not cached.
+        """
+        return self._generation
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Returns the value of a key, or None if it is not cached (or expired).
+
+        Args:
+            key (str): The key.
+
+        Returns:
+            Optional[Any]: The value.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        return value
+
+    def put(self, key: str, value: Any, generation: int) -> bool:
+        """
+        Caches the value of a key, unless the cache was invalidated since
+        the value was loaded.
+
+        Args:
+            key (str): The key.
+            value (Any): The value, not None.
+            generation (int): The `generation` of the cache read before the
+                value was loaded.
+
+        Returns:
+            bool: Whether the value was cached.
+        """
+        with self._lock:
+            if generation != self._generation:
+                return False
+            self._entries[key] = (time.monotonic() + self.ttl_s, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+        return True
+
+    def invalidate(self, key: str) -> None:
+        """
+        Drops the value of a key, if cached.
+
+        Args:
+            key (str): The key.
+        """
+        with self._lock:
+            self._generation += 1
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+        return None
+
+    def clear(self) -> None:
+        """
+        Drops all the values.
+        """
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+        return None
+
+
+class InvalidationListener:
+    """
+    Listens for the invalidations sent by other processes, on a connection
+    of its own, and applies them to the caches of this process.
+
+    Attributes:
+        config_file (Path): The path to the config file of the database.
+        listening (bool): Whether invalidations are being received, so
+            that the caches can be used.
+    """
+
+    def __init__(self, config_file: Path):
+        self.config_file = config_file
+        self.listening = False
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __repr__(self) -> str:
+        return f"<InvalidationListener {self.config_file}>"
+
+    def _listen(self) -> None:
+        connection = db.get_engine(config_file=self.config_file).raw_connection()
+        # Kept out of the pool, which opens another in its place
+        connection.detach()
+        dbapi_connection: Any = connection.dbapi_connection
+        try:
+            dbapi_connection.rollback()
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL}")
+            # Changes made while not listening were missed
+            clear(config_file=self.config_file)
+            self.listening = True
+            logger.debug(f"Listening for cache invalidations on {CHANNEL}")
+
+            while not self._stop_event.is_set():
+                readable, _, _ = select.select(
+                    [dbapi_connection], [], [], LISTEN_TIMEOUT_S
+                )
+                if not readable:
+                    # Fails if the connection was lost
+                    with dbapi_connection.cursor() as cursor:
+                        cursor.execute("SELECT 1")
+                dbapi_connection.poll()
+                notifies = dbapi_connection.notifies
+                while notifies:
+                    self._apply(notifies.pop(0).payload)
+        finally:
+            self.listening = False
+            connection.close()
+
+    def _apply(self, payload: str) -> None:
+        try:
+            name, keys = json.loads(payload)
+        except (TypeError, ValueError):
+            logger.warning(f"Ignoring cache invalidation: {payload}")
+            return
+        invalidate(name=name, keys=keys, config_file=self.config_file)
+
+    def _run(self) -> None:
+        backoff_s = 1.0
+        while not self._stop_event.is_set():
+            started_at = time.monotonic()
+            try:
+                self._listen()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.warning(f"Stopped listening for cache invalidations: {e}")
+            clear(config_file=self.config_file)
+            if time.monotonic() - started_at > LISTEN_TIMEOUT_S:
+                backoff_s = 1.0
+            self._stop_event.wait(backoff_s)
+            backoff_s = min(backoff_s * 2, LISTEN_TIMEOUT_S)
+
+    def start(self) -> None:
+        """
+        Starts listening, in a daemon thread.
+        """
+        self._thread = threading.Thread(
+            target=self._run, name="cache-invalidations", daemon=True
+        )
+        self._thread.start()
+
+        return None
+
+    def stop(self) -> None:
+        """
+        Stops listening, once the current wait is over.
+        """
+        self._stop_event.set()
+
+        return None
+
+
+def _reset_after_fork() -> None:
+    # The listener thread is not running in the child, and the lock may have
+    # been held by another thread of the parent
+    global _lock  # pylint: disable=global-statement
+    _lock = threading.Lock()
+    _listeners.clear()
+    _caches.clear()
+    _options.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_key(config_file: Path) -> Path:
+    return Path(config_file).resolve()
+
+
+def get_cache_options(config_file: Path) -> Dict[str, Any]:
+    """
+    Returns the options of the caches, from the `[cache]` section of the
+    config file.
+
+    Args:
+        config_file (Path): The path to the config file.
+
+    Returns:
+        Dict[str, Any]: The seconds values are kept for ('ttl_s', 0 to not
+            cache), the values kept at most by each cache ('max_entries'),
+            and how other processes are told of writes ('invalidation').
+
+    Raises:
+        ValueError: If the invalidation mode is not supported.
+    """
+    try:
+        params = config(path=config_file, section="cache")
+    except ValueError:
+        params = {}
+
+    invalidation = params.get("invalidation", "notify")
+    if invalidation not in ("notify", "local"):
+        raise ValueError(f"Unsupported cache invalidation: {invalidation}")
+
+    return {
+        "ttl_s": float(params.get("ttl", 30)),
+        "max_entries": int(params.get("max_entries", 1024)),
+        "invalidation": invalidation,
+    }
+
+
+def _on_settings_reload(settings: Settings) -> None:
+    key = _get_key(settings.path)
+    if key not in _options or _options[key] == get_cache_options(settings.path):
+        return
+
+    with _lock:
+        for cache_key in [cache_key for cache_key in _caches if cache_key[0] == key]:
+            del _caches[cache_key]
+        _options.pop(key, None)
+        listener = _listeners.pop(key, None)
+    if listener is not None:
+        listener.stop()
+    logger.info(f"Cache settings changed in {settings.path}, emptied the caches")
+
+
+on_reload(_on_settings_reload)
+
+
+def get_cache(name: str, config_file: Path) -> Optional[TTLCache]:
+    """
+    Returns a cache of this process, created on first use, if the caches
+    can be used: enabled, and listening for invalidations if they are sent.
+
+    Args:
+        name (str): The name of the cache, e.g. 'users'.
+        config_file (Path): The path to the config file.
+
+    Returns:
+        Optional[TTLCache]: The cache, or None.
+    """
+    key = _get_key(config_file)
+    cache = _caches.get((key, name))
+    if cache is None:
+        with _lock:
+            options = _options.get(key)
+            if options is None:
+                options = get_cache_options(config_file=key)
+                _options[key] = options
+            cache = _caches.get((key, name))
+            if cache is None:
+                cache = TTLCache(
+                    name=name,
+                    max_entries=options["max_entries"],
+                    ttl_s=options["ttl_s"],
+                )
+                _caches[(key, name)] = cache
+            listens = cache.ttl_s > 0 and options["invalidation"] == "notify"
+            if listens and key not in _listeners:
+                _listeners[key] = InvalidationListener(config_file=key)
+                _listeners[key].start()
+
+    if cache.ttl_s <= 0 or cache.max_entries <= 0:
+        return None
+    listener = _listeners.get(key)
+    if listener is not None and not listener.listening:
+        return None
+
+    return cache
+
+
+def read_through(
+    name: str, key: str, load: Callable[[], Optional[Any]], config_file: Path
+) -> Optional[Any]:
+    """
+    Returns a value from a cache, loaded (and cached) if it is not there.
+
+    Args:
+        name (str): The name of the cache, e.g. 'users'.
+        key (str): The key of the value, e.g. an email.
+        load (Callable[[], Optional[Any]]): Loads the value, None if there
+            is none (which is not cached).
+        config_file (Path): The path to the config file.
+
+    Returns:
+        Optional[Any]: The value.
+    """
+    cache = get_cache(name=name, config_file=config_file)
+    if cache is None:
+        return load()
+
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    generation = cache.generation
+    value = load()
+    if value is not None:
+        cache.put(key, value, generation=generation)
+
+    return value
+
+
+def invalidate(name: str, keys: Iterable[str], config_file: Path) -> None:
+    """
+    Drops keys from a cache of this process. See `invalidation_calls` for
+    the other processes.
+
+    Args:
+        name (str): The name of the cache.
+        keys (Iterable[str]): The keys.
+        config_file (Path): The path to the config file.
+    """
+    cache = _caches.get((_get_key(config_file), name))
+    if cache is None:
+        return None
+
+    for key in keys:
+        cache.invalidate(key)
+
+    return None
+
+
+def clear(config_file: Path) -> None:
+    """
+    Drops all the values from the caches of this process.
+
+    Args:
+        config_file (Path): The path to the config file.
+    """
+    key = _get_key(config_file)
+    for (cache_key, _), cache in list(_caches.items()):
+        if cache_key == key:
+            cache.clear()
+
+    return None
+
+
+def invalidation_calls(
+    name: str, keys: Sequence[str], config_file: Path
+) -> List[Tuple[Statement, Sequence[Any]]]:
+    """
+    Returns the statements that tell the other processes to drop keys from
+    a cache, to be executed in the transaction of the write that changes
+    them (see `db.execute_statements`), so they are sent once it commits.
+
+    Args:
+        name (str): The name of the cache.
+        keys (Sequence[str]): The keys.
+        config_file (Path): The path to the config file.
+
+    Returns:
+        List[Tuple[Statement, Sequence[Any]]]: The statements, none with
+            `[cache] invalidation = local`.
+    """
+    options = get_cache_options(config_file=config_file)
+    if options["invalidation"] != "notify" or not keys:
+        return []
+
+    calls: List[Tuple[Statement, Sequence[Any]]] = []
+    batch: List[str] = []
+    size = 0
+    for key in keys:
+        key_size = len(json.dumps(key)) + 2
+        if batch and size + key_size > MAX_PAYLOAD_SIZE:
+            calls.append((NOTIFY, (CHANNEL, json.dumps([name, batch]))))
+            batch, size = [], 0
+        batch.append(key)
+        size += key_size
+    calls.append((NOTIFY, (CHANNEL, json.dumps([name, batch]))))
+
+    return calls
+
+
+def get_cache_stats() -> List[Dict[str, Any]]:
+    """
+    Returns the state of the caches of this process.
+
+    Returns:
+        List[Dict[str, Any]]: For each cache, its 'name', the number of
+            values it holds ('entries'), its options, whether it is
+            'listening' for invalidations (None if they are not sent), and
+            the counters of `TTLCache`.
+    """
+    caches = []
+    for (key, name), cache in list(_caches.items()):
+        listener = _listeners.get(key)
+        lookups = cache.hits + cache.misses
+        caches.append(
+            {
+                "name": name,
+                "pid": os.getpid(),
+                "entries": len(cache),
+                "max_entries": cache.max_entries,
+                "ttl_s": cache.ttl_s,
+                "listening": None if listener is None else listener.listening,
+                "hits": cache.hits,
+                "misses": cache.misses,
+                "hit_ratio": round(cache.hits / lookups, 4) if lookups else None,
+                "evictions": cache.evictions,
+                "expirations": cache.expirations,
+                "invalidations": cache.invalidations,
+            }
+        )
+
+    return caches
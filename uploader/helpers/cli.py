@@ -2,6 +2,7 @@
 Module providing command line interface for the app.
 """
 
+import functools
 import logging
 import shutil
 import subprocess
@@ -10,11 +11,13 @@ from pathlib import Path
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=None)
 def get_repo_root() -> str:
     """
     Returns the root directory of the current Git repository.
 
-    Uses the command `git rev-parse --show-toplevel` to get the root directory.
+    Uses the command `git rev-parse --show-toplevel` to get the root directory,
+    once per process (workers forked by `uploader serve` inherit it).
     """
     repo_root = subprocess.check_output(["git", "rev-parse", "--show-toplevel"])
     repo_root = repo_root.decode("utf-8").strip()
@@ -35,11 +38,12 @@ def remove_directory(directory: Path) -> None:
     shutil.rmtree(directory)
 
 
+@functools.lru_cache(maxsize=None)
 def get_hostname() -> str:
     """
     Returns the hostname of the system.
 
-    Uses the command `hostname` to get the hostname.
+    Uses the command `hostname` to get the hostname, once per process.
     """
     hostname = subprocess.check_output(["hostname"])
     hostname = hostname.decode("utf-8").strip()
@@ -0,0 +1,273 @@
+"""
+Compression of uploaded files at rest.
+
+Files are compressed once they are finalized, with the codec configured for
+their data type in the `[compression]` section of the config file. Formats
+that are already compressed (video, images, archives, ...) are detected by
+their extension, their magic bytes or a trial compression of a sample, and
+are stored as they are.
+
+The 'zstd' codec needs the optional `zstandard` package; without it, 'gzip'
+is used instead.
+"""
+
+import gzip
+import logging
+import os
+import shutil
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = 1024 * 1024  # 1 MB
+
+CODECS = ["gzip", "zstd"]
+EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Compress only if a sample shrinks below this ratio
+MAX_SAMPLE_RATIO = 0.9
+SAMPLE_SIZE = 256 * 1024  # 256 KB
+
+COMPRESSED_EXTENSIONS = {
+    ".7z",
+    ".aac",
+    ".avi",
+    ".bz2",
+    ".flac",
+    ".gif",
+    ".gz",
+    ".heic",
+    ".jpeg",
+    ".jpg",
+    ".m4a",
+    ".mkv",
+    ".mov",
+    ".mp3",
+    ".mp4",
+    ".ogg",
+    ".png",
+    ".rar",
+    ".tgz",
+    ".webm",
+    ".webp",
+    ".xz",
+    ".zip",
+    ".zst",
+}
+
+COMPRESSED_MAGIC = [
+    b"\x1f\x8b",  # gzip
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"PK\x03\x04",  # zip, docx, ...
+    b"BZh",  # bzip2
+    b"\xfd7zXZ\x00",  # xz
+    b"7z\xbc\xaf\x27\x1c",  # 7z
+    b"Rar!",  # rar
+    b"\xff\xd8\xff",  # jpeg
+    b"\x89PNG",  # png
+    b"GIF8",  # gif
+    b"\x1a\x45\xdf\xa3",  # mkv, webm
+    b"OggS",  # ogg
+    b"fLaC",  # flac
+]
+
+
+def get_codec(codec: str) -> str:
+    """
+    Returns the codec that is actually used for the configured one.
+
+    Args:
+        codec (str): The configured codec, 'gzip' or 'zstd'.
+
+    Returns:
+        str: The codec to use.
+
+    Raises:
+        ValueError: If the codec is not supported.
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unsupported compression codec: {codec}")
+
+    if codec == "zstd" and zstandard is None:
+        logger.warning("zstandard is not installed, compressing with gzip instead")
+        return "gzip"
+
+    return codec
+
+
+def is_compressible(file_path: Path) -> bool:
+    """
+    Returns whether a file is worth compressing.
+
+    Args:
+        file_path (Path): The path to the file.
+
+    Returns:
+        bool: False if the file looks like it is already compressed.
+    """
+    if file_path.suffix.lower() in COMPRESSED_EXTENSIONS:
+        return False
+
+    file_size = file_path.stat().st_size
+    if file_size == 0:
+        return False
+
+    with open(file_path, "rb") as f:
+        header = os.pread(f.fileno(), 16, 0)
+        if any(header.startswith(magic) for magic in COMPRESSED_MAGIC):
+            return False
+        if header[4:8] == b"ftyp":  # mp4, mov, heic
+            return False
+
+        # Trial-compress a sample from the start and the middle of the file
+        sample = os.pread(f.fileno(), SAMPLE_SIZE, 0)
+        if file_size > 2 * SAMPLE_SIZE:
+            sample += os.pread(f.fileno(), SAMPLE_SIZE, file_size // 2)
+
+    ratio = len(zlib.compress(sample, 1)) / len(sample)
+    if ratio > MAX_SAMPLE_RATIO:
+        logger.debug(f"Not compressing {file_path} (sample ratio {ratio:.2f})")
+        return False
+
+    return True
+
+
+def get_compressed_path(file_path: Path, codec: str) -> Path:
+    """
+    Returns the path of the compressed copy of a file.
+
+    Args:
+        file_path (Path): The path to the file.
+        codec (str): The codec, 'gzip' or 'zstd'.
+
+    Returns:
+        Path: The path to the compressed file.
+    """
+    return file_path.with_name(file_path.name + EXTENSIONS[codec])
+
+
+def compress_file(file_path: Path, codec: str) -> Path:
+    """
+    Compresses a file next to itself, leaving the original in place.
+
+    Args:
+        file_path (Path): The path to the file.
+        codec (str): The codec, 'gzip' or 'zstd' (see `get_codec`).
+
+    Returns:
+        Path: The path to the compressed file.
+    """
+    compressed_path = get_compressed_path(file_path, codec)
+    temp_path = compressed_path.with_name(compressed_path.name + ".tmp")
+
+    with open(file_path, "rb") as src, open(temp_path, "wb") as dest:
+        if codec == "zstd":
+            compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1)
+            compressor.copy_stream(src, dest, read_size=BUFFER_SIZE)
+        else:
+            with gzip.GzipFile(
+                fileobj=dest, mode="wb", compresslevel=GZIP_LEVEL, mtime=0
+            ) as gz:
+                shutil.copyfileobj(src, gz, BUFFER_SIZE)
+    os.replace(temp_path, compressed_path)
+
+    original_size = file_path.stat().st_size
+    compressed_size = compressed_path.stat().st_size
+    logger.info(
+        f"Compressed {file_path.name} with {codec}: "
+        f"{original_size} -> {compressed_size} bytes"
+    )
+
+    return compressed_path
+
+
+def open_decompressed(file_path: Path, codec: str) -> BinaryIO:
+    """
+    Opens a compressed file for reading its original content.
+
+    Args:
+        file_path (Path): The path to the compressed file.
+        codec (str): The codec the file was compressed with.
+
+    Returns:
+        BinaryIO: The decompressed stream.
+    """
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError(f"zstandard is needed to read {file_path}")
+        return zstandard.ZstdDecompressor().stream_reader(open(file_path, "rb"))
+    if codec == "gzip":
+        return gzip.open(file_path, "rb")  # type: ignore
+
+    raise ValueError(f"Unsupported compression codec: {codec}")
+
+
+def iter_decompressed(
+    file_path: Path,
+    codec: str,
+    buffer_size: int = BUFFER_SIZE,
+    start: int = 0,
+    stop: Optional[int] = None,
+) -> Iterator[bytes]:
+    """
+    Yields the original content of a compressed file, block by block.
+
+    Compressed streams cannot seek, so the content before `start` is
+    decompressed and dropped.
+
+    Args:
+        file_path (Path): The path to the compressed file.
+        codec (str): The codec the file was compressed with.
+        buffer_size (int): The size of the blocks.
+        start (int): The offset in the original content to start at.
+        stop (Optional[int]): The offset to stop at, or None for the end.
+
+    Yields:
+        bytes: The decompressed data.
+    """
+    with open_decompressed(file_path, codec) as stream:
+        position = 0
+        while stop is None or position < stop:
+            size = buffer_size if stop is None else min(buffer_size, stop - position)
+            data = stream.read(size)
+            if not data:
+                break
+            position += len(data)
+            if position <= start:
+                continue
+            if position - len(data) < start:
+                data = data[start - position + len(data) :]
+            yield data
+
+
+def maybe_compress(file_path: Path, codec: Optional[str]) -> Optional[str]:
+    """
+    Compresses a file with the given codec, if it is worth compressing.
+
+    The compressed copy is written next to the file (see
+    `get_compressed_path`), and the original is left in place.
+
+    Args:
+        file_path (Path): The path to the file.
+        codec (Optional[str]): The configured codec, or None.
+
+    Returns:
+        Optional[str]: The codec used, or None if the file was not compressed.
+    """
+    if codec is None or not is_compressible(file_path):
+        return None
+
+    codec = get_codec(codec)
+    compress_file(file_path, codec)
+
+    return codec
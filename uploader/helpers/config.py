@@ -1,10 +1,283 @@
 """
 Helper functions for reading configuration files.
+
+A config file is parsed once per process into an immutable `Settings`
+object (see `get_settings`), which `config` reads its sections from. The
+file is parsed again when:
+- it changes: it is checked (with a `stat`) at most once every
+    `CHECK_INTERVAL_S` seconds.
+- the process gets a SIGHUP, once `install_reload_signal` was called.
+- `reload_settings` is called.
+
+Callbacks registered with `on_reload` are called with the new settings, so
+that what was built from the old ones (e.g. the app's config, database
+pools) can be updated.
 """
 
+import logging
+import os
+import signal
+import threading
+import time
 from configparser import ConfigParser
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict
+from types import MappingProxyType
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks of a config file for changes
+CHECK_INTERVAL_S = 5.0
+
+_TRUE_VALUES = ("true", "yes", "1")
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    The parsed contents of a config file, which do not change once loaded.
+
+    Attributes:
+        path (Path): The path to the config file.
+        version (Tuple[int, ...]): The modification time, size and inode of
+            the file when it was parsed, to tell when it changes.
+        sections (Mapping[str, Mapping[str, str]]): The options of each
+            section, read-only.
+        loaded_at (float): When the file was parsed (`time.monotonic`).
+    """
+
+    path: Path
+    version: Tuple[int, ...]
+    sections: Mapping[str, Mapping[str, str]]
+    loaded_at: float
+
+    def __repr__(self) -> str:
+        return f"<Settings {self.path} ({len(self.sections)} sections)>"
+
+    def has_section(self, section: str) -> bool:
+        """
+        Returns whether the config file has a section.
+        """
+        return section in self.sections
+
+    def section(self, section: str) -> Dict[str, str]:
+        """
+        Returns the options of a section.
+
+        Args:
+            section (str): The section.
+
+        Returns:
+            Dict[str, str]: A copy of the options, which callers may change.
+
+        Raises:
+            ValueError: If the section is not found in the config file.
+        """
+        if section not in self.sections:
+            raise ValueError(f"Section {section} not found in the {self.path} file")
+
+        return dict(self.sections[section])
+
+    def get(
+        self, section: str, option: str, default: Optional[str] = None
+    ) -> Optional[str]:
+        """
+        Returns an option, or `default` if it (or its section) is not set.
+        """
+        return self.sections.get(section, {}).get(option, default)
+
+    def get_int(self, section: str, option: str, default: int) -> int:
+        """
+        Returns an option as an integer, or `default` if it is not set.
+        """
+        value = self.get(section, option)
+        return default if value is None else int(value)
+
+    def get_float(self, section: str, option: str, default: float) -> float:
+        """
+        Returns an option as a float, or `default` if it is not set.
+        """
+        value = self.get(section, option)
+        return default if value is None else float(value)
+
+    def get_bool(self, section: str, option: str, default: bool) -> bool:
+        """
+        Returns an option as a boolean ('true', 'yes' or '1' are True), or
+        `default` if it is not set.
+        """
+        value = self.get(section, option)
+        return default if value is None else value.lower() in _TRUE_VALUES
+
+
+_settings: Dict[Path, Settings] = {}
+_checked_at: Dict[Path, float] = {}
+_listeners: List[Callable[[Settings], None]] = []
+_lock = threading.Lock()
+_reload_requested = False
+
+
+def _reset_after_fork() -> None:
+    # The lock may have been held by another thread of the parent
+    global _lock  # pylint: disable=global-statement
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _get_version(path: Path) -> Tuple[int, ...]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return ()
+
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def load_settings(path: Path) -> Settings:
+    """
+    Parses a config file, without caching it (see `get_settings`).
+
+    Args:
+        path (Path): The path to the config file.
+
+    Returns:
+        Settings: The settings.
+    """
+    version = _get_version(path)
+    parser = ConfigParser()
+    parser.read(path)
+    sections = {
+        section: MappingProxyType(dict(parser.items(section)))
+        for section in parser.sections()
+    }
+
+    return Settings(
+        path=Path(path),
+        version=version,
+        sections=MappingProxyType(sections),
+        loaded_at=time.monotonic(),
+    )
+
+
+def get_settings(path: Path) -> Settings:
+    """
+    Returns the settings of a config file, parsed once and parsed again
+    when the file changes or a reload is requested.
+
+    Args:
+        path (Path): The path to the config file.
+
+    Returns:
+        Settings: The settings.
+    """
+    global _reload_requested  # pylint: disable=global-statement
+
+    if _reload_requested:
+        _reload_requested = False
+        logger.info("Reloading settings (SIGHUP)")
+        reload_settings()
+
+    settings = _settings.get(path)
+    now = time.monotonic()
+    if settings is not None and now - _checked_at.get(path, 0.0) < CHECK_INTERVAL_S:
+        return settings
+
+    with _lock:
+        settings = _settings.get(path)
+        if settings is not None:
+            _checked_at[path] = now
+            version = _get_version(path)
+            if version == settings.version:
+                return settings
+            if not version:
+                # e.g. being replaced: keep the settings until it is back
+                logger.warning(f"Cannot read {path}, keeping its last settings")
+                return settings
+            logger.info(f"{path} changed, reloading settings")
+
+        new_settings = load_settings(path)
+        _settings[path] = new_settings
+        _checked_at[path] = now
+
+    if settings is not None:
+        _notify(new_settings)
+
+    return new_settings
+
+
+def reload_settings(path: Optional[Path] = None) -> List[Settings]:
+    """
+    Parses config files again, whether they changed or not, and notifies
+    the callbacks registered with `on_reload`.
+
+    Args:
+        path (Optional[Path]): The config file, or None for all the files
+            loaded so far.
+
+    Returns:
+        List[Settings]: The new settings.
+    """
+    with _lock:
+        paths = list(_settings) if path is None else [path]
+        reloaded = [load_settings(each) for each in paths]
+        now = time.monotonic()
+        for settings in reloaded:
+            _settings[settings.path] = settings
+            _checked_at[settings.path] = now
+
+    for settings in reloaded:
+        _notify(settings)
+
+    return reloaded
+
+
+def on_reload(callback: Callable[[Settings], None]) -> None:
+    """
+    Registers a callback, called with the new settings of a config file
+    each time it is reloaded.
+
+    Args:
+        callback (Callable[[Settings], None]): The callback.
+    """
+    if callback not in _listeners:
+        _listeners.append(callback)
+
+    return None
+
+
+def _notify(settings: Settings) -> None:
+    for callback in list(_listeners):
+        try:
+            callback(settings)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.error(f"Failed to apply reloaded settings of {settings.path}: {e}")
+
+
+def _request_reload(signum: int, frame: object) -> None:
+    # Only flags the reload: the handler may interrupt a thread holding the
+    # lock, so the files are parsed by the next caller of `get_settings`
+    global _reload_requested  # pylint: disable=global-statement
+    _reload_requested = True
+
+
+def install_reload_signal() -> bool:
+    """
+    Reloads the settings on SIGHUP. Must be called from the main thread.
+
+    Returns:
+        bool: Whether the handler was installed, False if the platform has
+            no SIGHUP or this is not the main thread.
+    """
+    if not hasattr(signal, "SIGHUP"):
+        return False
+    if threading.current_thread() is not threading.main_thread():
+        return False
+
+    signal.signal(signal.SIGHUP, _request_reload)
+
+    return True
 
 
 def config(path: Path, section: str) -> Dict[str, str]:
@@ -21,15 +294,4 @@ def config(path: Path, section: str) -> Dict[str, str]:
     Raises:
         ValueError: If the section is not found in the configuration file.
     """
-    parser = ConfigParser()
-    parser.read(path)
-
-    conf = {}
-    if parser.has_section(section):
-        params = parser.items(section)
-        for param in params:
-            conf[param[0]] = param[1]
-    else:
-        raise ValueError(f"Section {section} not found in the {path} file")
-
-    return conf
+    return get_settings(Path(path)).section(section)
@@ -1,24 +1,70 @@
 """
 Helper functions for interacting with a PostgreSQL database.
+
+Connections are taken from one pool per process (and config file), created
+on first use (see `get_engine`), so requests do not pay for a new connection
+(TCP and authentication handshakes) per query. The pool is sized by the
+`[postgresql_pool]` section of the config file (see `get_pool_options`).
+
+Pools are fork-safe: a forked child (e.g. a Gunicorn worker forked from a
+preloaded app) drops the connections inherited from its parent, without
+closing them, and opens its own. When the settings are reloaded with
+changes to `[postgresql]` or `[postgresql_pool]`, the pool is closed, and
+a new one is opened on next use (see `helpers/config.py`).
+
+Queries made while serving requests read rows straight off a cursor, as
+tuples (`fetch_rows`) or dicts (`fetch_dicts`, `fetch_one`). Those of the
+models are registered statements (see `helpers/statements.py`), prepared
+once per pooled connection and executed with bind parameters. pandas is only
+imported by the helpers that return or take a DataFrame (`execute_sql`,
+`df_to_table`), for scripts and exports, so workers do not pay for it at
+startup or per query.
 """
 
+import functools
 import json
 import logging
+import os
 import random
+import threading
 import time
 from datetime import timedelta
 from pathlib import Path
-from typing import Literal, Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
-import pandas as pd
 import psycopg2
+import psycopg2.errors
 import sqlalchemy
 from sqlalchemy.exc import OperationalError
 
-from uploader.helpers.config import config
+from uploader.helpers.config import Settings, config, get_settings, on_reload
+from uploader.helpers.statements import Statement
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 logger = logging.getLogger(__name__)
 
+_engines: Dict[Path, sqlalchemy.engine.base.Engine] = {}
+_pool_stats: Dict[Path, "PoolStats"] = {}
+_prepare: Dict[Path, bool] = {}
+# The sections each engine was created from
+_engine_sections: Dict[Path, Dict[str, Dict[str, str]]] = {}
+
+DB_SECTIONS = ("postgresql", "postgresql_pool")
+_engines_lock = threading.Lock()
+
 
 def handle_null(query: str) -> str:
     """
@@ -105,16 +151,16 @@ def execute_queries(
     command = None
     output = []
     try:
-        # read the connection parameters
-        params = config(path=config_file, section="postgresql")
-        # connect to the PostgreSQL server
+        # take a connection from the pool
+        engine = get_engine(config_file=config_file)
         if show_commands:
             logger.debug("Connecting to the PostgreSQL database...")
             logger.debug(
-                f"{params['host']}:{params['port']} {params['database']} ({params['user']})"
+                f"{engine.url.host}:{engine.url.port} {engine.url.database} "
+                f"({engine.url.username})"
             )
 
-        conn = psycopg2.connect(**params)  # type: ignore
+        conn = engine.raw_connection()
         cur = conn.cursor()
 
         def execute_query(query: str):
@@ -146,6 +192,7 @@ def execute_queries(
         raise e
     finally:
         if conn is not None:
+            # Returns the connection to the pool, rolled back if not committed
             conn.close()
 
     return output
@@ -168,55 +215,235 @@ def execute_insert_query(config_file: Path, query: str) -> str:
     return str(result[0][0][0])
 
 
-def get_db_connection(config_file: Path) -> sqlalchemy.engine.base.Engine:
+def get_pool_options(config_file: Path) -> Dict[str, Any]:
     """
-    Establishes a connection to the PostgreSQL database using the provided configuration file.
+    Returns how the connection pool of each process is sized, from the
+    `[postgresql_pool]` section of the config file.
 
     Args:
-        config_file (Path): The path to the configuration file.
+        config_file (Path): The path to the config file.
 
     Returns:
-        sqlalchemy.engine.base.Engine: The database connection engine.
+        Dict[str, Any]: The connections kept open ('pool_size'), the extra
+            connections opened under load and closed once returned
+            ('max_overflow'), the seconds to wait for a connection before
+            failing ('pool_timeout'), the seconds after which a connection
+            is replaced ('pool_recycle', -1 for never), and whether
+            connections are checked before use ('pool_pre_ping').
     """
+    try:
+        params = config(path=config_file, section="postgresql_pool")
+    except ValueError:
+        params = {}
+
+    return {
+        "pool_size": int(params.get("pool_size", 5)),
+        "max_overflow": int(params.get("max_overflow", 10)),
+        "pool_timeout": float(params.get("pool_timeout", 30)),
+        "pool_recycle": int(params.get("pool_recycle", 1800)),
+        "pool_pre_ping": params.get("pre_ping", "true").lower()
+        in ("true", "yes", "1"),
+    }
+
+
+def get_prepared_statements(config_file: Path) -> bool:
+    """
+    Returns whether registered statements are prepared on each connection,
+    from `[postgresql_pool] prepared_statements` (see
+    `helpers/statements.py`).
+
+    Args:
+        config_file (Path): The path to the config file.
+
+    Returns:
+        bool: Whether statements are prepared, True by default.
+    """
+    try:
+        params = config(path=config_file, section="postgresql_pool")
+    except ValueError:
+        params = {}
+
+    return params.get("prepared_statements", "true").lower() in ("true", "yes", "1")
+
+
+class PoolStats:
+    """
+    Counts the events of a connection pool, for monitoring.
+
+    Attributes:
+        connects (int): The connections opened.
+        checkouts (int): The connections handed out.
+        invalidations (int): The connections found broken, and discarded.
+        prepares (int): The statements prepared.
+        executions (int): The registered statements executed.
+    """
+
+    def __init__(self, engine: sqlalchemy.engine.base.Engine):
+        self.connects = 0
+        self.checkouts = 0
+        self.invalidations = 0
+        self.prepares = 0
+        self.executions = 0
+        sqlalchemy.event.listen(engine, "connect", self._on_connect)
+        sqlalchemy.event.listen(engine, "checkout", self._on_checkout)
+        sqlalchemy.event.listen(engine, "invalidate", self._on_invalidate)
+
+    def __repr__(self) -> str:
+        return f"<PoolStats {self.connects} connects, {self.checkouts} checkouts>"
+
+    def _on_connect(self, *args: Any) -> None:
+        self.connects += 1
+
+    def _on_checkout(self, *args: Any) -> None:
+        self.checkouts += 1
+
+    def _on_invalidate(self, *args: Any) -> None:
+        self.invalidations += 1
+
+
+def _create_engine(config_file: Path) -> sqlalchemy.engine.base.Engine:
     params = config(path=config_file, section="postgresql")
-    engine = sqlalchemy.create_engine(
-        "postgresql+psycopg2://"
-        + params["user"]
-        + ":"
-        + params["password"]
-        + "@"
-        + params["host"]
-        + ":"
-        + params["port"]
-        + "/"
-        + params["database"]
+    url = sqlalchemy.engine.URL.create(
+        "postgresql+psycopg2",
+        username=params.pop("user"),
+        password=params.pop("password", None),
+        host=params.pop("host", None),
+        port=int(params.pop("port")) if "port" in params else None,
+        database=params.pop("database"),
     )
+    params.pop("prepared_statements", None)
+    pool_options = get_pool_options(config_file=config_file)
+    # Other connection parameters (e.g. sslmode) are passed on to psycopg2
+    engine = sqlalchemy.create_engine(url, connect_args=params, **pool_options)
+    logger.debug(f"Created connection pool for {url.host}: {pool_options}")
+
+    return engine
+
+
+def _reset_after_fork() -> None:
+    # Connections are shared with the parent until dropped, and the lock may
+    # have been held by another thread of the parent
+    global _engines_lock  # pylint: disable=global-statement
+    _engines_lock = threading.Lock()
+    for engine in _engines.values():
+        engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_key(config_file: Path) -> Path:
+    return Path(config_file).resolve()
 
-    return engine  # type: ignore
 
+def _get_db_sections(settings: Settings) -> Dict[str, Dict[str, str]]:
+    return {name: dict(settings.sections.get(name, {})) for name in DB_SECTIONS}
 
-def execute_sql(config_file: Path, query: str) -> pd.DataFrame:
+
+def _on_settings_reload(settings: Settings) -> None:
+    key = _get_key(settings.path)
+    if key not in _engines or _engine_sections.get(key) == _get_db_sections(settings):
+        return
+
+    with _engines_lock:
+        engine = _engines.pop(key, None)
+        _pool_stats.pop(key, None)
+        _prepare.pop(key, None)
+        _engine_sections.pop(key, None)
+    if engine is not None:
+        # Connections in use are closed once returned
+        engine.dispose()
+        logger.info(f"Database settings changed in {settings.path}, reconnecting")
+
+
+on_reload(_on_settings_reload)
+
+
+def get_engine(config_file: Path) -> sqlalchemy.engine.base.Engine:
     """
-    Executes a SQL query on a PostgreSQL database and returns the result as a
-    pandas DataFrame.
+    Returns the engine (and connection pool) of this process for a config
+    file, created on first use.
 
     Args:
-        config_file_path (str): The path to the configuration file containing the
-            PostgreSQL database credentials.
-        query (str): The SQL query to execute.
+        config_file (Path): The path to the configuration file.
 
     Returns:
-        pd.DataFrame: A pandas DataFrame containing the result of the SQL query.
+        sqlalchemy.engine.base.Engine: The database engine.
+    """
+    key = _get_key(config_file)
+    engine = _engines.get(key)
+    if engine is not None:
+        return engine
+
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = _create_engine(config_file=key)
+            _pool_stats[key] = PoolStats(engine)
+            _prepare[key] = get_prepared_statements(config_file=key)
+            _engine_sections[key] = _get_db_sections(get_settings(key))
+            _engines[key] = engine
+
+    return engine
+
+
+def get_pool_stats() -> List[Dict[str, Any]]:
+    """
+    Returns the state of the connection pools of this process.
+
+    Returns:
+        List[Dict[str, Any]]: For each pool, the 'database' it connects to,
+            the number of connections kept open ('size'), idle in the pool
+            ('checked_in'), in use ('checked_out') and opened beyond the
+            size ('overflow'), and the counters of `PoolStats`.
+    """
+    pools = []
+    for key, engine in list(_engines.items()):
+        pool = engine.pool
+        stats = _pool_stats[key]
+        url = engine.url
+        pools.append(
+            {
+                "database": f"{url.host}:{url.port}/{url.database}",
+                "pid": os.getpid(),
+                "size": pool.size(),  # type: ignore[attr-defined]
+                "checked_in": pool.checkedin(),  # type: ignore[attr-defined]
+                "checked_out": pool.checkedout(),  # type: ignore[attr-defined]
+                "overflow": max(pool.overflow(), 0),  # type: ignore[attr-defined]
+                "connects": stats.connects,
+                "checkouts": stats.checkouts,
+                "invalidations": stats.invalidations,
+                "prepares": stats.prepares,
+                "executions": stats.executions,
+            }
+        )
+
+    return pools
+
+
+def get_db_connection(config_file: Path) -> sqlalchemy.engine.base.Engine:
+    """
+    Returns the engine of the PostgreSQL database, whose connections are
+    pooled (see `get_engine`).
+
+    Args:
+        config_file (Path): The path to the configuration file.
+
+    Returns:
+        sqlalchemy.engine.base.Engine: The database connection engine.
     """
-    engine = get_db_connection(config_file=config_file)
+    return get_engine(config_file=config_file)
+
 
+def _with_retries(query: Callable[[], Any]) -> Any:
+    # Retries while the database is unreachable, backing off up to 5 minutes
     timeout = timedelta(seconds=2.5)
 
     while True:
         try:
-            df = pd.read_sql(query, engine)
-            break
-        except OperationalError as e:
+            return query()
+        except (OperationalError, psycopg2.OperationalError) as e:
             if timeout > timedelta(seconds=300):
                 raise e
 
@@ -227,11 +454,215 @@ def execute_sql(config_file: Path, query: str) -> pd.DataFrame:
             time.sleep(sleep_time)
             timeout = timeout * 2
 
-            engine = get_db_connection(config_file=config_file)
 
-    engine.dispose()
+Query = Union[str, Statement]
+
+
+def _run_statements(
+    conn: Any,
+    key: Path,
+    calls: Sequence[Tuple[Query, Sequence[Any]]],
+    size: Optional[int] = None,
+) -> List[Tuple[List[str], List[Tuple[Any, ...]]]]:
+    # Runs queries in one transaction, and returns the columns and rows of
+    # each. Registered statements are prepared on the connection first, if
+    # they are not yet; `conn.info` lives as long as the DBAPI connection.
+    prepared = conn.info.setdefault("prepared_statements", set())
+    stats = _pool_stats.get(key)
+    results = []
+
+    cur = conn.cursor()
+    try:
+        for query, params in calls:
+            if not isinstance(query, Statement):
+                cur.execute(query, params or None)
+            else:
+                if len(params) != query.parameter_count:
+                    raise ValueError(
+                        f"{query.name} takes {query.parameter_count} parameters, "
+                        f"got {len(params)}"
+                    )
+                if not _prepare.get(key, True):
+                    sql, order = query.unprepared_query()
+                    cur.execute(sql, [params[index] for index in order])
+                else:
+                    if query.name not in prepared:
+                        cur.execute(query.prepare_query())
+                        prepared.add(query.name)
+                        if stats is not None:
+                            stats.prepares += 1
+                    cur.execute(query.execute_query(), list(params) or None)
+                if stats is not None:
+                    stats.executions += 1
+
+            if cur.description is None:
+                results.append(([], []))
+                continue
+            columns = [column[0] for column in cur.description]
+            rows = cur.fetchall() if size is None else cur.fetchmany(size)
+            results.append((columns, rows))
+    finally:
+        cur.close()
+    conn.commit()
+
+    return results
+
+
+def _execute(
+    config_file: Path,
+    calls: Sequence[Tuple[Query, Sequence[Any]]],
+    size: Optional[int] = None,
+) -> List[Tuple[List[str], List[Tuple[Any, ...]]]]:
+    key = _get_key(config_file)
+    engine = get_engine(config_file=key)
+
+    conn = engine.raw_connection()
+    try:
+        try:
+            return _run_statements(conn, key, calls, size=size)
+        except (
+            psycopg2.errors.InvalidSqlStatementName,
+            psycopg2.errors.DuplicatePreparedStatement,
+        ) as e:
+            # The session's statements are not what was recorded (e.g. a
+            # proxy moved the session): start over, preparing them again
+            logger.warning(f"Prepared statements out of sync, re-preparing: {e}")
+            conn.rollback()
+            cur = conn.cursor()
+            cur.execute("DEALLOCATE ALL")
+            cur.close()
+            conn.info["prepared_statements"] = set()
+            return _run_statements(conn, key, calls, size=size)
+    finally:
+        # Returns the connection to the pool, rolled back if not committed
+        conn.close()
+
+
+def _fetch(
+    config_file: Path,
+    query: Query,
+    params: Sequence[Any] = (),
+    size: Optional[int] = None,
+) -> Tuple[List[str], List[Tuple[Any, ...]]]:
+    def run_query() -> Tuple[List[str], List[Tuple[Any, ...]]]:
+        return _execute(config_file=config_file, calls=[(query, params)], size=size)[0]
+
+    return _with_retries(run_query)
+
+
+def execute_statements(
+    config_file: Path, calls: Sequence[Tuple[Statement, Sequence[Any]]]
+) -> List[List[Tuple[Any, ...]]]:
+    """
+    Executes registered statements (see `helpers/statements.py`) in one
+    transaction, committed if they all succeed.
+
+    Args:
+        config_file (Path): The path to the configuration file.
+        calls (Sequence[Tuple[Statement, Sequence[Any]]]): Each statement, and
+            the values of its parameters.
+
+    Returns:
+        List[List[Tuple[Any, ...]]]: The rows returned by each statement,
+            empty for those that return none.
+    """
+    try:
+        results = _execute(config_file=config_file, calls=calls)
+    except (Exception, psycopg2.DatabaseError) as e:
+        logger.debug(f"Error executing {[call[0].name for call in calls]}: {e}")
+        raise e
+
+    return [rows for _, rows in results]
+
+
+def fetch_rows(
+    config_file: Path, query: Query, params: Sequence[Any] = ()
+) -> List[Tuple[Any, ...]]:
+    """
+    Executes a SQL query on a PostgreSQL database and returns the rows of the
+    result, as tuples.
+
+    Args:
+        config_file (Path): The path to the configuration file.
+        query (Union[str, Statement]): The SQL query, or registered statement,
+            to execute.
+        params (Sequence[Any]): The values of the statement's parameters.
+
+    Returns:
+        List[Tuple[Any, ...]]: The rows, with the values converted by psycopg2
+            (e.g. TIMESTAMP to datetime, JSONB to dict, NULL to None).
+    """
+    _, rows = _fetch(config_file=config_file, query=query, params=params)
+
+    return rows
+
+
+def fetch_dicts(
+    config_file: Path, query: Query, params: Sequence[Any] = ()
+) -> List[Dict[str, Any]]:
+    """
+    Executes a SQL query on a PostgreSQL database and returns the rows of the
+    result, as dicts keyed by column name.
+
+    Args:
+        config_file (Path): The path to the configuration file.
+        query (Union[str, Statement]): The SQL query, or registered statement,
+            to execute.
+        params (Sequence[Any]): The values of the statement's parameters.
+
+    Returns:
+        List[Dict[str, Any]]: The rows. Where columns share a name (e.g.
+            `a.*, b.*` in a join), the last one is kept.
+    """
+    columns, rows = _fetch(config_file=config_file, query=query, params=params)
+
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def fetch_one(
+    config_file: Path, query: Query, params: Sequence[Any] = ()
+) -> Optional[Dict[str, Any]]:
+    """
+    Executes a SQL query on a PostgreSQL database and returns the first row
+    of the result, as a dict keyed by column name.
+
+    Args:
+        config_file (Path): The path to the configuration file.
+        query (Union[str, Statement]): The SQL query, or registered statement,
+            to execute.
+        params (Sequence[Any]): The values of the statement's parameters.
+
+    Returns:
+        Optional[Dict[str, Any]]: The row, or None if the result is empty.
+    """
+    columns, rows = _fetch(
+        config_file=config_file, query=query, params=params, size=1
+    )
+    if not rows:
+        return None
+
+    return dict(zip(columns, rows[0]))
+
+
+def execute_sql(config_file: Path, query: str) -> "pd.DataFrame":
+    """
+    Executes a SQL query on a PostgreSQL database and returns the result as a
+    pandas DataFrame, for analytics and exports. Prefer `fetch_dicts` or
+    `fetch_one` on the request path.
+
+    Args:
+        config_file_path (str): The path to the configuration file containing the
+            PostgreSQL database credentials.
+        query (str): The SQL query to execute.
+
+    Returns:
+        pd.DataFrame: A pandas DataFrame containing the result of the SQL query.
+    """
+    import pandas as pd  # pylint: disable=import-outside-toplevel
+
+    engine = get_engine(config_file=config_file)
 
-    return df
+    return _with_retries(lambda: pd.read_sql(query, engine))
 
 
 def fetch_record(config_file: Path, query: str) -> Optional[str]:
@@ -246,20 +677,20 @@ def fetch_record(config_file: Path, query: str) -> Optional[str]:
         Optional[str]: The value of the first column of the first row of the result set,
         or None if the result set is empty.
     """
-    df = execute_sql(config_file=config_file, query=query)
+    _, rows = _fetch(config_file=config_file, query=query, size=1)
 
     # Check if there is a row
-    if df.shape[0] == 0:
+    if not rows:
         return None
 
-    value = df.iloc[0, 0]
+    value = rows[0][0]
 
     return str(value)
 
 
 def df_to_table(
     config_file: Path,
-    df: pd.DataFrame,
+    df: "pd.DataFrame",
     table_name: str,
     if_exists: Literal["fail", "replace", "append"] = "replace",
 ) -> None:
@@ -274,6 +705,5 @@ def df_to_table(
             if the table already exists.
     """
 
-    engine = get_db_connection(config_file=config_file)
+    engine = get_engine(config_file=config_file)
     df.to_sql(table_name, engine, if_exists=if_exists, index=False)
-    engine.dispose()
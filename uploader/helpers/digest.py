@@ -0,0 +1,403 @@
+"""
+Content digests computed while uploads stream in.
+
+Files are hashed as a two-level tree: the file is split into fixed 1 MB
+blocks, each block is hashed on its own, and the digest of the file is the
+hash of the concatenated block hashes (like Dropbox's content hash). Blocks
+can be hashed in any order and in any process, so chunks that arrive out of
+order, or in different gunicorn workers, are hashed as they are written and
+the file never has to be read back.
+
+Block hashes ('leaves') are stored in a small file in the upload's chunk
+directory. A block that could not be hashed in flight (e.g. it straddles two
+chunks that are not aligned to the block size) is left blank, and is hashed
+from the final file when the upload is finalized.
+
+A leaf must describe the bytes that end up in the file, so each block is
+hashed by one writer only: chunks must tile the file, one request at a time
+receives a chunk, and a chunk is never written again once it is received
+(see `helpers/manifest.py`). A write that is rejected, or that only partly
+reaches the file, blanks the leaves it stored (see `DigestWriter.discard`).
+
+Digests are written as '<algorithm>:<hex>', e.g. 'sha256-tree:9f86d08...'.
+"""
+
+import base64
+import hashlib
+import hmac
+import logging
+import os
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+from uploader.helpers.multipart import FileSink
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1024 * 1024  # 1 MB
+LEAVES_NAME = "digests"
+
+# Not the RFC 3230 `Digest` header, whose algorithms hash the file as a whole
+HEADER_NAME = "X-Content-Tree-Digest"
+
+ALGORITHMS = {
+    "sha256": "sha256-tree",
+    "blake2b": "blake2b-tree",
+}
+
+_DIGEST_SIZE = 32
+_BLANK_LEAF = bytes(_DIGEST_SIZE)
+
+
+def _new_hash(algorithm: str) -> "hashlib._Hash":
+    if algorithm == "sha256":
+        return hashlib.sha256()
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=_DIGEST_SIZE)
+
+    raise ValueError(f"Unsupported digest algorithm: {algorithm}")
+
+
+def parse_digest(digest: str) -> Tuple[str, str]:
+    """
+    Splits a stored digest into its label and hex value.
+
+    Args:
+        digest (str): The digest, e.g. 'sha256-tree:9f86d08...'.
+
+    Returns:
+        Tuple[str, str]: The label and the hex value.
+    """
+    label, _, value = digest.partition(":")
+
+    return label, value
+
+
+def get_algorithm(digest: str) -> str:
+    """
+    Returns the algorithm a stored digest was computed with.
+
+    Args:
+        digest (str): The digest, e.g. 'sha256-tree:9f86d08...'.
+
+    Returns:
+        str: The algorithm, e.g. 'sha256'.
+
+    Raises:
+        ValueError: If the digest has an unknown label.
+    """
+    label, _ = parse_digest(digest)
+    for algorithm, algorithm_label in ALGORITHMS.items():
+        if algorithm_label == label:
+            return algorithm
+
+    raise ValueError(f"Unsupported digest: {digest}")
+
+
+def get_block_count(file_size: int) -> int:
+    """
+    Returns the number of blocks (and leaves) of a file.
+
+    Args:
+        file_size (int): The size of the file in bytes.
+
+    Returns:
+        int: The number of blocks.
+    """
+    return (file_size + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+
+def check_possession(
+    digest: str, file_size: int, leaves: bytes, blocks: Dict[int, bytes]
+) -> bool:
+    """
+    Checks a client's proof that it holds the file with the given digest.
+
+    The digest is not a secret (downloads carry it), so the client sends the
+    hashes of all the blocks of the file, which must hash to the digest, and
+    the bytes of a few blocks picked by the server, which must hash to their
+    leaves.
+
+    Args:
+        digest (str): The digest, e.g. 'sha256-tree:9f86d08...'.
+        file_size (int): The size of the file in bytes.
+        leaves (bytes): The concatenated block hashes of the file.
+        blocks (Dict[int, bytes]): The bytes of the picked blocks, by index.
+
+    Returns:
+        bool: True if the proof holds.
+    """
+    try:
+        algorithm = get_algorithm(digest)
+    except ValueError:
+        return False
+
+    block_count = get_block_count(file_size)
+    if len(leaves) != block_count * _DIGEST_SIZE:
+        return False
+    root = _new_hash(algorithm)
+    root.update(leaves)
+    root_digest = f"{ALGORITHMS[algorithm]}:{root.hexdigest()}"
+    if not hmac.compare_digest(root_digest, digest):
+        return False
+
+    for block_index, block in blocks.items():
+        if not 0 <= block_index < block_count:
+            return False
+        if len(block) != min(BLOCK_SIZE, file_size - block_index * BLOCK_SIZE):
+            return False
+        block_hash = _new_hash(algorithm)
+        block_hash.update(block)
+        leaf = leaves[block_index * _DIGEST_SIZE : (block_index + 1) * _DIGEST_SIZE]
+        if not hmac.compare_digest(block_hash.digest(), leaf):
+            return False
+
+    return True
+
+
+def digest_header(digest: str) -> str:
+    """
+    Formats a stored digest as the value of the `HEADER_NAME` header.
+
+    Args:
+        digest (str): The digest, e.g. 'sha256-tree:9f86d08...'.
+
+    Returns:
+        str: The header value, e.g. 'sha256-tree=n4bQgYhMfWWaL+qgxVrQFaO/TxsrC4Is0V1sFbDwCgg='.
+    """
+    label, value = parse_digest(digest)
+    encoded = base64.b64encode(bytes.fromhex(value)).decode("ascii")
+
+    return f"{label}={encoded}"
+
+
+class DigestWriter:
+    """
+    File sink that hashes the blocks of the file it writes.
+
+    Wraps the sink that stores a range of the file, starting at `offset`.
+    Every block that lies entirely within the range is hashed as it passes
+    through.
+
+    Attributes:
+        file_size (Optional[int]): The size of the whole file, or None if the
+            range runs to the end of the file.
+        leaves (Dict[int, bytes]): The block hashes, when no leaves file is used.
+    """
+
+    def __init__(
+        self,
+        sink: FileSink,
+        offset: int,
+        algorithm: str,
+        file_size: Optional[int] = None,
+        leaves_path: Optional[Path] = None,
+    ):
+        self.sink = sink
+        self.offset = offset
+        self.algorithm = algorithm
+        self.file_size = file_size
+        self.leaves_path = leaves_path
+        self.leaves: Dict[int, bytes] = {}
+        self._position = offset
+        self._block_index = offset // BLOCK_SIZE
+        # An unaligned range cannot hash its first (partial) block
+        self._skip = (BLOCK_SIZE - offset % BLOCK_SIZE) % BLOCK_SIZE
+        self._first_leaf = self._block_index + (1 if self._skip else 0)
+        self._stored = 0
+        self._hash = _new_hash(algorithm)
+        self._hashed = 0
+        self._leaves_fd: Optional[int] = None
+        if leaves_path is not None:
+            self._leaves_fd = os.open(leaves_path, os.O_WRONLY | os.O_CREAT, 0o644)
+
+    @property
+    def written(self) -> int:
+        """
+        The number of bytes written so far.
+        """
+        return self._position - self.offset
+
+    def _store_leaf(self) -> None:
+        leaf = self._hash.digest()
+        if self._leaves_fd is not None:
+            os.pwrite(self._leaves_fd, leaf, self._block_index * _DIGEST_SIZE)
+        else:
+            self.leaves[self._block_index] = leaf
+        self._stored += 1
+        self._block_index += 1
+        self._hash = _new_hash(self.algorithm)
+        self._hashed = 0
+
+    def write(self, data: bytes) -> None:
+        """
+        Writes a block of data to the wrapped sink, and hashes it.
+
+        Args:
+            data (bytes): The data to write.
+        """
+        self.sink.write(data)
+        self._position += len(data)
+
+        view = memoryview(data)
+        if self._skip:
+            skipped = min(self._skip, len(view))
+            self._skip -= skipped
+            view = view[skipped:]
+            if not self._skip and skipped:
+                self._block_index += 1
+        while view:
+            count = min(BLOCK_SIZE - self._hashed, len(view))
+            self._hash.update(view[:count])
+            self._hashed += count
+            view = view[count:]
+            if self._hashed == BLOCK_SIZE:
+                self._store_leaf()
+
+    def close(self) -> None:
+        """
+        Closes the wrapped sink, and stores the hash of the last block if the
+        range ends at the end of the file.
+        """
+        try:
+            self.sink.close()
+            at_end = self.file_size is None or self._position == self.file_size
+            if self._hashed and at_end:
+                self._store_leaf()
+        finally:
+            if self._leaves_fd is not None:
+                os.close(self._leaves_fd)
+                self._leaves_fd = None
+
+    def discard(self, keep: int = 0) -> None:
+        """
+        Blanks the hashes stored for the blocks that are not within the first
+        `keep` bytes of the range, e.g. because the write was rejected or
+        only partly reached the file. Those blocks are hashed from the file
+        when the upload is finalized instead.
+
+        Args:
+            keep (int): The number of bytes of the range that were written.
+        """
+        if self.offset + keep >= self._position:
+            return None
+
+        first = max(self._first_leaf, (self.offset + keep) // BLOCK_SIZE)
+        end = self._first_leaf + self._stored
+        if first >= end:
+            return None
+
+        if self.leaves_path is None:
+            for block_index in range(first, end):
+                self.leaves.pop(block_index, None)
+        else:
+            fd = os.open(self.leaves_path, os.O_WRONLY)
+            try:
+                os.pwrite(fd, _BLANK_LEAF * (end - first), first * _DIGEST_SIZE)
+            finally:
+                os.close(fd)
+        self._stored = first - self._first_leaf
+        logger.debug(f"Discarded the hashes of blocks {first} to {end - 1}")
+
+        return None
+
+    def digest(self) -> str:
+        """
+        Returns the digest of the file, when the writer covered all of it.
+
+        Returns:
+            str: The digest.
+        """
+        root = _new_hash(self.algorithm)
+        for block_index in range(len(self.leaves)):
+            root.update(self.leaves[block_index])
+
+        return f"{ALGORITHMS[self.algorithm]}:{root.hexdigest()}"
+
+
+def hash_file(file_path: Path, algorithm: str) -> str:
+    """
+    Computes the digest of a file from its content alone, ignoring any block
+    hashes computed in flight.
+
+    Args:
+        file_path (Path): The path to the file.
+        algorithm (str): The digest algorithm.
+
+    Returns:
+        str: The digest.
+    """
+    return finalize_digest(file_path, None, algorithm)
+
+
+def finalize_digest(
+    file_path: Path, leaves_path: Optional[Path], algorithm: str
+) -> str:
+    """
+    Computes the digest of a finalized file from its stored block hashes,
+    hashing any block that is missing a hash from the file itself.
+
+    Args:
+        file_path (Path): The path to the final file.
+        leaves_path (Optional[Path]): The path to the file with the block
+            hashes, or None to hash every block.
+        algorithm (str): The digest algorithm.
+
+    Returns:
+        str: The digest.
+    """
+    with open(file_path, "rb") as f:
+        return finalize_digest_with(
+            read_block=lambda offset, size: os.pread(f.fileno(), size, offset),
+            file_size=os.fstat(f.fileno()).st_size,
+            leaves_path=leaves_path,
+            algorithm=algorithm,
+        )
+
+
+def finalize_digest_with(
+    read_block: Callable[[int, int], bytes],
+    file_size: int,
+    leaves_path: Optional[Path],
+    algorithm: str,
+) -> str:
+    """
+    Computes the digest of a finalized file that is read with `read_block`,
+    e.g. from a remote storage backend.
+
+    Args:
+        read_block (Callable[[int, int], bytes]): Reads `size` bytes of the
+            file from `offset`, called as `read_block(offset, size)`.
+        file_size (int): The size of the file in bytes.
+        leaves_path (Optional[Path]): The path to the file with the block
+            hashes, or None to hash every block.
+        algorithm (str): The digest algorithm.
+
+    Returns:
+        str: The digest.
+    """
+    block_count = get_block_count(file_size)
+
+    leaves = b""
+    if leaves_path is not None:
+        try:
+            leaves = leaves_path.read_bytes()
+        except FileNotFoundError:
+            pass
+
+    root = _new_hash(algorithm)
+    rehashed = 0
+    for block_index in range(block_count):
+        start = block_index * _DIGEST_SIZE
+        leaf = leaves[start : start + _DIGEST_SIZE]
+        if len(leaf) < _DIGEST_SIZE or leaf == _BLANK_LEAF:
+            block_hash = _new_hash(algorithm)
+            block_hash.update(read_block(block_index * BLOCK_SIZE, BLOCK_SIZE))
+            leaf = block_hash.digest()
+            rehashed += 1
+        root.update(leaf)
+
+    if rehashed:
+        logger.debug(f"Hashed {rehashed}/{block_count} blocks on finalize")
+
+    return f"{ALGORITHMS[algorithm]}:{root.hexdigest()}"
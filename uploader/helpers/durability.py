@@ -0,0 +1,210 @@
+"""
+Flushes uploaded data to stable storage, so that a crash or power loss
+cannot leave an uploaded file registered with data that never reached the
+disk.
+
+How much is flushed is set with `[upload] durability`:
+- 'none': nothing, the kernel writes data back when it sees fit.
+- 'finalize': a file is flushed (with its directory entry) before it is
+    registered, so a registered file is always whole. Chunks received
+    before a crash may have to be sent again.
+- 'chunk': every chunk is also flushed before it is acknowledged, so that
+    an acknowledged chunk is never sent again.
+
+With `[upload] group_commit`, flushes are grouped: concurrent writers to the
+same file (the chunks of a 'direct' upload, or the entries of a directory)
+share one `fdatasync` instead of making one each. The first writer to ask
+leads a flush that covers every write made before it started, and writers
+arriving meanwhile wait for the next one, which also covers them all.
+
+Journaling filesystems (ext4, XFS) already share their journal commits
+between concurrent flushes, so grouping pays off mostly where each flush is
+a round trip of its own, e.g. on network filesystems (see
+`docs/durability.md`).
+"""
+
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MODES = ("none", "finalize", "chunk")
+
+
+@dataclass
+class _FileState:
+    """
+    The flushes of one file.
+    """
+
+    condition: threading.Condition
+    # Sync requests made, and covered by a completed flush
+    requested: int = 0
+    synced: int = 0
+    syncing: bool = False
+    users: int = 0
+    # Requests covered by a flush that failed, and its error
+    failed: int = 0
+    error: Optional[OSError] = None
+
+
+def _flush(path: Path, is_dir: bool) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if is_dir:
+            os.fsync(fd)
+        else:
+            os.fdatasync(fd)
+    finally:
+        os.close(fd)
+
+
+class GroupCommitter:
+    """
+    Groups the flushes of concurrent writers to the same file.
+
+    Attributes:
+        requests (int): The number of flushes asked for.
+        flushes (int): The number of flushes made.
+    """
+
+    def __init__(self, flush: Callable[[Path, bool], None] = _flush):
+        self._flush = flush
+        self._lock = threading.Lock()
+        self._files: Dict[Tuple[int, int], _FileState] = {}
+        self.requests = 0
+        self.flushes = 0
+
+    def __repr__(self) -> str:
+        return f"<GroupCommitter {self.flushes}/{self.requests} flushes>"
+
+    def sync(self, path: Path, delay_s: float = 0.0) -> None:
+        """
+        Returns once the data written to a file (or the entries of a
+        directory) before the call is on stable storage.
+
+        Args:
+            path (Path): The path to the file or directory.
+            delay_s (float): Seconds a leading writer waits for other writers
+                to join its flush, trading latency for fewer flushes.
+
+        Raises:
+            OSError: If the flush failed.
+        """
+        stat = os.stat(path)
+        is_dir = os.path.isdir(path)
+        key = (stat.st_dev, stat.st_ino)
+
+        with self._lock:
+            state = self._files.get(key)
+            if state is None:
+                state = _FileState(condition=threading.Condition(self._lock))
+                self._files[key] = state
+            state.users += 1
+            state.requested += 1
+            target = state.requested
+            self.requests += 1
+
+            try:
+                while state.synced < target:
+                    if state.failed >= target:
+                        raise OSError(f"Flushing {path} failed: {state.error}")
+                    if state.syncing:
+                        state.condition.wait()
+                        continue
+                    self._lead(state, path, is_dir, delay_s)
+            finally:
+                state.users -= 1
+                if state.users == 0:
+                    del self._files[key]
+
+        return None
+
+    def _lead(
+        self, state: _FileState, path: Path, is_dir: bool, delay_s: float
+    ) -> None:
+        # Called, and returns, holding the lock
+        state.syncing = True
+        covered = state.requested
+        error: Optional[OSError] = None
+        self._lock.release()
+        try:
+            if delay_s > 0:
+                time.sleep(delay_s)
+                with self._lock:
+                    covered = state.requested
+            self._flush(path, is_dir)
+        except OSError as e:
+            error = e
+        finally:
+            self._lock.acquire()
+            state.syncing = False
+            state.condition.notify_all()
+
+        if error is not None:
+            # A failed flush is not retried: the kernel may have dropped the
+            # data it could not write, and a second flush would succeed
+            state.failed, state.error = covered, error
+            logger.error(f"Failed to flush {path}: {error}")
+            raise error
+        state.synced = max(state.synced, covered)
+        self.flushes += 1
+
+
+_committer = GroupCommitter()
+
+
+def _reset_after_fork() -> None:
+    # The lock may have been held by another thread of the parent
+    global _committer  # pylint: disable=global-statement
+    _committer = GroupCommitter()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_committer() -> GroupCommitter:
+    """
+    Returns the group committer of this process.
+
+    Returns:
+        GroupCommitter: The group committer.
+    """
+    return _committer
+
+
+def sync_file(path: Path, delay_s: float = 0.0, grouped: bool = True) -> None:
+    """
+    Flushes a file (or the entries of a directory) to stable storage.
+
+    Args:
+        path (Path): The path to the file or directory.
+        delay_s (float): Seconds to wait for other writers to join a flush.
+        grouped (bool): Whether to group the flush with those of other
+            threads (see `GroupCommitter.sync`).
+    """
+    if grouped:
+        _committer.sync(path, delay_s=delay_s)
+    else:
+        _flush(path, os.path.isdir(path))
+
+    return None
+
+
+def sync_new_file(path: Path) -> None:
+    """
+    Flushes a newly created (or renamed) file, and the directory entry that
+    names it.
+
+    Args:
+        path (Path): The path to the file.
+    """
+    sync_file(path)
+    sync_file(path.parent)
+
+    return None
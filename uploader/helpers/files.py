@@ -0,0 +1,257 @@
+"""
+Helper functions for low-level file operations.
+"""
+
+import logging
+import os
+import uuid
+from pathlib import Path
+from typing import BinaryIO, Optional
+
+from uploader.helpers import pagecache
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = 1024 * 1024  # 1 MB
+
+
+def get_shard_dir(
+    storage_path: Path, file_uuid: str, shard_depth: int = 0, shard_width: int = 2
+) -> Path:
+    """
+    Returns the directory a file is stored in, under the storage path.
+
+    Files are spread over `shard_depth` levels of directories, keyed by the
+    first `shard_width` hex digits of their UUID per level, e.g. with two
+    levels of width 2, '2d0541d2-...' is stored under '2d/05/'.
+
+    Args:
+        storage_path (Path): The path to store uploaded files in.
+        file_uuid (str): The UUID of the file.
+        shard_depth (int): The number of directory levels, 0 to store files
+            directly under the storage path.
+        shard_width (int): The number of hex digits per level.
+
+    Returns:
+        Path: The directory of the file.
+
+    Raises:
+        ValueError: If `file_uuid` is not a UUID, and could lead out of the
+            storage path.
+    """
+    try:
+        uuid.UUID(file_uuid)
+    except ValueError as err:
+        raise ValueError(f"Invalid file UUID: {file_uuid!r}") from err
+
+    shard_dir = storage_path
+    for level in range(shard_depth):
+        shard_dir = shard_dir / file_uuid[level * shard_width : (level + 1) * shard_width]
+
+    return shard_dir
+
+
+def get_storage_file_path(
+    storage_path: Path,
+    file_uuid: str,
+    file_name: str,
+    shard_depth: int = 0,
+    shard_width: int = 2,
+) -> Path:
+    """
+    Returns the path to store an uploaded file at, creating its directory.
+
+    Args:
+        storage_path (Path): The path to store uploaded files in.
+        file_uuid (str): The UUID of the file.
+        file_name (str): The (secure) name of the file.
+        shard_depth (int): The number of directory levels (see `get_shard_dir`).
+        shard_width (int): The number of hex digits per level.
+
+    Returns:
+        Path: The path to the file, '<shard dir>/<uuid>_<file name>'.
+    """
+    shard_dir = get_shard_dir(storage_path, file_uuid, shard_depth, shard_width)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+
+    return shard_dir / f"{file_uuid}_{file_name}"
+
+
+def preallocate_file(file_path: Path, size: int) -> None:
+    """
+    Creates (if needed) and preallocates a file to the given size.
+
+    Uses `posix_fallocate` where available so that the blocks are reserved
+    up front, and falls back to extending the file with `ftruncate`.
+    Safe to call concurrently from multiple workers for the same file.
+
+    Args:
+        file_path (Path): The path to the file.
+        size (int): The size of the file in bytes.
+    """
+    fd = os.open(file_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size >= size:
+            return None
+
+        if size > 0 and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, size)
+                return None
+            except OSError as e:
+                logger.debug(f"posix_fallocate failed for {file_path}: {e}")
+
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+    return None
+
+
+class OffsetWriter:
+    """
+    Writes sequential blocks of data into an existing file, starting at a
+    given offset.
+
+    Uses positional writes, so concurrent writers to disjoint ranges of the
+    same file do not interfere with each other. Blocks are gathered into
+    writes of up to `buffer_size` bytes, aligned to `buffer_size` in the
+    file, so the kernel gets a few large writes instead of many small ones.
+
+    Files of at least `drop_cache_above` bytes are dropped from the page
+    cache as they are written (see `helpers/pagecache.py`).
+
+    Attributes:
+        written (int): The number of bytes written so far.
+    """
+
+    def __init__(
+        self,
+        file_path: Path,
+        offset: int,
+        limit: Optional[int] = None,
+        buffer_size: int = BUFFER_SIZE,
+        drop_cache_above: Optional[int] = None,
+        create: bool = False,
+    ):
+        self.file_path = file_path
+        self.offset = offset
+        self.limit = limit
+        self.buffer_size = buffer_size
+        self.drop_cache_above = drop_cache_above
+        self.written = 0
+        flags = os.O_WRONLY
+        if create:
+            flags |= os.O_CREAT | os.O_TRUNC
+        self._fd: Optional[int] = os.open(file_path, flags, 0o644)
+        self._buffer = bytearray()
+        self._flushed = 0
+        self._window: Optional[pagecache.WritebackWindow] = None
+        if drop_cache_above is not None:
+            self._watch_size(os.fstat(self._fd).st_size)
+
+    def __repr__(self) -> str:
+        return f"<OffsetWriter {self.file_path} at {self.offset + self.written}>"
+
+    def _watch_size(self, size: int) -> None:
+        # Files are dropped from the cache once they are known to be large
+        if self._window is None and size >= self.drop_cache_above:  # type: ignore
+            self._window = pagecache.WritebackWindow(
+                self._fd, self.offset + self._flushed  # type: ignore
+            )
+
+    def _flush(self, length: int) -> None:
+        flushed = 0
+        try:
+            with memoryview(self._buffer) as view:
+                while flushed < length:
+                    count = os.pwrite(
+                        self._fd,  # type: ignore
+                        view[flushed:length],
+                        self.offset + self._flushed,
+                    )
+                    flushed += count
+                    self._flushed += count
+        finally:
+            del self._buffer[:flushed]
+
+        if self.drop_cache_above is not None:
+            self._watch_size(self.offset + self._flushed)
+        if self._window is not None:
+            self._window.advance(self.offset + self._flushed)
+
+    def write(self, data: bytes) -> None:
+        """
+        Writes a block of data after the previously written ones.
+
+        Args:
+            data (bytes): The data to write.
+
+        Raises:
+            ValueError: If the data written exceeds `limit` bytes.
+        """
+        if self._fd is None:
+            raise ValueError(f"Writer for {self.file_path} is closed")
+        if self.limit is not None and self.written + len(data) > self.limit:
+            raise ValueError(f"Data exceeds the limit of {self.limit} bytes")
+
+        self._buffer += data
+        self.written += len(data)
+        end = self.offset + self.written
+        aligned_end = end - end % self.buffer_size
+        if aligned_end > self.offset + self._flushed:
+            self._flush(aligned_end - self.offset - self._flushed)
+
+    def close(self) -> None:
+        """
+        Writes the buffered data, and closes the underlying file descriptor.
+        """
+        if self._fd is None:
+            return
+        try:
+            self._flush(len(self._buffer))
+            if self._window is not None:
+                self._window.close(self.offset + self._flushed)
+        finally:
+            # What is left in the buffer was not written
+            self.written = self._flushed
+            self._buffer = bytearray()
+            os.close(self._fd)
+            self._fd = None
+
+
+def write_at(
+    file_path: Path,
+    offset: int,
+    stream: BinaryIO,
+    limit: Optional[int] = None,
+    buffer_size: int = BUFFER_SIZE,
+) -> int:
+    """
+    Writes the contents of a stream into an existing file at the given offset.
+
+    Args:
+        file_path (Path): The path to the (preallocated) file.
+        offset (int): The byte offset to start writing at.
+        stream (BinaryIO): The stream to read data from.
+        limit (Optional[int]): The maximum number of bytes to write.
+        buffer_size (int): The size of the read buffer.
+
+    Returns:
+        int: The number of bytes written.
+
+    Raises:
+        ValueError: If the stream holds more than `limit` bytes.
+    """
+    writer = OffsetWriter(file_path, offset, limit=limit)
+    try:
+        while True:
+            data = stream.read(buffer_size)
+            if not data:
+                break
+            writer.write(data)
+    finally:
+        writer.close()
+
+    return writer.written
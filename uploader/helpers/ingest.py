@@ -0,0 +1,209 @@
+"""
+Measures the recent ingest throughput, and recommends how clients should
+chunk their uploads.
+
+Each upload request (a chunk, a batch of chunks or a tus PATCH) that is
+received whole is recorded with its size and how long it took to receive.
+Over a sliding window, this gives:
+- the throughput of one request ('stream'), bound by the client's link and
+  the disk, which sets the chunk size: chunks are sized to take about
+  `target_chunk_s` seconds to send, so fast sites use big chunks and spend
+  less time on per-request overhead.
+- the number of requests in flight on average (by Little's law, the time
+  spent receiving requests over the length of the window), which sets how
+  many requests a client should send at once: fewer when the server is
+  loaded.
+
+Samples are kept in a fixed-size ring of binary records (`chunk_path/.ingest`)
+shared by all worker processes on the host. Recording a request writes its
+record and bumps the ring's counter under a short exclusive `flock`; only
+`IngestMeter.stats` reads the whole ring.
+"""
+
+import contextlib
+import fcntl
+import logging
+import os
+import struct
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+STATE_NAME = ".ingest"
+
+# Samples kept at most, the oldest are overwritten first
+MAX_SAMPLES = 2000
+
+# The number of samples ever recorded, then one record per slot: when the
+# request ended, its size and how long it took to receive
+_HEADER = struct.Struct("<Q")
+_RECORD = struct.Struct("<ddd")
+_RING_SIZE = _HEADER.size + MAX_SAMPLES * _RECORD.size
+
+MB = 1024 * 1024
+
+
+class IngestMeter:
+    """
+    Recent ingest throughput, across all worker processes.
+
+    Attributes:
+        path (Path): The path to the state file.
+        window_s (int): Seconds of samples the measures are taken over.
+    """
+
+    def __init__(self, chunk_path: Path, window_s: int = 300):
+        self.path = chunk_path / STATE_NAME
+        self.window_s = window_s
+
+    def __repr__(self) -> str:
+        return f"<IngestMeter {self.path} window={self.window_s}s>"
+
+    def __str__(self) -> str:
+        return self.__repr__()
+
+    @contextlib.contextmanager
+    def _locked(self, operation: int) -> Iterator[int]:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, operation)
+            yield fd
+        finally:
+            # Closing the descriptor releases the lock
+            os.close(fd)
+
+    def record(self, size: int, duration_s: float) -> None:
+        """
+        Records an upload request that was received whole.
+
+        Args:
+            size (int): The size of the request body in bytes.
+            duration_s (float): Seconds it took to receive and store.
+        """
+        if size <= 0:
+            return None
+
+        record = _RECORD.pack(time.time(), size, max(duration_s, 1e-3))
+        with self._locked(fcntl.LOCK_EX) as fd:
+            header = os.pread(fd, _HEADER.size, 0)
+            if len(header) < _HEADER.size or os.fstat(fd).st_size != _RING_SIZE:
+                # New, or left by an older version
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, _RING_SIZE)
+                count = 0
+            else:
+                (count,) = _HEADER.unpack(header)
+            slot = count % MAX_SAMPLES
+            os.pwrite(fd, record, _HEADER.size + slot * _RECORD.size)
+            os.pwrite(fd, _HEADER.pack(count + 1), 0)
+
+        return None
+
+    def _read_samples(self, now: float) -> List[Tuple[float, float, float]]:
+        with self._locked(fcntl.LOCK_SH) as fd:
+            data = os.pread(fd, _RING_SIZE, 0)
+        if len(data) != _RING_SIZE:
+            return []
+
+        cutoff = now - self.window_s
+        samples = [
+            sample
+            for sample in _RECORD.iter_unpack(data[_HEADER.size :])
+            if sample[0] >= cutoff
+        ]
+        samples.sort()
+
+        return samples
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the measures over the window.
+
+        Returns:
+            Dict[str, Any]: The number of 'samples', the 'throughput' of the
+                server and of one request ('stream_throughput', None without
+                samples), in bytes per second, and the average number of
+                requests 'in_flight'.
+        """
+        now = time.time()
+        samples = self._read_samples(now)
+        total_bytes = sum(sample[1] for sample in samples)
+        total_duration = sum(sample[2] for sample in samples)
+        count = len(samples)
+        # Measured over the window, or since the first sample if the server
+        # has not been receiving uploads for that long
+        span = float(self.window_s)
+        if samples:
+            span = min(span, max(now - samples[0][0] + samples[0][2], 1.0))
+
+        return {
+            "samples": count,
+            "throughput": total_bytes / span,
+            "stream_throughput": (
+                total_bytes / total_duration if total_duration else None
+            ),
+            "in_flight": total_duration / span,
+        }
+
+
+def _round_chunk_size(size: float) -> int:
+    # Down to a power of two MB, so the sizes handed out do not jitter
+    rounded = MB
+    while rounded * 2 <= size:
+        rounded *= 2
+
+    return rounded
+
+
+def recommend(
+    stats: Dict[str, Any],
+    chunking: Dict[str, float],
+    budget: int,
+    capacity: Optional[int] = None,
+    in_flight: Optional[int] = None,
+) -> Dict[str, int]:
+    """
+    Recommends how a client should chunk its uploads.
+
+    Args:
+        stats (Dict[str, Any]): The measures (see `IngestMeter.stats`).
+        chunking (Dict[str, float]): The chunking settings (see
+            `orchestrator.get_chunking`).
+        budget (int): The most requests the client may have in flight, e.g.
+            its share of the upload slots.
+        capacity (Optional[int]): The most upload requests the server takes
+            at once, if known.
+        in_flight (Optional[int]): The upload requests in flight right now,
+            if known.
+
+    Returns:
+        Dict[str, int]: The 'chunk_size' in bytes, the number of chunks of a
+            file to send at once ('chunk_concurrency'), and the number of
+            files to upload at once ('parallel_uploads').
+    """
+    stream_throughput = stats["stream_throughput"]
+    if stream_throughput is None:
+        chunk_size = chunking["chunk_size"]
+    else:
+        chunk_size = _round_chunk_size(stream_throughput * chunking["target_chunk_s"])
+    chunk_size = int(
+        min(max(chunk_size, chunking["min_chunk_size"]), chunking["max_chunk_size"])
+    )
+
+    budget = max(1, min(budget, int(chunking["max_connections"])))
+    if capacity:
+        load = max(stats["in_flight"], in_flight or 0) / capacity
+        if load >= 0.75:
+            budget = max(1, budget // 2)
+        if load >= 1:
+            budget = 1
+
+    chunk_concurrency = min(budget, int(chunking["max_chunk_concurrency"]))
+
+    return {
+        "chunk_size": chunk_size,
+        "chunk_concurrency": chunk_concurrency,
+        "parallel_uploads": max(1, budget // chunk_concurrency),
+    }
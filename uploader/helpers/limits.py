@@ -0,0 +1,319 @@
+"""
+Per-user limits on upload requests.
+
+Each user may have at most `max_concurrent_per_user` upload requests (chunks,
+or tus PATCHes) in progress, and all users together at most `max_concurrent`.
+When the server is busy, the slots are shared fairly: a user gets at most an
+equal share of `max_concurrent` among the users uploading at the time, so a
+user with many parallel uploads cannot crowd out the others.
+
+Ingest bandwidth is limited per user with a token bucket: a request spends
+tokens for its Content-Length up front, and the bucket refills at
+`bandwidth` bytes per second, up to `burst` bytes.
+
+Requests over a limit are rejected at once, rather than queued in a worker,
+with the number of seconds to wait before retrying. The state is a table of
+fixed-size binary records (`chunk_path/.limits`), one per upload request in
+progress and one per user whose bucket is not full, under a short `flock`, so
+the limits hold across all worker processes on the host. Taking a slot writes
+its record (and the user's bucket), releasing it clears the record, and
+records of finished requests or full buckets are reused.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import logging
+import math
+import os
+import struct
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+STATE_NAME = ".limits"
+
+# One record per slot: its kind, the user's key, then for a lease its id,
+# worker pid and start time, and for a bucket its tokens and when they were
+# counted
+_RECORD = struct.Struct("<B7x16s16sqdd")
+_FREE = 0
+_LEASE = 1
+_BUCKET = 2
+
+
+class RateLimited(Exception):
+    """
+    Raised when an upload request is over a limit.
+
+    Attributes:
+        retry_after (int): Seconds to wait before retrying.
+    """
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class Lease:
+    """
+    A slot held by an upload request in progress.
+    """
+
+    user: str
+    lease_id: str
+    slot: int
+
+
+def _get_user_key(user: str) -> bytes:
+    return hashlib.blake2b(user.encode("utf-8"), digest_size=16).digest()
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+class UploadLimiter:
+    """
+    Enforces the per-user upload limits.
+
+    Attributes:
+        path (Path): The path to the state file.
+        max_concurrent (int): The maximum number of upload requests in
+            progress, for all users.
+        max_concurrent_per_user (int): The maximum number of upload requests
+            in progress per user.
+        bandwidth (float): The ingest bandwidth per user, in bytes per second,
+            or 0 for no limit.
+        burst (float): The bytes a user may send at once, above `bandwidth`.
+        lease_timeout_s (int): Seconds after which a slot that was never
+            released (e.g. by a killed worker) is freed.
+    """
+
+    def __init__(
+        self,
+        chunk_path: Path,
+        max_concurrent: int = 8,
+        max_concurrent_per_user: int = 4,
+        bandwidth: float = 0,
+        burst: float = 100 * 1024 * 1024,
+        lease_timeout_s: int = 60 * 60,
+    ):
+        self.path = chunk_path / STATE_NAME
+        self.max_concurrent = max_concurrent
+        self.max_concurrent_per_user = max_concurrent_per_user
+        self.bandwidth = bandwidth
+        self.burst = burst
+        self.lease_timeout_s = lease_timeout_s
+
+    def __repr__(self) -> str:
+        return (
+            f"<UploadLimiter {self.max_concurrent_per_user}/{self.max_concurrent} "
+            f"concurrent, {self.bandwidth / (1024 * 1024):.1f} MB/s>"
+        )
+
+    def __str__(self) -> str:
+        return self.__repr__()
+
+    @contextlib.contextmanager
+    def _locked(self, operation: int) -> Iterator[int]:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, operation)
+            yield fd
+        finally:
+            # Closing the descriptor releases the lock
+            os.close(fd)
+
+    def _read_records(self, fd: int) -> Optional[List[Tuple[Any, ...]]]:
+        # None if the file is not a record table, e.g. left by an older version
+        data = os.pread(fd, os.fstat(fd).st_size, 0)
+        if len(data) % _RECORD.size:
+            return None
+
+        return list(_RECORD.iter_unpack(data))
+
+    def _scan(self, records: List[Tuple[Any, ...]], now: float) -> Dict[str, Any]:
+        # Sorts the records into live leases and buckets; the slots of dead
+        # workers, timed out leases and full buckets are free
+        leases = []
+        buckets = {}
+        free = []
+        for slot, (kind, user_key, _, pid, counted_at, tokens) in enumerate(records):
+            if (
+                kind == _LEASE
+                and now - counted_at < self.lease_timeout_s
+                and _is_alive(pid)
+            ):
+                leases.append(user_key)
+                continue
+            if kind == _BUCKET and self.bandwidth > 0:
+                elapsed = max(now - counted_at, 0)
+                tokens = min(tokens + elapsed * self.bandwidth, self.burst)
+                if tokens < self.burst:
+                    buckets[user_key] = (slot, tokens)
+                    continue
+            free.append(slot)
+
+        return {"leases": leases, "buckets": buckets, "free": free}
+
+    def _get_fair_share(self, leases: List[bytes], user_key: bytes) -> int:
+        active_users = set(leases)
+        active_users.add(user_key)
+
+        return max(
+            1,
+            min(self.max_concurrent_per_user, self.max_concurrent // len(active_users)),
+        )
+
+    def acquire(self, user: str, size: int) -> Lease:
+        """
+        Takes a slot for an upload request, and spends its bytes.
+
+        Args:
+            user (str): The username.
+            size (int): The size of the request body in bytes.
+
+        Returns:
+            Lease: The slot, to release once the request is done.
+
+        Raises:
+            RateLimited: If the request is over a limit.
+        """
+        now = time.time()
+        user_key = _get_user_key(user)
+        with self._locked(fcntl.LOCK_EX) as fd:
+            records = self._read_records(fd)
+            if records is None:
+                logger.warning(f"Resetting upload limits state {self.path}")
+                os.ftruncate(fd, 0)
+                records = []
+            scan = self._scan(records, now)
+
+            active = scan["leases"].count(user_key)
+            total_active = len(scan["leases"])
+            fair_share = self._get_fair_share(scan["leases"], user_key)
+            if active >= fair_share:
+                raise RateLimited(
+                    f"Too many uploads in progress ({active}/{fair_share})",
+                    retry_after=1,
+                )
+            if total_active >= self.max_concurrent:
+                raise RateLimited("The server is busy", retry_after=1)
+
+            bucket_slot, tokens = scan["buckets"].get(user_key, (None, self.burst))
+            if self.bandwidth > 0 and tokens < 0:
+                raise RateLimited(
+                    "Upload bandwidth exceeded",
+                    retry_after=math.ceil(-tokens / self.bandwidth),
+                )
+
+            free = scan["free"]
+            slot = free.pop(0) if free else len(records)
+            lease = Lease(user=user, lease_id=uuid.uuid4().hex, slot=slot)
+            record = _RECORD.pack(
+                _LEASE, user_key, bytes.fromhex(lease.lease_id), os.getpid(), now, 0
+            )
+            os.pwrite(fd, record, slot * _RECORD.size)
+
+            if self.bandwidth > 0:
+                if bucket_slot is None:
+                    bucket_slot = free.pop(0) if free else max(slot + 1, len(records))
+                # May go into debt, which later requests wait out
+                record = _RECORD.pack(
+                    _BUCKET, user_key, bytes(16), 0, now, tokens - size
+                )
+                os.pwrite(fd, record, bucket_slot * _RECORD.size)
+
+        return lease
+
+    def release(self, lease: Lease) -> None:
+        """
+        Releases the slot of a finished upload request.
+
+        Args:
+            lease (Lease): The slot from `acquire`.
+        """
+        offset = lease.slot * _RECORD.size
+        with self._locked(fcntl.LOCK_EX) as fd:
+            data = os.pread(fd, _RECORD.size, offset)
+            if len(data) == _RECORD.size:
+                kind, _, lease_id, _, _, _ = _RECORD.unpack(data)
+                # Unless the slot was freed and reused meanwhile
+                if kind == _LEASE and lease_id.hex() == lease.lease_id:
+                    os.pwrite(fd, bytes(_RECORD.size), offset)
+
+        return None
+
+    @contextlib.contextmanager
+    def slot(self, user: str, size: int) -> Iterator[Lease]:
+        """
+        Holds a slot for the duration of an upload request.
+
+        Args:
+            user (str): The username.
+            size (int): The size of the request body in bytes.
+
+        Raises:
+            RateLimited: If the request is over a limit.
+        """
+        lease = self.acquire(user, size)
+        try:
+            yield lease
+        finally:
+            self.release(lease)
+
+    def usage(self, user: str) -> Dict[str, Any]:
+        """
+        Returns the current usage of a user, and of all users.
+
+        Args:
+            user (str): The username.
+
+        Returns:
+            Dict[str, Any]: The user's uploads in progress ('active'), their
+                current 'fair_share' of slots, the bytes they may send right
+                away ('available_bytes', None if the bandwidth is not
+                limited), and the uploads in progress and users uploading
+                for all users ('total_active', 'active_users').
+        """
+        now = time.time()
+        user_key = _get_user_key(user)
+        with self._locked(fcntl.LOCK_SH) as fd:
+            records = self._read_records(fd) or []
+        scan = self._scan(records, now)
+        _, tokens = scan["buckets"].get(user_key, (None, self.burst))
+
+        return {
+            "active": scan["leases"].count(user_key),
+            "fair_share": self._get_fair_share(scan["leases"], user_key),
+            "available_bytes": int(tokens) if self.bandwidth > 0 else None,
+            "total_active": len(scan["leases"]),
+            "active_users": len(set(scan["leases"])),
+        }
+
+    def get_limits(self) -> Dict[str, Any]:
+        """
+        Returns the configured limits.
+
+        Returns:
+            Dict[str, Any]: The limits.
+        """
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_concurrent_per_user": self.max_concurrent_per_user,
+            "bandwidth_bytes_per_s": self.bandwidth or None,
+            "burst_bytes": int(self.burst) if self.bandwidth > 0 else None,
+        }
@@ -0,0 +1,275 @@
+"""
+Per-upload chunk receipt manifest.
+
+The manifest is a small binary file kept in the upload's chunk directory:
+a fixed header (total chunk count, received chunk count, finalizer claim)
+followed by a bitmap with one bit per chunk. Every update takes an exclusive
+`flock` on the file, so it is safe across threads and gunicorn worker
+processes on the same host, and only reads or writes the header and a
+single bitmap byte.
+
+The first chunk of an upload pins its layout (chunk size and file size) in
+a file next to the manifest, and every chunk must then start at its index
+times the chunk size (see `get_chunk_range`), so that chunks can neither
+overlap nor leave gaps. A chunk is received by one request at a time (see
+`ChunkManifest.lock_chunk`).
+"""
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import struct
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest"
+LAYOUT_NAME = "layout"
+
+_MAGIC = b"CCMANIF1"
+_HEADER = struct.Struct("<8sIIB")  # magic, total chunks, received chunks, claimed
+
+
+def get_chunk_range(
+    chunk_index: int, total_chunks: int, chunk_size: int, file_size: int
+) -> Tuple[int, int]:
+    """
+    Returns the byte range of a chunk of a file split into chunks of
+    `chunk_size` bytes, the last one holding the rest (as Dropzone does).
+
+    Args:
+        chunk_index (int): The index of the chunk.
+        total_chunks (int): The total number of chunks in the upload.
+        chunk_size (int): The size of every chunk but the last, in bytes.
+        file_size (int): The size of the whole file, in bytes.
+
+    Returns:
+        Tuple[int, int]: The offset of the chunk in the file, and its length.
+
+    Raises:
+        ValueError: If the values do not describe such a split.
+    """
+    if chunk_size <= 0 or file_size < 0:
+        raise ValueError(f"Invalid chunk size {chunk_size} or file size {file_size}")
+    if total_chunks != max(1, -(-file_size // chunk_size)):
+        raise ValueError(
+            f"{total_chunks} chunks of {chunk_size} bytes do not make up "
+            f"{file_size} bytes"
+        )
+    if not 0 <= chunk_index < total_chunks:
+        raise ValueError(f"Chunk index {chunk_index} out of range")
+
+    offset = chunk_index * chunk_size
+
+    return offset, min(chunk_size, file_size - offset)
+
+
+class ChunkManifest:
+    """
+    Tracks which chunks of an upload have been received, and which request
+    gets to finalize the upload.
+
+    Attributes:
+        path (Path): The path to the manifest file.
+    """
+
+    def __init__(self, save_dir: Path):
+        self.path = save_dir / MANIFEST_NAME
+
+    def __repr__(self) -> str:
+        return f"<ChunkManifest {self.path}>"
+
+    def __str__(self) -> str:
+        return self.__repr__()
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[int]:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield fd
+        finally:
+            # Closing the descriptor releases the lock
+            os.close(fd)
+
+    def _read_header(self, fd: int, total_chunks: int) -> Tuple[int, int, int]:
+        data = os.pread(fd, _HEADER.size, 0)
+        if len(data) < _HEADER.size:
+            if not total_chunks:
+                return 0, 0, 0
+            # New manifest, write an empty header and bitmap
+            bitmap_size = (total_chunks + 7) // 8
+            os.pwrite(fd, _HEADER.pack(_MAGIC, total_chunks, 0, 0), 0)
+            os.ftruncate(fd, _HEADER.size + bitmap_size)
+            return total_chunks, 0, 0
+
+        magic, stored_total, received, claimed = _HEADER.unpack(data)
+        if magic != _MAGIC:
+            raise ValueError(f"Corrupt chunk manifest: {self.path}")
+        if total_chunks and stored_total != total_chunks:
+            raise ValueError(
+                f"Total chunk count changed from {stored_total} to {total_chunks}"
+            )
+
+        return stored_total, received, claimed
+
+    def check_layout(self, total_chunks: int, chunk_size: int, file_size: int) -> None:
+        """
+        Records the layout of the upload on its first chunk, and checks that
+        the other chunks have the same.
+
+        Args:
+            total_chunks (int): The total number of chunks in the upload.
+            chunk_size (int): The size of every chunk but the last, in bytes.
+            file_size (int): The size of the whole file, in bytes.
+
+        Raises:
+            ValueError: If the layout differs from the one recorded.
+        """
+        layout = {"chunk_size": chunk_size, "file_size": file_size}
+        layout_path = self.path.parent / LAYOUT_NAME
+
+        with self._locked() as fd:
+            self._read_header(fd, total_chunks)
+            try:
+                recorded = json.loads(layout_path.read_text())
+            except FileNotFoundError:
+                layout_path.write_text(json.dumps(layout))
+                return None
+
+        if recorded != layout:
+            raise ValueError(f"Upload layout changed from {recorded} to {layout}")
+
+        return None
+
+    def lock_chunk(self, chunk_index: int) -> BinaryIO:
+        """
+        Takes the lock on receiving a chunk, held until the returned file is
+        closed, so that two requests for the same chunk (e.g. a retry and
+        the request it retries) do not write it at the same time.
+
+        Args:
+            chunk_index (int): The index of the chunk.
+
+        Returns:
+            BinaryIO: The locked file.
+
+        Raises:
+            ValueError: If another request is receiving the chunk.
+        """
+        lock_file = open(self.path.parent / f"{chunk_index}.lock", "ab")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError as err:
+            lock_file.close()
+            raise ValueError(f"Chunk {chunk_index} is already being received") from err
+
+        return lock_file
+
+    def is_received(self, chunk_index: int) -> bool:
+        """
+        Checks if a chunk has been received.
+
+        Args:
+            chunk_index (int): The index of the chunk.
+
+        Returns:
+            bool: True if the chunk has been received.
+        """
+        if not self.path.exists():
+            return False
+
+        with self._locked() as fd:
+            total, _, _ = self._read_header(fd, 0)
+            if not 0 <= chunk_index < total:
+                return False
+            byte = os.pread(fd, 1, _HEADER.size + chunk_index // 8)[0]
+
+        return bool(byte & (1 << (chunk_index % 8)))
+
+    def mark_received(self, chunk_index: int, total_chunks: int) -> bool:
+        """
+        Records a received chunk.
+
+        Receiving the same chunk more than once (e.g. a retried request) is
+        counted once.
+
+        Args:
+            chunk_index (int): The index of the received chunk.
+            total_chunks (int): The total number of chunks in the upload.
+
+        Returns:
+            bool: True if this call completed the upload and claimed its
+                finalization. Exactly one call per upload returns True,
+                unless the claim is released with `release_claim`.
+
+        Raises:
+            ValueError: If the chunk index is out of range, or the total
+                chunk count does not match the manifest.
+        """
+        if not 0 <= chunk_index < total_chunks:
+            raise ValueError(f"Chunk index {chunk_index} out of range")
+
+        with self._locked() as fd:
+            total, received, claimed = self._read_header(fd, total_chunks)
+
+            byte_offset = _HEADER.size + chunk_index // 8
+            mask = 1 << (chunk_index % 8)
+            byte = os.pread(fd, 1, byte_offset)[0]
+            if not byte & mask:
+                os.pwrite(fd, bytes([byte | mask]), byte_offset)
+                received += 1
+
+            claim = received == total and not claimed
+            if claim:
+                claimed = 1
+
+            os.pwrite(fd, _HEADER.pack(_MAGIC, total, received, claimed), 0)
+
+        return claim
+
+    def release_claim(self) -> None:
+        """
+        Releases the finalization claim, e.g. after a failed finalization,
+        so that a retried chunk can claim it again.
+        """
+        with self._locked() as fd:
+            total, received, _ = self._read_header(fd, 0)
+            if total:
+                os.pwrite(fd, _HEADER.pack(_MAGIC, total, received, 0), 0)
+
+        logger.debug(f"Released finalization claim on {self.path}")
+
+    def is_complete(self) -> bool:
+        """
+        Checks if all the chunks of the upload have been received.
+
+        Returns:
+            bool: True if all the chunks have been received.
+        """
+        if not self.path.exists():
+            return False
+
+        with self._locked() as fd:
+            total, received, _ = self._read_header(fd, 0)
+
+        return total > 0 and received == total
+
+    def missing_chunks(self) -> List[int]:
+        """
+        Returns the indices of the chunks that have not been received yet.
+
+        Returns:
+            List[int]: The indices of the missing chunks.
+        """
+        if not self.path.exists():
+            return []
+
+        with self._locked() as fd:
+            total, _, _ = self._read_header(fd, 0)
+            bitmap = os.pread(fd, (total + 7) // 8, _HEADER.size)
+
+        return [i for i in range(total) if not bitmap[i // 8] & (1 << (i % 8))]
@@ -0,0 +1,227 @@
+"""
+Streaming parser for multipart/form-data request bodies.
+
+Unlike werkzeug's form parsing, which spools every file part to a temporary
+file before the view can see it, this parser hands file data to a sink chosen
+by the caller as soon as it is read off the socket. Form fields that precede a
+file part are available when choosing the sink.
+
+A body may hold several file parts, each preceded by its own fields (see
+`scoped_fields`), e.g. the chunks of a batched upload request.
+"""
+
+import logging
+from typing import BinaryIO, Callable, Dict, Optional, Protocol
+
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 64 * 1024  # 64 KB
+MAX_FORM_MEMORY_SIZE = 500 * 1024  # 500 KB
+MAX_PARTS = 1000
+
+
+class FileSink(Protocol):
+    """
+    Destination for the data of a file part.
+    """
+
+    def write(self, data: bytes) -> None:
+        """
+        Writes a block of data.
+        """
+
+    def close(self) -> None:
+        """
+        Called once all the data of the part has been written.
+        """
+
+
+class DiscardSink:
+    """
+    File sink that drops the data of a part, e.g. a chunk received before.
+
+    Attributes:
+        written (int): The number of bytes dropped.
+    """
+
+    def __init__(self) -> None:
+        self.written = 0
+
+    def write(self, data: bytes) -> None:
+        self.written += len(data)
+
+    def close(self) -> None:
+        pass
+
+
+OpenFile = Callable[[str, str, Dict[str, str]], FileSink]
+
+
+class StreamingFormParser:
+    """
+    Incremental multipart/form-data parser.
+
+    Data is pushed in with `feed()` and `finish()`, so the same parser can be
+    driven from a blocking WSGI stream or an async ASGI receive loop. Memory
+    use is bounded by `max_form_memory_size` (for fields and the decoder's
+    look-ahead buffer) plus the size of the blocks fed in.
+
+    With `scoped_fields`, the fields parsed so far only apply to the next
+    file part: they are passed to `open_file` and the parser starts over
+    with no fields.
+
+    Attributes:
+        fields (Dict[str, str]): The form fields parsed so far.
+        file_count (int): The number of file parts parsed so far.
+    """
+
+    def __init__(
+        self,
+        boundary: bytes,
+        open_file: OpenFile,
+        max_form_memory_size: int = MAX_FORM_MEMORY_SIZE,
+        max_parts: int = MAX_PARTS,
+        scoped_fields: bool = False,
+    ) -> None:
+        self.fields: Dict[str, str] = {}
+        self.file_count = 0
+        self._scoped_fields = scoped_fields
+        self._open_file = open_file
+        self._max_form_memory_size = max_form_memory_size
+        self._decoder = MultipartDecoder(
+            boundary, max_form_memory_size=max_form_memory_size, max_parts=max_parts
+        )
+        self._field_name: Optional[str] = None
+        self._field_data = bytearray()
+        self._sink: Optional[FileSink] = None
+
+    def feed(self, data: bytes) -> None:
+        """
+        Parses a block of the request body.
+
+        Args:
+            data (bytes): The next block of the request body.
+
+        Raises:
+            ValueError: If the body is malformed or a field is too large.
+        """
+        try:
+            self._decoder.receive_data(data)
+        except RequestEntityTooLarge as e:
+            raise ValueError("Multipart part exceeds the memory budget") from e
+        self._process_events()
+
+    def finish(self) -> Dict[str, str]:
+        """
+        Signals the end of the request body.
+
+        Returns:
+            Dict[str, str]: The form fields.
+
+        Raises:
+            ValueError: If the body ended before the closing boundary.
+        """
+        self._decoder.receive_data(None)
+        self._process_events()
+
+        if self._sink is not None or self._field_name is not None:
+            self.abort()
+            raise ValueError("Unexpected end of multipart body")
+
+        return self.fields
+
+    def abort(self) -> None:
+        """
+        Closes any file sink left open by an interrupted request, with its
+        `abort` method if it has one.
+        """
+        if self._sink is not None:
+            sink, self._sink = self._sink, None
+            getattr(sink, "abort", sink.close)()
+
+    def _process_events(self) -> None:
+        while True:
+            event = self._decoder.next_event()
+            if isinstance(event, NeedData):
+                return
+            if isinstance(event, Epilogue):
+                return
+            if isinstance(event, File):
+                self._sink = self._open_file(event.name, event.filename, self.fields)
+                self.file_count += 1
+                if self._scoped_fields:
+                    self.fields = {}
+            elif isinstance(event, Field):
+                self._field_name = event.name
+                self._field_data.clear()
+            elif isinstance(event, Data):
+                self._process_data(event)
+
+    def _process_data(self, event: Data) -> None:
+        if self._sink is not None:
+            if event.data:
+                self._sink.write(event.data)
+            if not event.more_data:
+                sink, self._sink = self._sink, None
+                sink.close()
+            return
+
+        if self._field_name is None:
+            return
+
+        self._field_data.extend(event.data)
+        if len(self._field_data) > self._max_form_memory_size:
+            raise ValueError(f"Field {self._field_name} exceeds the memory budget")
+        if not event.more_data:
+            self.fields[self._field_name] = self._field_data.decode("utf-8", "replace")
+            self._field_name = None
+            self._field_data.clear()
+
+
+def parse_form(
+    stream: BinaryIO,
+    boundary: bytes,
+    open_file: OpenFile,
+    max_form_memory_size: int = MAX_FORM_MEMORY_SIZE,
+    read_size: int = READ_SIZE,
+    scoped_fields: bool = False,
+) -> Dict[str, str]:
+    """
+    Parses a multipart/form-data body from a blocking stream.
+
+    Args:
+        stream (BinaryIO): The request body stream.
+        boundary (bytes): The multipart boundary.
+        open_file (OpenFile): Called with the part name, the file name and the
+            fields parsed so far when a file part starts; returns the sink
+            that receives the part's data.
+        max_form_memory_size (int): The memory budget for form fields.
+        read_size (int): The number of bytes to read from the stream at a time.
+        scoped_fields (bool): Whether fields only apply to the next file part
+            (see `StreamingFormParser`).
+
+    Returns:
+        Dict[str, str]: The form fields.
+
+    Raises:
+        ValueError: If the body is malformed or a field is too large.
+    """
+    parser = StreamingFormParser(
+        boundary=boundary,
+        open_file=open_file,
+        max_form_memory_size=max_form_memory_size,
+        scoped_fields=scoped_fields,
+    )
+    try:
+        while True:
+            data = stream.read(read_size)
+            if not data:
+                break
+            parser.feed(data)
+        return parser.finish()
+    except Exception:
+        parser.abort()
+        raise
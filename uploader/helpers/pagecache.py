@@ -0,0 +1,253 @@
+"""
+Keeps large uploads and downloads from pushing hotter data out of the page
+cache.
+
+An uploaded file is written once, and read back at most once (to assemble
+it, or to download it). Left to itself, the kernel keeps all of it cached,
+dirty until written back, evicting the data other requests and processes
+on the node are using. Files of at least `[upload] drop_cache_above` MB
+are instead:
+- written back one window at a time as they are written, each window being
+    dropped from the cache once it is on disk (see `WritebackWindow`), so
+    a writer keeps at most two windows of its file cached.
+- read with the kernel's read-ahead for sequential reads, and dropped from
+    the cache as they are read (see `SequentialReader`).
+
+`posix_fadvise` only drops clean pages, so writeback is started (and waited
+for) with `sync_file_range`, where the C library has it. Elsewhere, the
+advice is skipped and the kernel's defaults apply.
+"""
+
+import ctypes
+import ctypes.util
+import io
+import logging
+import os
+from pathlib import Path
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+WINDOW_SIZE = 8 * 1024 * 1024  # 8 MB
+
+# See sync_file_range(2)
+_SYNC_FILE_RANGE_WAIT_BEFORE = 1
+_SYNC_FILE_RANGE_WRITE = 2
+_SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _sync_file_range = _libc.sync_file_range
+    _sync_file_range.argtypes = [
+        ctypes.c_int,
+        ctypes.c_int64,
+        ctypes.c_int64,
+        ctypes.c_uint,
+    ]
+    _sync_file_range.restype = ctypes.c_int
+except (AttributeError, OSError, TypeError):
+    _sync_file_range = None
+
+
+def advise(fd: int, offset: int, length: int, advice: int) -> None:
+    """
+    Tells the kernel how a range of a file will be accessed, if the platform
+    supports it. The advice is only a hint, failures are ignored.
+
+    Args:
+        fd (int): The file descriptor.
+        offset (int): The start of the range.
+        length (int): The length of the range, 0 for up to the end of file.
+        advice (int): One of the `os.POSIX_FADV_*` constants.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return None
+
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError as e:
+        logger.debug(f"posix_fadvise({advice}) failed: {e}")
+
+    return None
+
+
+def drop(fd: int, offset: int = 0, length: int = 0) -> None:
+    """
+    Drops the clean pages of a range of a file from the page cache. Dirty
+    pages are left alone, see `write_back`.
+
+    Args:
+        fd (int): The file descriptor.
+        offset (int): The start of the range.
+        length (int): The length of the range, 0 for up to the end of file.
+    """
+    if hasattr(os, "POSIX_FADV_DONTNEED"):
+        advise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+    return None
+
+
+def write_back(fd: int, offset: int, length: int, wait: bool = False) -> bool:
+    """
+    Starts writing back the dirty pages of a range of a file, without
+    flushing the disk's cache or the file's metadata (this is not a
+    durability guarantee, see `helpers/durability.py`).
+
+    Args:
+        fd (int): The file descriptor.
+        offset (int): The start of the range.
+        length (int): The length of the range.
+        wait (bool): Whether to wait for the range to be written back.
+
+    Returns:
+        bool: Whether writeback was started, False if not supported here.
+    """
+    if _sync_file_range is None:
+        return False
+
+    flags = _SYNC_FILE_RANGE_WRITE
+    if wait:
+        flags |= _SYNC_FILE_RANGE_WAIT_BEFORE | _SYNC_FILE_RANGE_WAIT_AFTER
+    if _sync_file_range(fd, offset, length, flags) != 0:
+        logger.debug(f"sync_file_range failed: {os.strerror(ctypes.get_errno())}")
+        return False
+
+    return True
+
+
+def drop_file(file_path: Path) -> None:
+    """
+    Drops what is cached (and clean) of a file from the page cache, e.g.
+    once an upload is finalized.
+
+    Args:
+        file_path (Path): The path to the file.
+    """
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError as e:
+        logger.debug(f"Cannot open {file_path} to drop it from the cache: {e}")
+        return None
+    try:
+        drop(fd)
+    finally:
+        os.close(fd)
+
+    return None
+
+
+class WritebackWindow:
+    """
+    Drops data written front to back to a range of a file from the page
+    cache, once it is on disk.
+
+    Writeback of each window is started as soon as the window is written,
+    and the window before it is waited for and then dropped, so at most two
+    windows are cached at a time and the writer is held back to the speed
+    of the disk. Windows are aligned to `window_size` in the file.
+
+    Attributes:
+        fd (int): The file descriptor written to.
+        window_size (int): The size of a window in bytes.
+    """
+
+    def __init__(self, fd: int, offset: int, window_size: int = WINDOW_SIZE):
+        self.fd = fd
+        self.window_size = window_size
+        self._start = offset
+        self._previous: Optional[Tuple[int, int]] = None
+
+    def __repr__(self) -> str:
+        return f"<WritebackWindow fd={self.fd} at {self._start}>"
+
+    def _retire(self, start: int, length: int) -> None:
+        # Wait for the window before, which has had a window's worth of time
+        if self._previous is not None:
+            write_back(self.fd, *self._previous, wait=True)
+            drop(self.fd, *self._previous)
+        write_back(self.fd, start, length)
+        self._previous = (start, length)
+
+    def advance(self, end: int) -> None:
+        """
+        Records that the range is written up to `end`.
+
+        Args:
+            end (int): The offset in the file the data is written up to.
+        """
+        while True:
+            window_end = (self._start // self.window_size + 1) * self.window_size
+            if end < window_end:
+                break
+            self._retire(self._start, window_end - self._start)
+            self._start = window_end
+
+        return None
+
+    def close(self, end: int) -> None:
+        """
+        Writes back the rest of the range, and drops it once it is on disk,
+        so the writer leaves nothing of the range cached.
+
+        Args:
+            end (int): The offset in the file the data is written up to.
+        """
+        if end > self._start:
+            self._retire(self._start, end - self._start)
+            self._start = end
+        if self._previous is not None:
+            write_back(self.fd, *self._previous, wait=True)
+            drop(self.fd, *self._previous)
+            self._previous = None
+
+        return None
+
+
+class SequentialReader(io.FileIO):
+    """
+    A file read once, front to back: the kernel reads ahead aggressively,
+    and, with `drop_cache`, what was read is dropped from the page cache one
+    window behind the reader, and the rest once closed. Being a plain file,
+    it can still be sent with `sendfile` (e.g. by Gunicorn's
+    `wsgi.file_wrapper`), in which case it is only dropped once closed.
+
+    Attributes:
+        drop_cache (bool): Whether to drop what was read from the cache.
+    """
+
+    def __init__(self, file_path: Path, drop_cache: bool = False):
+        super().__init__(file_path, "rb")
+        self.drop_cache = drop_cache
+        self._unchecked = 0
+        self._dropped = 0
+        if hasattr(os, "POSIX_FADV_SEQUENTIAL"):
+            advise(self.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            advise(self.fileno(), 0, WINDOW_SIZE, os.POSIX_FADV_WILLNEED)
+
+    def _drop_behind(self, count: int) -> None:
+        self._unchecked += count
+        if not self.drop_cache or self._unchecked < WINDOW_SIZE:
+            return
+        self._unchecked = 0
+        position = self.tell()
+        end = position - position % WINDOW_SIZE - WINDOW_SIZE
+        if end > self._dropped:
+            drop(self.fileno(), self._dropped, end - self._dropped)
+            self._dropped = end
+
+    def read(self, size: int = -1) -> bytes:  # type: ignore[override]
+        data = super().read(size)
+        if data:
+            self._drop_behind(len(data))
+        return data  # type: ignore[return-value]
+
+    def readinto(self, buffer) -> int:  # type: ignore[no-untyped-def]
+        count = super().readinto(buffer)
+        if count:
+            self._drop_behind(count)
+        return count  # type: ignore[return-value]
+
+    def close(self) -> None:
+        if not self.closed and self.drop_cache:
+            drop(self.fileno())
+        super().close()
@@ -0,0 +1,129 @@
+"""
+A registry of the SQL statements run while serving requests, each defined
+once, with bind parameters (`$1`, `$2`, ...) instead of values formatted
+into the SQL.
+
+Each statement is prepared (`PREPARE`) on a pooled connection the first
+time it runs there, and executed (`EXECUTE`) with its parameters after
+that, so PostgreSQL parses it once per connection and can reuse its plan
+(see `db.execute_statements`). Values are sent as parameters, so they need
+no escaping.
+
+With `[postgresql_pool] prepared_statements = false` (e.g. behind a
+PgBouncer pooling transactions, where a session's prepared statements are
+not kept), statements are still sent with bind parameters, but unprepared.
+"""
+
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+_PARAMETER = re.compile(r"\$(\d+)")
+
+_registry: Dict[str, "Statement"] = {}
+
+
+@dataclass(frozen=True)
+class Statement:
+    """
+    A SQL statement with bind parameters.
+
+    Attributes:
+        name (str): The name it is prepared as, unique across the registry.
+        sql (str): The SQL, with its parameters as `$1`, `$2`, ...
+        parameter_count (int): The number of parameters it takes.
+    """
+
+    name: str
+    sql: str
+    parameter_count: int = field(init=False)
+
+    def __post_init__(self) -> None:
+        numbers = {int(number) for number in _PARAMETER.findall(self.sql)}
+        if numbers and numbers != set(range(1, max(numbers) + 1)):
+            raise ValueError(f"Statement {self.name} skips a parameter: {self.sql}")
+        object.__setattr__(self, "parameter_count", max(numbers, default=0))
+
+    def __repr__(self) -> str:
+        return f"<Statement {self.name} ({self.parameter_count} parameters)>"
+
+    def prepare_query(self) -> str:
+        """
+        Returns the SQL query to prepare the statement on a connection.
+
+        Returns:
+            str: The SQL query.
+        """
+        return f"PREPARE {self.name} AS {self.sql}"
+
+    def execute_query(self) -> str:
+        """
+        Returns the SQL query to execute the prepared statement, with a
+        psycopg2 placeholder for each parameter.
+
+        Returns:
+            str: The SQL query.
+        """
+        if self.parameter_count == 0:
+            return f"EXECUTE {self.name}"
+
+        placeholders = ", ".join(["%s"] * self.parameter_count)
+        return f"EXECUTE {self.name} ({placeholders})"
+
+    def unprepared_query(self) -> Tuple[str, List[int]]:
+        """
+        Returns the SQL query to execute the statement without preparing it,
+        with psycopg2 placeholders.
+
+        Returns:
+            Tuple[str, List[int]]: The SQL query, and the (0-based) index of
+                the parameter each placeholder takes, in order.
+        """
+        order: List[int] = []
+
+        def placeholder(match: "re.Match[str]") -> str:
+            order.append(int(match.group(1)) - 1)
+            return "%s"
+
+        sql = _PARAMETER.sub(placeholder, self.sql.replace("%", "%%"))
+
+        return sql, order
+
+
+def register(name: str, sql: str) -> Statement:
+    """
+    Adds a statement to the registry.
+
+    Args:
+        name (str): The name to prepare it as, e.g. 'users_find_by_email'.
+        sql (str): The SQL, with its parameters as `$1`, `$2`, ...
+
+    Returns:
+        Statement: The statement.
+
+    Raises:
+        ValueError: If another statement is registered under the same name.
+    """
+    if not re.fullmatch(r"[a-z_][a-z0-9_]*", name):
+        raise ValueError(f"Invalid statement name: {name}")
+
+    statement = Statement(name=name, sql=" ".join(sql.split()))
+    registered = _registry.get(name)
+    if registered is not None and registered != statement:
+        raise ValueError(f"Statement {name} is already registered")
+    _registry[name] = statement
+
+    return statement
+
+
+def get_statements() -> List[Statement]:
+    """
+    Returns the registered statements.
+
+    Returns:
+        List[Statement]: The statements, by name.
+    """
+    return sorted(_registry.values(), key=lambda statement: statement.name)
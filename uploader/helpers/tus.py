@@ -0,0 +1,356 @@
+"""
+State of resumable uploads made with the tus 1.0 protocol.
+
+See https://tus.io/protocols/resumable-upload for the protocol.
+
+Each upload keeps a small JSON info file (offset, length, owner, expiry) in
+`chunk_path/<upload_id>/`, and writes its data directly into the final file
+under the storage path, like the 'direct' chunk mode.
+"""
+
+import base64
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, Optional, Tuple
+
+from uploader.helpers import cli, digest, durability, files
+
+logger = logging.getLogger(__name__)
+
+TUS_VERSION = "1.0.0"
+TUS_EXTENSIONS = ["creation", "termination", "expiration"]
+
+INFO_NAME = "tus.json"
+LOCK_NAME = "tus.lock"
+
+
+class TusUploadLocked(Exception):
+    """
+    Raised when another request is already writing to the upload.
+    """
+
+
+def parse_metadata(header: Optional[str]) -> Dict[str, str]:
+    """
+    Parses an Upload-Metadata header.
+
+    Args:
+        header (Optional[str]): Comma separated `key base64(value)` pairs.
+
+    Returns:
+        Dict[str, str]: The decoded metadata.
+
+    Raises:
+        ValueError: If a value is not valid base64.
+    """
+    metadata: Dict[str, str] = {}
+    if not header:
+        return metadata
+
+    for pair in header.split(","):
+        parts = pair.strip().split(" ")
+        if not parts[0]:
+            continue
+        value = ""
+        if len(parts) > 1:
+            try:
+                value = base64.b64decode(parts[1], validate=True).decode("utf-8")
+            except (ValueError, UnicodeDecodeError) as e:
+                raise ValueError(f"Invalid Upload-Metadata value for {parts[0]}") from e
+        metadata[parts[0]] = value
+
+    return metadata
+
+
+class TusUpload:
+    """
+    A resumable tus upload.
+
+    Attributes:
+        upload_id (str): The ID of the upload, also used as the file UUID.
+        save_dir (Path): The directory holding the upload's state.
+        file_name (str): The (secure) name of the file.
+        file_path (Path): The path to the final file.
+        length (int): The total size of the upload in bytes.
+        offset (int): The number of bytes received so far.
+        owner (str): The username of the user who created the upload.
+        expires_at (datetime): The time after which the upload is discarded.
+        data_type (Optional[str]): The data type of the upload, from the
+            'data_type' metadata.
+        finalizing (bool): Whether the complete upload was handed over to
+            be finalized, which happens once.
+    """
+
+    def __init__(
+        self,
+        upload_id: str,
+        save_dir: Path,
+        file_name: str,
+        file_path: Path,
+        length: int,
+        offset: int,
+        owner: str,
+        expires_at: datetime,
+        data_type: Optional[str] = None,
+        finalizing: bool = False,
+    ):
+        self.upload_id = upload_id
+        self.save_dir = save_dir
+        self.file_name = file_name
+        self.file_path = file_path
+        self.length = length
+        self.offset = offset
+        self.owner = owner
+        self.expires_at = expires_at
+        self.data_type = data_type
+        self.finalizing = finalizing
+
+    def __repr__(self) -> str:
+        return f"<TusUpload {self.upload_id} {self.offset}/{self.length}>"
+
+    def __str__(self) -> str:
+        return self.__repr__()
+
+    @staticmethod
+    def create(
+        chunk_path: Path,
+        storage_path: Path,
+        file_name: str,
+        length: int,
+        owner: str,
+        expiration_s: int,
+        data_type: Optional[str] = None,
+        storage_layout: Tuple[int, int] = (0, 2),
+    ) -> "TusUpload":
+        """
+        Creates a new upload, and preallocates its final file.
+
+        Args:
+            chunk_path (Path): The path to store upload state in.
+            storage_path (Path): The path to store uploaded files in.
+            file_name (str): The (secure) name of the file.
+            length (int): The total size of the upload in bytes.
+            owner (str): The username of the user creating the upload.
+            expiration_s (int): Seconds without progress before the upload expires.
+            data_type (Optional[str]): The data type of the upload.
+            storage_layout (Tuple[int, int]): The shard depth and width of
+                the storage path (see `files.get_shard_dir`).
+
+        Returns:
+            TusUpload: The new upload.
+        """
+        upload_id = str(uuid.uuid4())
+        save_dir = chunk_path / upload_id
+        save_dir.mkdir(parents=True)
+
+        upload = TusUpload(
+            upload_id=upload_id,
+            save_dir=save_dir,
+            file_name=file_name,
+            file_path=files.get_storage_file_path(
+                storage_path,
+                upload_id,
+                file_name,
+                shard_depth=storage_layout[0],
+                shard_width=storage_layout[1],
+            ),
+            length=length,
+            offset=0,
+            owner=owner,
+            expires_at=datetime.now() + timedelta(seconds=expiration_s),
+            data_type=data_type,
+        )
+        files.preallocate_file(upload.file_path, length)
+        upload.save()
+
+        return upload
+
+    @staticmethod
+    def load(chunk_path: Path, upload_id: str) -> "Optional[TusUpload]":
+        """
+        Loads an upload's state.
+
+        Args:
+            chunk_path (Path): The path upload state is stored in.
+            upload_id (str): The ID of the upload.
+
+        Returns:
+            Optional[TusUpload]: The upload, or None if it does not exist.
+        """
+        try:
+            uuid.UUID(upload_id)
+        except ValueError:
+            return None
+
+        save_dir = chunk_path / upload_id
+        try:
+            info = json.loads((save_dir / INFO_NAME).read_text())
+        except FileNotFoundError:
+            return None
+
+        return TusUpload(
+            upload_id=upload_id,
+            save_dir=save_dir,
+            file_name=info["file_name"],
+            file_path=Path(info["file_path"]),
+            length=int(info["length"]),
+            offset=int(info["offset"]),
+            owner=info["owner"],
+            expires_at=datetime.fromisoformat(info["expires_at"]),
+            data_type=info.get("data_type"),
+            finalizing=info.get("finalizing", False),
+        )
+
+    def save(self) -> None:
+        """
+        Atomically writes the upload's state to its info file.
+        """
+        info = {
+            "file_name": self.file_name,
+            "file_path": str(self.file_path),
+            "length": self.length,
+            "offset": self.offset,
+            "owner": self.owner,
+            "expires_at": self.expires_at.isoformat(),
+            "data_type": self.data_type,
+            "finalizing": self.finalizing,
+        }
+        temp_path = self.save_dir / f"{INFO_NAME}.tmp"
+        temp_path.write_text(json.dumps(info))
+        os.replace(temp_path, self.save_dir / INFO_NAME)
+
+        return None
+
+    @property
+    def is_expired(self) -> bool:
+        """
+        Whether the upload has expired.
+        """
+        return datetime.now() > self.expires_at
+
+    @property
+    def is_complete(self) -> bool:
+        """
+        Whether all the bytes of the upload have been received.
+        """
+        return self.offset == self.length
+
+    def refresh(self) -> None:
+        """
+        Reloads the offset and finalization state, which other requests may
+        have changed. Call while holding `lock()`.
+        """
+        current = TusUpload.load(self.save_dir.parent, self.upload_id)
+        if current is not None:
+            self.offset = current.offset
+            self.finalizing = current.finalizing
+
+        return None
+
+    @contextlib.contextmanager
+    def lock(self) -> Iterator[None]:
+        """
+        Holds an exclusive lock on the upload, shared across processes.
+
+        Raises:
+            TusUploadLocked: If another request holds the lock.
+        """
+        fd = os.open(self.save_dir / LOCK_NAME, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError as e:
+                raise TusUploadLocked(self.upload_id) from e
+            yield
+        finally:
+            os.close(fd)
+
+    def append(
+        self,
+        stream: BinaryIO,
+        offset: int,
+        expiration_s: int,
+        digest_algorithm: str,
+        buffer_size: int = files.BUFFER_SIZE,
+        sync: bool = False,
+        drop_cache_above: Optional[int] = None,
+    ) -> int:
+        """
+        Appends data at the given offset, which must be the current offset.
+
+        The offset is saved even if the stream breaks off, so the client can
+        resume from the last byte that was written. Must be called while
+        holding `lock()`.
+
+        Args:
+            stream (BinaryIO): The request body.
+            offset (int): The offset the client is writing at.
+            expiration_s (int): Seconds without progress before the upload expires.
+            digest_algorithm (str): The algorithm to hash the data with.
+            buffer_size (int): The size of the read buffer.
+            sync (bool): Whether to flush the data to stable storage before
+                the new offset is saved (see `helpers/durability.py`).
+            drop_cache_above (Optional[int]): The size from which the file is
+                kept out of the page cache (see `helpers/pagecache.py`).
+
+        Returns:
+            int: The new offset.
+
+        Raises:
+            ValueError: If the offset does not match, or the data exceeds
+                the upload length.
+        """
+        self.refresh()
+        if offset != self.offset:
+            raise ValueError(f"Upload-Offset {offset} does not match {self.offset}")
+
+        writer = files.OffsetWriter(
+            self.file_path,
+            self.offset,
+            limit=self.length - self.offset,
+            drop_cache_above=drop_cache_above,
+        )
+        sink = digest.DigestWriter(
+            writer,
+            offset=self.offset,
+            algorithm=digest_algorithm,
+            file_size=self.length,
+            leaves_path=self.save_dir / digest.LEAVES_NAME,
+        )
+        try:
+            while True:
+                data = stream.read(buffer_size)
+                if not data:
+                    break
+                sink.write(data)
+        finally:
+            try:
+                sink.close()
+            finally:
+                # Only the bytes that reached the file may keep their hashes
+                sink.discard(keep=writer.written)
+            if sync and writer.written:
+                durability.sync_file(self.file_path)
+                durability.sync_file(self.save_dir / digest.LEAVES_NAME)
+            self.offset += writer.written
+            self.expires_at = datetime.now() + timedelta(seconds=expiration_s)
+            self.save()
+
+        return self.offset
+
+    def delete(self) -> None:
+        """
+        Discards the upload, its state and its partial file.
+        """
+        if self.file_path.exists():
+            self.file_path.unlink()
+        if self.save_dir.exists():
+            cli.remove_directory(self.save_dir)
+
+        return None
@@ -2,6 +2,7 @@
 Utility functions for the uploader.
 """
 
+import functools
 import logging
 from pathlib import Path
 from datetime import datetime
@@ -10,9 +11,11 @@ from uploader.helpers import cli
 from uploader.helpers.config import config
 
 
+@functools.lru_cache(maxsize=None)
 def get_config_file_path() -> Path:
     """
-    Returns the path to the config file.
+    Returns the path to the config file, resolved once per process (models
+    call this for every query they are not given a config file for).
 
     Returns:
         str: The path to the config file.
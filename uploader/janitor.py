@@ -0,0 +1,350 @@
+"""
+Removes abandoned uploads.
+
+An upload whose browser tab was closed mid-upload leaves its chunk directory
+(`chunk_path/<dz_uuid>`) behind, and in the 'direct' chunk mode or with tus,
+a partial file under the storage path. The janitor finds uploads that have
+been idle for longer than `[janitor] ttl` (or whose tus upload has expired)
+and removes them, deleting at most `max_deletes_per_s` files per second so
+that a large sweep does not starve uploads of disk I/O.
+
+It runs as a thread in each app process (`[janitor] mode=background`), or
+on its own with `uploader/scripts/janitor.py` (e.g. from cron). Sweeps are serialized with a
+lock file, so only one process sweeps at a time.
+"""
+
+import fcntl
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from uploader import orchestrator, storage
+from uploader.helpers import files, tus
+from uploader.helpers.admission import ReservationLedger
+from uploader.helpers.config import config
+from uploader.helpers.tus import TusUpload
+from uploader.models.finalize_job import FinalizeJob
+from uploader.models.uploaded_file import UploadedFile
+
+logger = logging.getLogger(__name__)
+
+LOCK_NAME = ".janitor.lock"
+
+
+@dataclass
+class JanitorReport:
+    """
+    Outcome of a janitor sweep.
+    """
+
+    uploads_scanned: int = 0
+    uploads_removed: int = 0
+    files_removed: int = 0
+    bytes_reclaimed: int = 0
+    errors: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"removed {self.uploads_removed}/{self.uploads_scanned} uploads, "
+            f"{self.files_removed} files, "
+            f"{self.bytes_reclaimed / (1024 * 1024):.2f} MB reclaimed, "
+            f"{self.errors} errors"
+        )
+
+
+def get_last_activity(save_dir: Path) -> float:
+    """
+    Returns when an upload last received data.
+
+    Args:
+        save_dir (Path): The chunk directory of the upload.
+
+    Returns:
+        float: The most recent modification time of the directory or any
+            file in it, as a timestamp.
+    """
+    last_activity = save_dir.stat().st_mtime
+    with os.scandir(save_dir) as entries:
+        for entry in entries:
+            try:
+                last_activity = max(last_activity, entry.stat().st_mtime)
+            except FileNotFoundError:
+                continue
+
+    return last_activity
+
+
+class Janitor:
+    """
+    Finds and removes abandoned uploads.
+
+    Attributes:
+        chunk_path (Path): The path uploaded chunks are stored in.
+        storage_path (Path): The path uploaded files are stored in.
+        ttl_s (int): Seconds of inactivity after which an upload is abandoned.
+        interval_s (int): Seconds between sweeps when running in the background.
+        max_deletes_per_s (int): The maximum number of files deleted per second.
+        storage_layout (Tuple[int, int]): The shard depth and width of the
+            storage path (see `files.get_shard_dir`).
+        config_file (Optional[Path]): The path to the config file.
+    """
+
+    def __init__(
+        self,
+        chunk_path: Path,
+        storage_path: Path,
+        ttl_s: int = 24 * 60 * 60,
+        interval_s: int = 60 * 60,
+        max_deletes_per_s: int = 100,
+        storage_layout: Tuple[int, int] = (0, 2),
+        config_file: Optional[Path] = None,
+    ):
+        self.chunk_path = chunk_path
+        self.storage_path = storage_path
+        self.ttl_s = ttl_s
+        self.interval_s = interval_s
+        self.max_deletes_per_s = max_deletes_per_s
+        self.storage_layout = storage_layout
+        self.config_file = config_file
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_delete = 0.0
+
+    def __repr__(self) -> str:
+        return f"<Janitor {self.chunk_path} ttl={self.ttl_s}s>"
+
+    @staticmethod
+    def from_config(config_file: Path) -> "Janitor":
+        """
+        Creates a Janitor from the `[janitor]` and `[upload]` sections of the
+        config file.
+
+        Args:
+            config_file (Path): The path to the config file.
+
+        Returns:
+            Janitor: The janitor.
+        """
+        try:
+            params = config(path=config_file, section="janitor")
+        except ValueError:
+            params = {}
+
+        return Janitor(
+            chunk_path=orchestrator.get_chunk_path(config_file=config_file),
+            storage_path=orchestrator.get_storage_path(config_file=config_file),
+            ttl_s=int(params.get("ttl", 24 * 60 * 60)),
+            interval_s=int(params.get("interval", 60 * 60)),
+            max_deletes_per_s=int(params.get("max_deletes_per_s", 100)),
+            storage_layout=orchestrator.get_storage_layout(config_file=config_file),
+            config_file=config_file,
+        )
+
+    def _delete(self, file_path: Path, report: JanitorReport) -> None:
+        # Spaces out deletes, unlinking large files is not free
+        if self.max_deletes_per_s > 0:
+            wait = self._last_delete + 1 / self.max_deletes_per_s - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._last_delete = time.monotonic()
+
+        try:
+            size = file_path.stat().st_blocks * 512
+            file_path.unlink()
+        except FileNotFoundError:
+            return None
+        report.files_removed += 1
+        report.bytes_reclaimed += size
+
+        return None
+
+    def _remove_tree(self, directory: Path, report: JanitorReport) -> None:
+        with os.scandir(directory) as entries:
+            children = [Path(entry.path) for entry in entries]
+        for child in children:
+            if child.is_dir() and not child.is_symlink():
+                self._remove_tree(child, report)
+            else:
+                self._delete(child, report)
+        directory.rmdir()
+
+        return None
+
+    def is_abandoned(self, save_dir: Path, now: float) -> bool:
+        """
+        Checks whether an upload has been abandoned.
+
+        Args:
+            save_dir (Path): The chunk directory of the upload.
+            now (float): The current time, as a timestamp.
+
+        Returns:
+            bool: True if the upload can be removed.
+        """
+        tus_upload = TusUpload.load(self.chunk_path, save_dir.name)
+        if tus_upload is not None:
+            # tus uploads announce when they expire
+            return tus_upload.is_expired
+
+        if now - get_last_activity(save_dir) < self.ttl_s:
+            return False
+
+        # Fully received, and waiting for (or being processed by) a finalizer
+        job = FinalizeJob.find_by_uuid_query(
+            dz_uuid=save_dir.name, config_file=self.config_file
+        )
+        if job is not None and job.status in ("queued", "running"):
+            return False
+
+        return True
+
+    def remove_upload(
+        self, save_dir: Path, partial_files: List[Path], report: JanitorReport
+    ) -> None:
+        """
+        Removes an abandoned upload: its chunk directory, and its partial
+        files under the storage path (or its unfinished upload to a remote
+        storage backend) unless the upload was registered.
+
+        Args:
+            save_dir (Path): The chunk directory of the upload.
+            partial_files (List[Path]): The upload's files under the storage path.
+            report (JanitorReport): The report to add the removed files to.
+        """
+        registered = UploadedFile.find_by_uuid_query(
+            uuid=save_dir.name, config_file=self.config_file
+        )
+
+        if registered is None:
+            upload_state = storage.read_upload_state(save_dir)
+            if upload_state is not None and upload_state["backend"] != "local":
+                backend = storage.get_backend(
+                    name=upload_state["backend"], config_file=self.config_file
+                )
+                logger.debug(f"Aborting upload of {upload_state['key']} to {backend}")
+                backend.abort(upload_state["key"], upload_state["upload_handle"])
+            for partial_file in partial_files:
+                logger.debug(f"Removing partial file {partial_file}")
+                self._delete(partial_file, report)
+
+        logger.debug(f"Removing abandoned upload {save_dir}")
+        self._remove_tree(save_dir, report)
+        ReservationLedger(self.chunk_path).release(save_dir.name)
+        report.uploads_removed += 1
+
+        return None
+
+    def _find_partial_files(self, dz_uuids: List[str]) -> Dict[str, List[Path]]:
+        # Files are named '<uuid>_<file name>', scan each shard directory once
+        shard_dirs: Dict[Path, Set[str]] = {}
+        for dz_uuid in dz_uuids:
+            try:
+                shard_dir = files.get_shard_dir(
+                    self.storage_path, dz_uuid, *self.storage_layout
+                )
+            except ValueError:
+                # Not an upload's directory, so it has no files in storage
+                continue
+            shard_dirs.setdefault(shard_dir, set()).add(dz_uuid)
+
+        partial_files: Dict[str, List[Path]] = {}
+        for shard_dir, shard_uuids in shard_dirs.items():
+            if not shard_dir.is_dir():
+                continue
+            with os.scandir(shard_dir) as entries:
+                for entry in entries:
+                    if entry.name[:36] in shard_uuids and entry.name[36:37] == "_":
+                        partial_files.setdefault(entry.name[:36], []).append(
+                            Path(entry.path)
+                        )
+
+        return partial_files
+
+    def sweep(self) -> JanitorReport:
+        """
+        Removes all abandoned uploads.
+
+        Returns:
+            JanitorReport: What was removed. Empty if another process is
+                already sweeping.
+        """
+        report = JanitorReport()
+
+        lock_fd = os.open(self.chunk_path / LOCK_NAME, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.debug("Another janitor is sweeping, skipping")
+                return report
+
+            now = time.time()
+            abandoned: List[Path] = []
+            with os.scandir(self.chunk_path) as entries:
+                for entry in entries:
+                    if not entry.is_dir():
+                        continue
+                    report.uploads_scanned += 1
+                    try:
+                        if self.is_abandoned(Path(entry.path), now):
+                            abandoned.append(Path(entry.path))
+                    except (OSError, ValueError) as e:
+                        logger.error(f"Cannot check {entry.path}: {e}")
+                        report.errors += 1
+
+            partial_files = self._find_partial_files(
+                [save_dir.name for save_dir in abandoned]
+            )
+            for save_dir in abandoned:
+                try:
+                    tus_upload = TusUpload.load(self.chunk_path, save_dir.name)
+                    if tus_upload is None:
+                        self.remove_upload(
+                            save_dir, partial_files.get(save_dir.name, []), report
+                        )
+                        continue
+                    # Skips uploads a client is writing to right now
+                    with tus_upload.lock():
+                        self.remove_upload(
+                            save_dir, partial_files.get(save_dir.name, []), report
+                        )
+                except tus.TusUploadLocked:
+                    continue
+                except (OSError, ValueError) as e:
+                    logger.error(f"Cannot remove {save_dir}: {e}")
+                    report.errors += 1
+        finally:
+            os.close(lock_fd)
+
+        logger.info(f"Janitor sweep: {report}")
+
+        return report
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            try:
+                self.sweep()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error(f"Janitor error: {e}")
+
+    def start(self) -> None:
+        """
+        Starts sweeping every `interval_s` seconds in the background.
+        """
+        self._thread = threading.Thread(target=self._run, name="janitor", daemon=True)
+        self._thread.start()
+
+        logger.info(f"Started janitor (every {self.interval_s}s, ttl {self.ttl_s}s)")
+
+    def stop(self) -> None:
+        """
+        Stops the background sweeps.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,291 @@
+"""
+Blob model
+"""
+
+import contextlib
+import fcntl
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator, Optional
+
+from uploader.helpers import db, durability, statements, utils
+from uploader.helpers.digest import parse_digest
+
+logger = logging.getLogger(__name__)
+
+BLOBS_DIR_NAME = "blobs"
+
+ADD_REFERENCE = statements.register(
+    "blobs_add_reference",
+    """
+    INSERT INTO blobs (digest, blob_path, size_bytes, ref_count, codec, original_size)
+    VALUES ($1, $2, $3, 1, $4, $5)
+    ON CONFLICT (digest) DO UPDATE
+    SET ref_count = blobs.ref_count + 1
+    RETURNING ref_count, codec, original_size
+    """,
+)
+RELEASE_REFERENCE = statements.register(
+    "blobs_release_reference",
+    """
+    UPDATE blobs
+    SET ref_count = ref_count - 1
+    WHERE digest = $1
+    RETURNING ref_count
+    """,
+)
+DELETE = statements.register("blobs_delete", "DELETE FROM blobs WHERE digest = $1")
+FIND_BY_DIGEST = statements.register(
+    "blobs_find_by_digest",
+    """
+    SELECT digest, blob_path, size_bytes, ref_count, codec, original_size,
+        created_at
+    FROM blobs
+    WHERE digest = $1
+    """,
+)
+
+
+class Blob:
+    """
+    Blob model.
+
+    A file in the content-addressed store, keyed by its digest and shared by
+    every UploadedFile with the same content. The blob is deleted from disk
+    when its last reference goes.
+
+    Attributes:
+        digest (str): The content digest of the blob.
+        blob_path (Path): The path to the blob.
+        size_bytes (int): The size of the blob in bytes.
+        ref_count (int): The number of UploadedFiles referencing the blob.
+        codec (Optional[str]): The codec the blob is compressed with, or None.
+        original_size (Optional[int]): The size of the content in bytes,
+            before compression, or None if it was not recorded.
+    """
+
+    def __init__(
+        self,
+        digest: str,
+        blob_path: Path,
+        size_bytes: int,
+        ref_count: int = 0,
+        codec: Optional[str] = None,
+        original_size: Optional[int] = None,
+        created_at: Optional[datetime] = None,
+    ):
+        self.digest = digest
+        self.blob_path = blob_path
+        self.size_bytes = size_bytes
+        self.ref_count = ref_count
+        self.codec = codec
+        self.original_size = original_size
+        self.created_at = created_at or datetime.now()
+
+    def __repr__(self):
+        return f"<Blob {self.digest} refs={self.ref_count}>"
+
+    def __str__(self):
+        return self.__repr__()
+
+    @staticmethod
+    def create_table_query() -> str:
+        """
+        Returns the SQL query to create the blobs table.
+
+        Returns:
+            str: The SQL query.
+        """
+
+        sql_query = """
+        CREATE TABLE IF NOT EXISTS blobs (
+            digest TEXT PRIMARY KEY,
+            blob_path TEXT NOT NULL,
+            size_bytes BIGINT NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            codec TEXT,
+            original_size BIGINT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+
+        return sql_query
+
+    @staticmethod
+    def drop_table_query() -> str:
+        """
+        Returns the SQL query to drop the blobs table.
+
+        Returns:
+            str: The SQL query.
+        """
+        sql_query = "DROP TABLE IF EXISTS blobs"
+
+        return sql_query
+
+    @staticmethod
+    def get_blob_path(blobs_path: Path, digest: str) -> Path:
+        """
+        Returns where the blob with the given digest is stored.
+
+        Blobs are spread over two levels of directories, keyed by the first
+        four hex digits of the digest.
+
+        Args:
+            blobs_path (Path): The root of the content-addressed store.
+            digest (str): The content digest.
+
+        Returns:
+            Path: The path to the blob.
+        """
+        label, value = parse_digest(digest)
+
+        return blobs_path / label / value[:2] / value[2:4] / value
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _locked(blob_path: Path) -> Iterator[None]:
+        # Serializes adding and removing references to the same blob, across
+        # processes, so a blob is never unlinked while it gains a reference
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(
+            blob_path.parent / f".{blob_path.name}.lock", os.O_RDWR | os.O_CREAT, 0o644
+        )
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def acquire(
+        digest: str,
+        file_path: Optional[Path],
+        blobs_path: Path,
+        codec: Optional[str] = None,
+        original_size: Optional[int] = None,
+        sync: bool = False,
+        config_file: Optional[Path] = None,
+    ) -> "Optional[Blob]":
+        """
+        Adds a reference to the blob with the given digest.
+
+        If the blob does not exist yet, `file_path` is hard-linked into the
+        store to become the blob. `file_path` itself is left in place; the
+        caller removes it once the reference is recorded.
+
+        The returned blob's codec is the one it was stored with, which may
+        differ from `codec` if the blob already existed.
+
+        Args:
+            digest (str): The content digest of the file.
+            file_path (Optional[Path]): The file with that content, or None to
+                only reference an existing blob.
+            blobs_path (Path): The root of the content-addressed store.
+            codec (Optional[str]): The codec `file_path` is compressed with.
+            original_size (Optional[int]): The size of the content in bytes,
+                before compression.
+            sync (bool): Whether to flush a new blob's directory entry to
+                stable storage before it is recorded.
+            config_file (Path): The path to the database configuration file.
+
+        Returns:
+            Optional[Blob]: The blob, or None if it does not exist and no
+                file was given.
+        """
+        if config_file is None:
+            config_file = utils.get_config_file_path()
+
+        blob_path = Blob.get_blob_path(blobs_path, digest)
+
+        with Blob._locked(blob_path):
+            if not blob_path.exists():
+                if file_path is None:
+                    return None
+                os.link(file_path, blob_path)
+                if sync:
+                    durability.sync_file(blob_path.parent)
+                logger.debug(f"Stored new blob {blob_path}")
+            elif file_path is not None:
+                logger.info(f"Deduplicated {file_path} into {blob_path}")
+
+            size_bytes = blob_path.stat().st_size
+            params = (digest, str(blob_path), size_bytes, codec or None, original_size)
+            result = db.execute_statements(
+                config_file=config_file, calls=[(ADD_REFERENCE, params)]
+            )
+
+        return Blob(
+            digest=digest,
+            blob_path=blob_path,
+            size_bytes=size_bytes,
+            ref_count=int(result[0][0][0]),
+            codec=result[0][0][1],
+            original_size=result[0][0][2],
+        )
+
+    def release(self, config_file: Optional[Path] = None) -> None:
+        """
+        Removes a reference to the blob, and deletes the blob when it was
+        the last one.
+
+        Args:
+            config_file (Path): The path to the database configuration file.
+        """
+        if config_file is None:
+            config_file = utils.get_config_file_path()
+
+        with Blob._locked(self.blob_path):
+            result = db.execute_statements(
+                config_file=config_file, calls=[(RELEASE_REFERENCE, (self.digest,))]
+            )
+            if not result[0]:
+                logger.warning(f"Releasing unknown blob {self.digest}")
+                return None
+
+            self.ref_count = int(result[0][0][0])
+            if self.ref_count <= 0:
+                db.execute_statements(
+                    config_file=config_file, calls=[(DELETE, (self.digest,))]
+                )
+                logger.info(f"Deleting unreferenced blob {self.blob_path}")
+                if self.blob_path.exists():
+                    self.blob_path.unlink()
+
+        return None
+
+    @staticmethod
+    def find_by_digest_query(
+        digest: str, config_file: Optional[Path] = None
+    ) -> "Optional[Blob]":
+        """
+        Returns the Blob with the given digest.
+
+        Args:
+            digest (str): The content digest.
+            config_file (Path): The path to the database configuration file.
+
+        Returns:
+            Optional[Blob]: The Blob with the given digest.
+        """
+        if config_file is None:
+            config_file = utils.get_config_file_path()
+
+        row = db.fetch_one(
+            config_file=config_file, query=FIND_BY_DIGEST, params=(digest,)
+        )
+
+        if row is None:
+            return None
+
+        return Blob(
+            digest=row["digest"],
+            blob_path=Path(row["blob_path"]),
+            size_bytes=int(row["size_bytes"]),
+            ref_count=int(row["ref_count"]),
+            codec=row["codec"],
+            original_size=row["original_size"],
+            created_at=row["created_at"],
+        )
@@ -0,0 +1,288 @@
+"""
+FinalizeJob model
+"""
+
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from uploader.helpers import db, statements, utils
+
+logger = logging.getLogger(__name__)
+
+# Re-queues the job if it already exists and failed, but leaves it alone if
+# it is queued, running or done, so that it never runs twice at once
+QUEUE = statements.register(
+    "finalize_jobs_queue",
+    """
+    INSERT INTO finalize_jobs (dz_uuid, job_data, status, queued_at)
+    VALUES ($1, $2, 'queued', $3)
+    ON CONFLICT (dz_uuid) DO UPDATE
+    SET job_data = EXCLUDED.job_data,
+        status = 'queued',
+        attempts = 0,
+        error = NULL,
+        queued_at = EXCLUDED.queued_at,
+        started_at = NULL,
+        finished_at = NULL
+    WHERE finalize_jobs.status = 'failed'
+    """,
+)
+CLAIM_NEXT = statements.register(
+    "finalize_jobs_claim_next",
+    """
+    UPDATE finalize_jobs
+    SET status = 'running',
+        attempts = attempts + 1,
+        started_at = CURRENT_TIMESTAMP
+    WHERE dz_uuid = (
+        SELECT dz_uuid
+        FROM finalize_jobs
+        WHERE status = 'queued'
+            OR (
+                status = 'running'
+                AND started_at < CURRENT_TIMESTAMP - make_interval(secs => $1)
+            )
+        ORDER BY queued_at
+        FOR UPDATE SKIP LOCKED
+        LIMIT 1
+    )
+    RETURNING dz_uuid, job_data, status, attempts, queued_at
+    """,
+)
+MARK_DONE = statements.register(
+    "finalize_jobs_mark_done",
+    """
+    UPDATE finalize_jobs
+    SET status = 'done', error = NULL, finished_at = CURRENT_TIMESTAMP
+    WHERE dz_uuid = $1
+    """,
+)
+MARK_FAILED = statements.register(
+    "finalize_jobs_mark_failed",
+    """
+    UPDATE finalize_jobs
+    SET status = $2,
+        error = $3,
+        finished_at = CURRENT_TIMESTAMP
+    WHERE dz_uuid = $1
+    """,
+)
+FIND_BY_UUID = statements.register(
+    "finalize_jobs_find_by_uuid",
+    """
+    SELECT dz_uuid, job_data, status, attempts, error, queued_at
+    FROM finalize_jobs
+    WHERE dz_uuid = $1
+    """,
+)
+
+
+class FinalizeJob:
+    """
+    FinalizeJob model.
+
+    A durable queue entry for an upload whose chunks have all been received,
+    and which is waiting to be assembled and registered as an UploadedFile.
+
+    Attributes:
+        dz_uuid (str): The Dropzone UUID of the upload.
+        job_data (Dict[str, Any]): What the finalizer needs to finish the upload.
+        status (str): One of 'queued', 'running', 'done' or 'failed'.
+        attempts (int): The number of times the job has been started.
+        error (Optional[str]): The error of the last failed attempt.
+        queued_at (datetime): The time at which the job was queued.
+    """
+
+    def __init__(
+        self,
+        dz_uuid: str,
+        job_data: Dict[str, Any],
+        status: str = "queued",
+        attempts: int = 0,
+        error: Optional[str] = None,
+        queued_at: Optional[datetime] = None,
+    ):
+        self.dz_uuid = dz_uuid
+        self.job_data = job_data
+        self.status = status
+        self.attempts = attempts
+        self.error = error
+        self.queued_at = queued_at or datetime.now()
+
+    def __repr__(self):
+        return f"<FinalizeJob {self.dz_uuid} {self.status}>"
+
+    def __str__(self):
+        return self.__repr__()
+
+    @staticmethod
+    def create_table_query() -> str:
+        """
+        Returns the SQL query to create the finalize_jobs table.
+
+        Returns:
+            str: The SQL query.
+        """
+
+        sql_query = """
+        CREATE TABLE IF NOT EXISTS finalize_jobs (
+            dz_uuid TEXT PRIMARY KEY,
+            job_data JSONB NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            queued_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        """
+
+        return sql_query
+
+    @staticmethod
+    def drop_table_query() -> str:
+        """
+        Returns the SQL query to drop the finalize_jobs table.
+
+        Returns:
+            str: The SQL query.
+        """
+        sql_query = "DROP TABLE IF EXISTS finalize_jobs"
+
+        return sql_query
+
+    def save(self, config_file: Optional[Path] = None) -> None:
+        """
+        Queues the job, or re-queues it if it already exists and failed.
+
+        Args:
+            config_file (Path): The path to the database configuration file.
+        """
+        if config_file is None:
+            config_file = utils.get_config_file_path()
+
+        params = (self.dz_uuid, json.dumps(self.job_data), self.queued_at)
+        db.execute_statements(config_file=config_file, calls=[(QUEUE, params)])
+
+        return None
+
+    @staticmethod
+    def claim_next(
+        stale_after_s: int, config_file: Optional[Path] = None
+    ) -> "Optional[FinalizeJob]":
+        """
+        Claims the oldest queued job, and marks it as running.
+
+        Jobs left 'running' for longer than `stale_after_s` (e.g. because the
+        worker died) are claimed again. Concurrent workers never claim the
+        same job.
+
+        Args:
+            stale_after_s (int): Seconds after which a running job is stale.
+            config_file (Path): The path to the database configuration file.
+
+        Returns:
+            Optional[FinalizeJob]: The claimed job, or None if the queue is empty.
+        """
+        if config_file is None:
+            config_file = utils.get_config_file_path()
+
+        result = db.execute_statements(
+            config_file=config_file, calls=[(CLAIM_NEXT, (int(stale_after_s),))]
+        )
+
+        if not result or not result[0]:
+            return None
+
+        dz_uuid, job_data, status, attempts, queued_at = result[0][0]
+        if isinstance(job_data, str):
+            job_data = json.loads(job_data)
+
+        return FinalizeJob(
+            dz_uuid=dz_uuid,
+            job_data=job_data,
+            status=status,
+            attempts=attempts,
+            queued_at=queued_at,
+        )
+
+    def mark_done(self, config_file: Optional[Path] = None) -> None:
+        """
+        Marks the job as done.
+
+        Args:
+            config_file (Path): The path to the database configuration file.
+        """
+        if config_file is None:
+            config_file = utils.get_config_file_path()
+
+        db.execute_statements(
+            config_file=config_file, calls=[(MARK_DONE, (self.dz_uuid,))]
+        )
+        self.status = "done"
+
+        return None
+
+    def mark_failed(
+        self, error: str, retry: bool, config_file: Optional[Path] = None
+    ) -> None:
+        """
+        Records a failed attempt, and re-queues the job if it can be retried.
+
+        Args:
+            error (str): The error message.
+            retry (bool): Whether to queue the job again.
+            config_file (Path): The path to the database configuration file.
+        """
+        if config_file is None:
+            config_file = utils.get_config_file_path()
+
+        self.status = "queued" if retry else "failed"
+        self.error = error
+
+        db.execute_statements(
+            config_file=config_file,
+            calls=[(MARK_FAILED, (self.dz_uuid, self.status, error))],
+        )
+
+        return None
+
+    @staticmethod
+    def find_by_uuid_query(
+        dz_uuid: str, config_file: Optional[Path] = None
+    ) -> "Optional[FinalizeJob]":
+        """
+        Returns the FinalizeJob for the given upload.
+
+        Args:
+            dz_uuid (str): The Dropzone UUID of the upload.
+            config_file (Path): The path to the database configuration file.
+
+        Returns:
+            Optional[FinalizeJob]: The job, or None if the upload was never queued.
+        """
+        if config_file is None:
+            config_file = utils.get_config_file_path()
+
+        row = db.fetch_one(
+            config_file=config_file, query=FIND_BY_UUID, params=(dz_uuid,)
+        )
+
+        if row is None:
+            return None
+
+        job_data = row["job_data"]
+        if isinstance(job_data, str):
+            job_data = json.loads(job_data)
+
+        return FinalizeJob(
+            dz_uuid=row["dz_uuid"],
+            job_data=job_data,
+            status=row["status"],
+            attempts=int(row["attempts"]),
+            error=row["error"],
+            queued_at=row["queued_at"],
+        )
@@ -2,11 +2,29 @@
 Submission model
 """
 
+import json
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
 
-from uploader.helpers import db, utils
+from uploader.helpers import db, statements, utils
+
+INSERT = statements.register(
+    "submissions_insert",
+    """
+    INSERT INTO submissions (uploaded_by, submission_data)
+    VALUES ($1, $2)
+    RETURNING id
+    """,
+)
+FIND_BY_ID = statements.register(
+    "submissions_find_by_id",
+    """
+    SELECT id, submission_data, uploaded_by, submission_timestamp
+    FROM submissions
+    WHERE id = $1
+    """,
+)
 
 
 class Submission:
@@ -71,22 +89,6 @@ class Submission:
 
         return sql_query
 
-    def insert_query(self) -> str:
-        """
-        Returns the SQL query to insert the submission into the submissions table.
-
-        Returns:
-            str: The SQL query.
-        """
-
-        sql_query = f"""
-        INSERT INTO submissions (uploaded_by, submission_data)
-        VALUES ('{self.uploaded_by}', '{db.sanitize_json(self.submission_data)}')
-        RETURNING id
-        """
-
-        return sql_query
-
     def save(self, config_file: Optional[Path] = None) -> int:
         """
         Saves the submission to the database.
@@ -100,10 +102,11 @@ class Submission:
         if not config_file:
             config_file = utils.get_config_file_path()
 
-        inserted_id = db.execute_insert_query(
-            config_file=config_file, query=self.insert_query()
+        result = db.execute_statements(
+            config_file=config_file,
+            calls=[(INSERT, (self.uploaded_by, json.dumps(self.submission_data)))],
         )
-        self.id = int(inserted_id)
+        self.id = int(result[0][0][0])
 
         return self.id
 
@@ -124,19 +127,22 @@ class Submission:
         if not config_file:
             config_file = utils.get_config_file_path()
 
-        query = f"SELECT * FROM submissions WHERE id = {submission_id}"
-        result_df = db.execute_sql(config_file=config_file, query=query)
+        row = db.fetch_one(
+            config_file=config_file, query=FIND_BY_ID, params=(submission_id,)
+        )
 
-        if result_df.empty:
+        if row is None:
             return None
 
+        submission_data = row["submission_data"] or {}
         submission = Submission(
-            subject_id=result_df["subject_id"].values[0],
-            data_type=result_df["data_type"].values[0],
-            event_name=result_df["event_name"].values[0],
-            uploaded_by=result_df["uploaded_by"].values[0],
+            subject_id=submission_data.get("subject_id"),
+            data_type=submission_data.get("data_type"),
+            event_name=submission_data.get("event_name"),
+            uploaded_by=row["uploaded_by"],
         )
 
         submission.id = submission_id
+        submission.submission_timestamp = row["submission_timestamp"]
 
         return submission
@@ -3,13 +3,64 @@ Model to map submitted files to submissions
 """
 
 from pathlib import Path
-from typing import Optional
+from typing import Any, Dict, List, Optional
 
-import pandas as pd
-
-from uploader.helpers import db, utils
+from uploader.helpers import cache, db, statements, utils
+from uploader.models import uploaded_file
 from uploader.models.uploaded_file import UploadedFile
 
+INSERT = statements.register(
+    "submitted_files_map_insert",
+    """
+    INSERT INTO submitted_files_map (submission_id, file_uuid)
+    VALUES ($1, $2)
+    """,
+)
+FIND_BY_USER = statements.register(
+    "submitted_files_map_find_by_user",
+    """
+    SELECT submissions.id AS submission_id, submissions.submission_data,
+        submissions.uploaded_by, uploaded_files.uuid, uploaded_files.file_name,
+        uploaded_files.file_size_mb, uploaded_files.uploaded_at
+    FROM submitted_files_map
+    LEFT JOIN submissions ON submissions.id = submitted_files_map.submission_id
+    LEFT JOIN uploaded_files ON uploaded_files."uuid" = submitted_files_map.file_uuid
+    WHERE submissions.uploaded_by = $1
+    ORDER BY uploaded_files.uploaded_at DESC
+    """,
+)
+FIND_BY_UUID = statements.register(
+    "submitted_files_map_find_by_uuid",
+    """
+    SELECT submissions.id AS submission_id, submissions.submission_data,
+        submissions.uploaded_by, uploaded_files.uuid, uploaded_files.file_name,
+        uploaded_files.file_size_mb, uploaded_files.uploaded_at
+    FROM submitted_files_map
+    LEFT JOIN submissions ON submissions.id = submitted_files_map.submission_id
+    LEFT JOIN uploaded_files ON uploaded_files."uuid" = submitted_files_map.file_uuid
+    WHERE uploaded_files.uuid = $1
+    """,
+)
+OWNS_DIGEST = statements.register(
+    "submitted_files_map_owns_digest",
+    """
+    SELECT 1
+    FROM submitted_files_map
+    JOIN submissions ON submissions.id = submitted_files_map.submission_id
+    JOIN uploaded_files ON uploaded_files."uuid" = submitted_files_map.file_uuid
+    WHERE submissions.uploaded_by = $1 AND uploaded_files.digest = $2
+    LIMIT 1
+    """,
+)
+DELETE_BY_UUID = statements.register(
+    "submitted_files_map_delete_by_uuid",
+    "DELETE FROM submitted_files_map WHERE file_uuid = $1",
+)
+DELETE_UPLOADED_FILE = statements.register(
+    "uploaded_files_delete_by_uuid",
+    "DELETE FROM uploaded_files WHERE uuid = $1",
+)
+
 
 class SubmittedFilesMap:
     """
@@ -64,21 +115,6 @@ class SubmittedFilesMap:
 
         return sql_query
 
-    def insert_query(self) -> str:
-        """
-        Returns the SQL query to insert the submitted files map into the submitted_files_map table.
-
-        Returns:
-            str: The SQL query.
-        """
-
-        sql_query = f"""
-        INSERT INTO submitted_files_map (submission_id, file_uuid)
-        VALUES ({self.submission_id}, '{self.file_uuid}')
-        """
-
-        return sql_query
-
     def save(self, config_file: Optional[Path] = None) -> None:
         """
         Saves the submitted files map to the database.
@@ -89,14 +125,17 @@ class SubmittedFilesMap:
         if not config_file:
             config_file = utils.get_config_file_path()
 
-        db.execute_queries(config_file=config_file, queries=[self.insert_query()])
+        db.execute_statements(
+            config_file=config_file,
+            calls=[(INSERT, (self.submission_id, self.file_uuid))],
+        )
 
         return None
 
     @staticmethod
     def get_files_submitted_by_user(
         user_name: str, config_file: Optional[Path] = None
-    ) -> pd.DataFrame:
+    ) -> List[Dict[str, Any]]:
         """
         Returns the files submitted by a user.
 
@@ -105,26 +144,22 @@ class SubmittedFilesMap:
             config_file (Optional[Path]): The path to the config file.
 
         Returns:
-            pd.DataFrame: The files submitted by the user.
+            List[Dict[str, Any]]: The files submitted by the user, newest first,
+                each with the columns of its submission and uploaded file.
         """
         if not config_file:
             config_file = utils.get_config_file_path()
 
-        query = f"""
-        SELECT submissions.*, uploaded_files.*
-        FROM submitted_files_map
-        LEFT JOIN submissions ON submissions.id = submitted_files_map.submission_id
-        LEFT JOIN uploaded_files ON uploaded_files."uuid" = submitted_files_map.file_uuid
-        WHERE submissions.uploaded_by = '{user_name}'
-        ORDER BY uploaded_files.uploaded_at DESC;
-        """
-
-        df = db.execute_sql(config_file=config_file, query=query)
+        rows = db.fetch_dicts(
+            config_file=config_file, query=FIND_BY_USER, params=(user_name,)
+        )
 
-        return df
+        return rows
 
     @staticmethod
-    def get_file_by_uuid(uuid: str, config_file: Optional[Path] = None) -> pd.DataFrame:
+    def get_file_by_uuid(
+        uuid: str, config_file: Optional[Path] = None
+    ) -> Optional[Dict[str, Any]]:
         """
         Returns the file by UUID.
 
@@ -133,53 +168,64 @@ class SubmittedFilesMap:
             config_file (Optional[Path]): The path to the config file.
 
         Returns:
-            pd.DataFrame: The file.
+            Optional[Dict[str, Any]]: The file, with the columns of its
+                submission and uploaded file, or None if not found.
         """
         if not config_file:
             config_file = utils.get_config_file_path()
 
-        query = f"""
-        SELECT submissions.*, uploaded_files.*
-        FROM submitted_files_map
-        LEFT JOIN submissions ON submissions.id = submitted_files_map.submission_id
-        LEFT JOIN uploaded_files ON uploaded_files."uuid" = submitted_files_map.file_uuid
-        WHERE uploaded_files.uuid = '{uuid}';
-        """
-
-        df = db.execute_sql(config_file=config_file, query=query)
+        row = db.fetch_one(
+            config_file=config_file, query=FIND_BY_UUID, params=(uuid,)
+        )
 
-        return df
+        return row
 
     @staticmethod
-    def delete(uuid: str, config_file: Optional[Path] = None) -> None:
+    def user_owns_digest(
+        user_name: str, digest: str, config_file: Optional[Path] = None
+    ) -> bool:
         """
-        Deletes the file by UUID.
+        Returns whether a user submitted a file with the given content digest.
 
         Args:
-            uuid (str): The UUID of the file.
+            user_name (str): The name of the user.
+            digest (str): The content digest.
             config_file (Optional[Path]): The path to the config file.
+
+        Returns:
+            bool: True if the user submitted such a file.
         """
         if not config_file:
             config_file = utils.get_config_file_path()
 
-        # Delete the file from disk
-        UploadedFile.delete_file(uuid=uuid)
+        row = db.fetch_one(
+            config_file=config_file, query=OWNS_DIGEST, params=(user_name, digest)
+        )
 
-        delete_queries = []
+        return row is not None
 
-        delete_submitted_files_map_query = f"""
-        DELETE FROM submitted_files_map
-        WHERE file_uuid = '{uuid}';
+    @staticmethod
+    def delete(uuid: str, config_file: Optional[Path] = None) -> None:
         """
+        Deletes the file by UUID.
 
-        delete_uploaded_files_query = f"""
-        DELETE FROM uploaded_files
-        WHERE uuid = '{uuid}';
+        Args:
+            uuid (str): The UUID of the file.
+            config_file (Optional[Path]): The path to the config file.
         """
+        if not config_file:
+            config_file = utils.get_config_file_path()
 
-        delete_queries.append(delete_submitted_files_map_query)
-        delete_queries.append(delete_uploaded_files_query)
-
-        db.execute_queries(config_file=config_file, queries=delete_queries)
+        # Delete the file from disk
+        UploadedFile.delete_file(uuid=uuid, config_file=config_file)
+
+        db.execute_statements(
+            config_file=config_file,
+            calls=[(DELETE_BY_UUID, (uuid,)), (DELETE_UPLOADED_FILE, (uuid,))]
+            + cache.invalidation_calls(
+                name=uploaded_file.CACHE, keys=[uuid], config_file=config_file
+            ),
+        )
+        cache.invalidate(name=uploaded_file.CACHE, keys=[uuid], config_file=config_file)
 
         return None
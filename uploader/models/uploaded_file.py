@@ -2,15 +2,41 @@
 UploadedFile model
 """
 
+import functools
 import logging
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
 
-from uploader.helpers import db, utils
+from uploader import storage
+from uploader.helpers import cache, db, statements, utils
+from uploader.models.blob import Blob
 
 logger = logging.getLogger(__name__)
 
+# The cache of the uploaded files found by UUID (see helpers/cache.py)
+CACHE = "uploaded_files"
+
+INSERT = statements.register(
+    "uploaded_files_insert",
+    """
+    INSERT INTO uploaded_files (
+        uuid, file_name, file_path,
+        file_size_mb, uploaded_at, digest, codec, storage, original_size
+    )
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+    """,
+)
+FIND_BY_UUID = statements.register(
+    "uploaded_files_find_by_uuid",
+    """
+    SELECT uuid, file_name, file_path, file_size_mb, uploaded_at, digest, codec,
+        storage, original_size
+    FROM uploaded_files
+    WHERE uuid = $1
+    """,
+)
+
 
 class UploadedFile:
     """
@@ -21,15 +47,42 @@ class UploadedFile:
         file_name (str): The name of the uploaded file.
         file_size (int): The size of the uploaded file.
         uploaded_at (datetime): The time at which the file was uploaded.
+        digest (Optional[str]): The content digest of the file, computed
+            while it was uploaded (see helpers/digest.py).
+        codec (Optional[str]): The codec the file is compressed with on disk,
+            or None if it is stored as uploaded (see helpers/compression.py).
+        storage (str): The storage backend the file is stored in, with
+            `file_path` as its key (see uploader/storage).
+        original_size (Optional[int]): The size of the file in bytes as it
+            was uploaded, before compression, or None if it was not recorded.
     """
 
-    def __init__(self, uuid: str, file_name: str, file_path: Path):
+    def __init__(
+        self,
+        uuid: str,
+        file_name: str,
+        file_path: Path,
+        digest: Optional[str] = None,
+        codec: Optional[str] = None,
+        storage: str = "local",
+        file_size: Optional[int] = None,
+        original_size: Optional[int] = None,
+    ):
         self.uuid = uuid
         self.file_name = file_name
         self.file_path = file_path
-        self.file_size_mb = round(file_path.stat().st_size / (1024 * 1024), 2)
-        created_time = file_path.stat().st_ctime
-        self.uploaded_at = datetime.fromtimestamp(created_time)
+        self.digest = digest
+        self.codec = codec
+        self.storage = storage
+        self.original_size = original_size
+        if file_size is None:
+            file_stat = file_path.stat()
+            self.file_size_mb = round(file_stat.st_size / (1024 * 1024), 2)
+            self.uploaded_at = datetime.fromtimestamp(file_stat.st_ctime)
+        else:
+            # Not on the local disk, or loaded from the database
+            self.file_size_mb = round(file_size / (1024 * 1024), 2)
+            self.uploaded_at = datetime.now()
 
     def __repr__(self):
         return f"<UploadedFile {self.file_name}>"
@@ -52,7 +105,11 @@ class UploadedFile:
             file_name TEXT NOT NULL,
             file_path TEXT NOT NULL,
             file_size_mb REAL NOT NULL,
-            uploaded_at TIMESTAMP NOT NULL
+            uploaded_at TIMESTAMP NOT NULL,
+            digest TEXT,
+            codec TEXT,
+            storage TEXT NOT NULL DEFAULT 'local',
+            original_size BIGINT
         )
         """
 
@@ -70,26 +127,6 @@ class UploadedFile:
 
         return sql_query
 
-    def insert_query(self) -> str:
-        """
-        Returns the SQL query to insert the uploaded file into the database.
-
-        Returns:
-            str: The SQL query.
-        """
-        sql_query = f"""
-        INSERT INTO uploaded_files (
-            uuid, file_name, file_path,
-            file_size_mb, uploaded_at
-        )
-        VALUES (
-            '{self.uuid}', '{self.file_name}', '{self.file_path}',
-            {self.file_size_mb}, '{self.uploaded_at}'
-        )
-        """
-
-        return sql_query
-
     def save(self, config_file: Optional[Path] = None) -> None:
         """
         Saves the uploaded file to the database.
@@ -100,7 +137,18 @@ class UploadedFile:
         if not config_file:
             config_file = utils.get_config_file_path()
 
-        db.execute_queries(config_file=config_file, queries=[self.insert_query()])
+        params = (
+            self.uuid,
+            self.file_name,
+            str(self.file_path),
+            self.file_size_mb,
+            self.uploaded_at,
+            self.digest or None,
+            self.codec or None,
+            self.storage,
+            self.original_size,
+        )
+        db.execute_statements(config_file=config_file, calls=[(INSERT, params)])
 
         return None
 
@@ -111,6 +159,9 @@ class UploadedFile:
         """
         Returns the UploadedFile with the given UUID.
 
+        The file's row is cached (see helpers/cache.py), and invalidated
+        when it is deleted (see SubmittedFilesMap.delete).
+
         Args:
             uuid (str): The UUID of the uploaded file.
             config_file (Path): The path to the database configuration file.
@@ -121,21 +172,37 @@ class UploadedFile:
         if config_file is None:
             config_file = utils.get_config_file_path()
 
-        sql_query = f"SELECT * FROM uploaded_files WHERE uuid = '{uuid}'"
-
-        df = db.execute_sql(config_file=config_file, query=sql_query)
+        row = cache.read_through(
+            name=CACHE,
+            key=uuid,
+            load=functools.partial(
+                db.fetch_one,
+                config_file=config_file,
+                query=FIND_BY_UUID,
+                params=(uuid,),
+            ),
+            config_file=config_file,
+        )
 
-        if df.empty:
+        if row is None:
             return None
 
         uploaded_file = UploadedFile(
-            uuid=df.iloc[0]["uuid"],
-            file_name=df.iloc[0]["file_name"],
-            file_path=Path(df.iloc[0]["file_path"]),
+            uuid=row["uuid"],
+            file_name=row["file_name"],
+            file_path=Path(row["file_path"]),
+            storage=row.get("storage") or "local",
+            file_size=0,
         )
 
-        uploaded_file.file_size_mb = df.iloc[0]["file_size_mb"]
-        uploaded_file.uploaded_at = datetime.fromisoformat(str(df.iloc[0]["uploaded_at"]))
+        uploaded_file.file_size_mb = row["file_size_mb"]
+        uploaded_file.uploaded_at = row["uploaded_at"]
+        if row.get("digest") is not None:
+            uploaded_file.digest = row["digest"]
+        if row.get("codec") is not None:
+            uploaded_file.codec = row["codec"]
+        if row.get("original_size") is not None:
+            uploaded_file.original_size = int(row["original_size"])
 
         return uploaded_file
 
@@ -144,6 +211,10 @@ class UploadedFile:
         """
         Deletes the uploaded file with the given UUID from disk.
 
+        Files in the content-addressed store drop their reference to the
+        blob instead, which is deleted when no other file references it.
+        Files in a remote storage backend are deleted from it.
+
         Use SubmittedFilesMap.delete to delete the file from the database.
 
         Args:
@@ -157,8 +228,26 @@ class UploadedFile:
             uuid=uuid, config_file=config_file
         )
 
-        if uploaded_file is not None:
-            logger.info(f"Deleting file {uploaded_file.file_path}")
-            uploaded_file.file_path.unlink()
+        if uploaded_file is None:
+            return None
+
+        if uploaded_file.digest is not None:
+            blob = Blob.find_by_digest_query(
+                digest=uploaded_file.digest, config_file=config_file
+            )
+            if blob is not None and blob.blob_path == uploaded_file.file_path:
+                # Shared with other files, only deleted with its last reference
+                blob.release(config_file=config_file)
+                return None
+
+        if uploaded_file.storage != "local":
+            backend = storage.get_backend(
+                name=uploaded_file.storage, config_file=config_file
+            )
+            backend.delete(str(uploaded_file.file_path))
+            return None
+
+        logger.info(f"Deleting file {uploaded_file.file_path}")
+        uploaded_file.file_path.unlink()
 
         return None
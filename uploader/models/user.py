@@ -2,6 +2,7 @@
 User model.
 """
 
+import functools
 import logging
 from pathlib import Path
 from typing import Optional
@@ -10,10 +11,38 @@ from datetime import datetime
 import flask_login
 import werkzeug.security
 
-from uploader.helpers import db, utils
+from uploader.helpers import cache, db, statements, utils
 
 logger = logging.getLogger(__name__)
 
+# The cache of the users found by email (see helpers/cache.py)
+CACHE = "users"
+
+INSERT = statements.register(
+    "users_insert",
+    """
+    INSERT INTO users (username, email, password_hash)
+    VALUES ($1, $2, $3)
+    """,
+)
+FIND_BY_USERNAME = statements.register(
+    "users_find_by_username",
+    """
+    SELECT username, email, password_hash, created_at
+    FROM users
+    WHERE username = $1
+    """,
+)
+FIND_BY_EMAIL = statements.register(
+    "users_find_by_email",
+    """
+    SELECT username, email, password_hash, created_at
+    FROM users
+    WHERE email = $1
+        AND is_active = TRUE
+    """,
+)
+
 
 class User(flask_login.UserMixin):
     """
@@ -98,23 +127,6 @@ class User(flask_login.UserMixin):
 
         return sql_query
 
-    def insert_query(self) -> str:
-        """
-        Returns the query to insert the user into the users table.
-
-        Returns:
-            str: The query to insert the user into the users table.
-        """
-
-        sanitized_email = self.email.strip().lower()
-
-        sql_query = f"""
-        INSERT INTO users (username, email, password_hash)
-        VALUES ('{self.username}', '{sanitized_email}', '{self.password}')
-        """
-
-        return sql_query
-
     def save(self, config_file: Optional[Path] = None) -> None:
         """
         Saves the user to the database.
@@ -125,7 +137,15 @@ class User(flask_login.UserMixin):
         if config_file is None:
             config_file = utils.get_config_file_path()
 
-        db.execute_queries(config_file=config_file, queries=[self.insert_query()])
+        normalized_email = self.email.strip().lower()
+        db.execute_statements(
+            config_file=config_file,
+            calls=[(INSERT, (self.username, normalized_email, self.password))]
+            + cache.invalidation_calls(
+                name=CACHE, keys=[normalized_email], config_file=config_file
+            ),
+        )
+        cache.invalidate(name=CACHE, keys=[normalized_email], config_file=config_file)
 
         logger.debug(f"User {self.email} saved to the database.")
         return None
@@ -147,20 +167,18 @@ class User(flask_login.UserMixin):
         if config_file is None:
             config_file = utils.get_config_file_path()
 
-        sql_query = f"""
-        SELECT * FROM users WHERE username = '{username}'
-        """
-
-        df = db.execute_sql(config_file=config_file, query=sql_query)
+        row = db.fetch_one(
+            config_file=config_file, query=FIND_BY_USERNAME, params=(username,)
+        )
 
-        if df.empty:
+        if row is None:
             return None
 
         user = User(
-            username=df.iloc[0]["username"],
-            email=df.iloc[0]["email"],
-            password=df.iloc[0]["password_hash"],
-            created_at=df.iloc[0]["created_at"],
+            username=row["username"],
+            email=row["email"],
+            password=row["password_hash"],
+            created_at=row["created_at"],
         )
 
         return user
@@ -172,6 +190,9 @@ class User(flask_login.UserMixin):
         """
         Returns User object if the user is found by email.
 
+        Looked up on each authenticated request, so the user's row is
+        cached (see helpers/cache.py).
+
         Args:
             email (str): The email of the user to find.
             config_file (Path): The path to the database configuration file.
@@ -182,23 +203,26 @@ class User(flask_login.UserMixin):
         if config_file is None:
             config_file = utils.get_config_file_path()
 
-        sql_query = f"""
-        SELECT *
-        FROM users
-        WHERE email = '{email}'
-            AND is_active = TRUE
-        """
-
-        df = db.execute_sql(config_file=config_file, query=sql_query)
+        row = cache.read_through(
+            name=CACHE,
+            key=email,
+            load=functools.partial(
+                db.fetch_one,
+                config_file=config_file,
+                query=FIND_BY_EMAIL,
+                params=(email,),
+            ),
+            config_file=config_file,
+        )
 
-        if df.empty:
+        if row is None:
             return None
 
         user = User(
-            username=df.iloc[0]["username"],
-            email=df.iloc[0]["email"],
-            password=df.iloc[0]["password_hash"],
-            created_at=df.iloc[0]["created_at"],
+            username=row["username"],
+            email=row["email"],
+            password=row["password_hash"],
+            created_at=row["created_at"],
         )
 
         return user
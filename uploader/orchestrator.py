@@ -3,6 +3,7 @@ Module to orchestrate the app.
 """
 
 from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
 
 from uploader.helpers.config import config
 
@@ -60,3 +61,431 @@ def get_chunk_path(config_file: Path) -> Path:
         chunk_path.mkdir(parents=True)
 
     return chunk_path
+
+
+def get_chunk_mode(config_file: Path) -> str:
+    """
+    Returns how uploaded chunks are written to disk.
+
+    - 'chunked': each chunk is saved to its own file under the chunk path,
+        and the chunks are concatenated once all of them are received.
+    - 'direct': the final file is preallocated under the storage path and
+        each chunk is written directly at its byte offset.
+
+    Args:
+        config_file (Path): The path to the config file.
+
+    Returns:
+        str: The chunk mode.
+
+    Raises:
+        ValueError: If the chunk mode is not supported.
+    """
+    config_params = config(path=config_file, section="upload")
+    chunk_mode = config_params.get("chunk_mode", "chunked")
+
+    if chunk_mode not in ("chunked", "direct"):
+        raise ValueError(f"Unsupported chunk mode: {chunk_mode}")
+
+    return chunk_mode
+
+
+def get_finalize_mode(config_file: Path) -> str:
+    """
+    Returns how uploads are finalized once all their chunks are received.
+
+    - 'inline': by the request that delivers the last chunk.
+    - 'background': by worker threads started in each app process.
+    - 'external': by a dedicated `scripts/finalizer.py` process.
+
+    Args:
+        config_file (Path): The path to the config file.
+
+    Returns:
+        str: The finalize mode.
+
+    Raises:
+        ValueError: If the finalize mode is not supported.
+    """
+    try:
+        config_params = config(path=config_file, section="finalize")
+    except ValueError:
+        config_params = {}
+    finalize_mode = config_params.get("mode", "inline")
+
+    if finalize_mode not in ("inline", "background", "external"):
+        raise ValueError(f"Unsupported finalize mode: {finalize_mode}")
+
+    return finalize_mode
+
+
+def get_tus_expiration(config_file: Path) -> int:
+    """
+    Returns the number of seconds after which an idle tus upload expires.
+
+    Args:
+        config_file (Path): The path to the config file.
+
+    Returns:
+        int: The expiration time in seconds.
+    """
+    config_params = config(path=config_file, section="upload")
+    tus_expiration = int(config_params.get("tus_expiration", 24 * 60 * 60))
+
+    return tus_expiration
+
+
+def get_digest_algorithm(config_file: Path) -> str:
+    """
+    Returns the algorithm used to compute content digests of uploads.
+
+    Args:
+        config_file (Path): The path to the config file.
+
+    Returns:
+        str: The digest algorithm, 'sha256' or 'blake2b'.
+
+    Raises:
+        ValueError: If the digest algorithm is not supported.
+    """
+    config_params = config(path=config_file, section="upload")
+    digest_algorithm = config_params.get("digest_algorithm", "sha256")
+
+    if digest_algorithm not in ("sha256", "blake2b"):
+        raise ValueError(f"Unsupported digest algorithm: {digest_algorithm}")
+
+    return digest_algorithm
+
+
+def get_dedupe(config_file: Path) -> bool:
+    """
+    Returns whether uploaded files are stored in the content-addressed store,
+    where files with the same content share a single blob.
+
+    Args:
+        config_file (Path): The path to the config file.
+
+    Returns:
+        bool: True if uploads are deduplicated.
+    """
+    config_params = config(path=config_file, section="upload")
+    dedupe = config_params.get("dedupe", "false").lower() in ("true", "yes", "1")
+
+    return dedupe
+
+
+def get_compression_codecs(config_file: Path) -> Dict[str, str]:
+    """
+    Returns the codec to compress uploaded files with, by data type.
+
+    Read from the `[compression]` section of the config file, which maps
+    data types (see `UploadForm.data_type`) to 'gzip' or 'zstd'. Data types
+    that are not listed are stored uncompressed.
+
+    Args:
+        config_file (Path): The path to the config file.
+
+    Returns:
+        Dict[str, str]: The codec for each compressed data type.
+
+    Raises:
+        ValueError: If a codec is not supported.
+    """
+    try:
+        config_params = config(path=config_file, section="compression")
+    except ValueError:
+        config_params = {}
+
+    codecs: Dict[str, str] = {}
+    for data_type, codec in config_params.items():
+        if codec not in ("gzip", "zstd"):
+            raise ValueError(f"Unsupported compression codec for {data_type}: {codec}")
+        codecs[data_type] = codec
+
+    return codecs
+
+
+def get_janitor_mode(config_file: Path) -> str:
+    """
+    Returns how abandoned uploads are cleaned up.
+
+    - 'off': only by running `scripts/janitor.py`.
+    - 'background': by a janitor thread started in each app process.
+
+    Args:
+        config_file (Path): The path to the config file.
+
+    Returns:
+        str: The janitor mode.
+
+    Raises:
+        ValueError: If the janitor mode is not supported.
+    """
+    try:
+        config_params = config(path=config_file, section="janitor")
+    except ValueError:
+        config_params = {}
+    janitor_mode = config_params.get("mode", "off")
+
+    if janitor_mode not in ("off", "background"):
+        raise ValueError(f"Unsupported janitor mode: {janitor_mode}")
+
+    return janitor_mode
+
+
+def get_storage_layout(config_file: Path) -> Tuple[int, int]:
+    """
+    Returns how uploaded files are spread over directories under the
+    storage path (see `files.get_shard_dir`).
+
+    Args:
+        config_file (Path): The path to the config file.
+
+    Returns:
+        Tuple[int, int]: The number of directory levels (0 for a flat
+            layout), and the number of UUID hex digits per level.
+
+    Raises:
+        ValueError: If the layout does not fit in the UUID's first group of
+            hex digits.
+    """
+    config_params = config(path=config_file, section="upload")
+    shard_depth = int(config_params.get("shard_depth", 0))
+    shard_width = int(config_params.get("shard_width", 2))
+
+    if shard_depth < 0 or shard_width < 1 or shard_depth * shard_width > 8:
+        raise ValueError(
+            f"Unsupported storage layout: {shard_depth} levels of {shard_width}"
+        )
+
+    return shard_depth, shard_width
+
+
+def get_storage_backend(config_file: Path) -> str:
+    """
+    Returns where uploaded files are stored (see `uploader/storage`).
+
+    - 'local': under the storage path.
+    - 's3': in the S3-compatible bucket from the `[s3]` section.
+
+    Args:
+        config_file (Path): The path to the config file.
+
+    Returns:
+        str: The name of the storage backend.
+
+    Raises:
+        ValueError: If the storage backend is not supported.
+    """
+    try:
+        config_params = config(path=config_file, section="storage")
+    except ValueError:
+        config_params = {}
+    backend = config_params.get("backend", "local")
+
+    if backend not in ("local", "s3"):
+        raise ValueError(f"Unsupported storage backend: {backend}")
+
+    return backend
+
+
+def get_admission_control(config_file: Path) -> Optional[Tuple[int, int]]:
+    """
+    Returns the settings of disk space admission control (see
+    `helpers/admission.py`), from the `[admission]` section.
+
+    Args:
+        config_file (Path): The path to the config file.
+
+    Returns:
+        Optional[Tuple[int, int]]: The bytes to always leave free, and the
+            seconds after which an idle upload's reservation expires. None
+            if admission control is disabled.
+    """
+    try:
+        config_params = config(path=config_file, section="admission")
+    except ValueError:
+        config_params = {}
+
+    enabled = config_params.get("enabled", "false").lower() in ("true", "yes", "1")
+    if not enabled:
+        return None
+
+    min_free = int(config_params.get("min_free", 1024)) * 1024 * 1024
+    reservation_ttl = int(config_params.get("reservation_ttl", 60 * 60))
+
+    return min_free, reservation_ttl
+
+
+def get_upload_limits(config_file: Path) -> Optional[Dict[str, float]]:
+    """
+    Returns the per-user upload limits (see `helpers/limits.py`), from the
+    `[limits]` section.
+
+    Args:
+        config_file (Path): The path to the config file.
+
+    Returns:
+        Optional[Dict[str, float]]: The 'max_concurrent' and
+            'max_concurrent_per_user' upload requests, and the 'bandwidth'
+            (bytes per second, 0 for no limit) and 'burst' (bytes) of each
+            user. None if uploads are not limited.
+    """
+    try:
+        config_params = config(path=config_file, section="limits")
+    except ValueError:
+        config_params = {}
+
+    enabled = config_params.get("enabled", "false").lower() in ("true", "yes", "1")
+    if not enabled:
+        return None
+
+    return {
+        "max_concurrent": int(config_params.get("max_concurrent", 8)),
+        "max_concurrent_per_user": int(
+            config_params.get("max_concurrent_per_user", 4)
+        ),
+        "bandwidth": float(config_params.get("bandwidth", 0)) * 1024 * 1024,
+        "burst": float(config_params.get("burst", 100)) * 1024 * 1024,
+    }
+
+
+def get_server_options(config_file: Path) -> Dict[str, Any]:
+    """
+    Returns how `uploader serve` runs the app, from the `[server]` section.
+
+    - 'gthread': worker processes, each serving requests on a pool of threads
+        (the default, as requests mostly wait on the network and the disk).
+    - 'sync': worker processes serving one request at a time.
+    - 'asgi': Uvicorn workers, receiving chunks on an event loop (see
+        `uploader/asgi.py`).
+
+    Options left out are None, and picked from the number of CPUs by
+    `uploader serve`.
+
+    Args:
+        config_file (Path): The path to the config file.
+
+    Returns:
+        Dict[str, Any]: The 'bind' address, 'worker_class', number of
+            'workers' and 'threads' (per worker), whether to 'preload' the
+            app before forking the workers, and the 'timeout',
+            'graceful_timeout' and 'keepalive' in seconds.
+
+    Raises:
+        ValueError: If the worker class is not supported.
+    """
+    try:
+        config_params = config(path=config_file, section="server")
+    except ValueError:
+        config_params = {}
+    flask_params = config(path=config_file, section="flask")
+
+    worker_class = config_params.get("worker_class", "gthread")
+    if worker_class not in ("gthread", "sync", "asgi"):
+        raise ValueError(f"Unsupported worker class: {worker_class}")
+
+    def get_int(key: str) -> Optional[int]:
+        value = config_params.get(key, "")
+        return int(value) if value else None
+
+    return {
+        "bind": config_params.get(
+            "bind", f"0.0.0.0:{flask_params.get('web_app_port', 15000)}"
+        ),
+        "worker_class": worker_class,
+        "workers": get_int("workers"),
+        "threads": get_int("threads"),
+        "preload": config_params.get("preload", "true").lower()
+        in ("true", "yes", "1"),
+        "timeout": get_int("timeout"),
+        "graceful_timeout": get_int("graceful_timeout"),
+        "keepalive": get_int("keepalive"),
+    }
+
+
+def get_chunking(config_file: Path) -> Dict[str, float]:
+    """
+    Returns how the upload form is told to chunk uploads (see
+    `helpers/ingest.py`), from the `[chunking]` section.
+
+    Args:
+        config_file (Path): The path to the config file.
+
+    Returns:
+        Dict[str, float]: The 'chunk_size' used until throughput is measured,
+            its 'min_chunk_size' and 'max_chunk_size' (all in bytes), the
+            seconds a chunk should take to send ('target_chunk_s'), the
+            seconds of measures to use ('window_s'), and the most requests a
+            client sends at once ('max_connections'), and for one file
+            ('max_chunk_concurrency').
+    """
+    try:
+        config_params = config(path=config_file, section="chunking")
+    except ValueError:
+        config_params = {}
+
+    return {
+        "chunk_size": float(config_params.get("chunk_size", 10)) * 1024 * 1024,
+        "min_chunk_size": float(config_params.get("min_chunk_size", 4)) * 1024 * 1024,
+        "max_chunk_size": float(config_params.get("max_chunk_size", 64)) * 1024 * 1024,
+        "target_chunk_s": float(config_params.get("target_chunk_time", 5)),
+        "window_s": int(config_params.get("window", 300)),
+        "max_connections": int(config_params.get("max_connections", 6)),
+        "max_chunk_concurrency": int(config_params.get("max_chunk_concurrency", 3)),
+    }
+
+
+def get_durability(config_file: Path) -> Dict[str, Any]:
+    """
+    Returns how uploaded data is flushed to stable storage (see
+    `helpers/durability.py`).
+
+    - 'none': never.
+    - 'finalize': each file, before it is registered.
+    - 'chunk': each chunk too, before it is acknowledged.
+
+    Args:
+        config_file (Path): The path to the config file.
+
+    Returns:
+        Dict[str, Any]: The durability 'mode', whether concurrent flushes of
+            a file are grouped ('group_commit'), and the seconds a grouped
+            flush waits for others to join it ('group_commit_delay_s').
+
+    Raises:
+        ValueError: If the durability mode is not supported.
+    """
+    config_params = config(path=config_file, section="upload")
+    mode = config_params.get("durability", "none")
+
+    if mode not in ("none", "finalize", "chunk"):
+        raise ValueError(f"Unsupported durability mode: {mode}")
+
+    return {
+        "mode": mode,
+        "group_commit": config_params.get("group_commit", "true").lower()
+        in ("true", "yes", "1"),
+        "group_commit_delay_s": float(config_params.get("group_commit_delay", 0))
+        / 1000,
+    }
+
+
+def get_drop_cache_above(config_file: Path) -> Optional[int]:
+    """
+    Returns the size from which uploaded files are kept out of the page cache
+    when they are written and read (see `helpers/pagecache.py`).
+
+    Args:
+        config_file (Path): The path to the config file.
+
+    Returns:
+        Optional[int]: The size in bytes, or None to cache files of any size.
+    """
+    config_params = config(path=config_file, section="upload")
+    drop_cache_above = float(config_params.get("drop_cache_above", 256))
+
+    if drop_cache_above <= 0:
+        return None
+
+    return int(drop_cache_above * 1024 * 1024)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""
+Measures the throughput cost of each durability mode (see
+`helpers/durability.py`), on the disk of a given directory.
+
+Concurrent writers receive the chunks of one file, 'direct' style: each
+chunk is written at its offset into a preallocated file, in blocks of the
+size the multipart parser hands out, then flushed as the mode asks:
+- 'none': never.
+- 'finalize': the file, once, after all its chunks are written.
+- 'chunk': also each chunk, by its own writer.
+- 'chunk, group commit': each chunk, grouped with concurrent writers.
+- 'chunk, group commit, delay': same, the leader waiting `--delay` ms for
+    other writers to join.
+
+`--flush-latency` adds a sleep to every flush, served one flush at a time,
+to see how the modes fare on a disk with slower flushes than the one at hand.
+
+Does not need a config file or a database.
+"""
+
+import sys
+from pathlib import Path
+
+file = Path(__file__)
+parent = file.parent
+ROOT = None
+for parent in file.parents:
+    if parent.name == "ChunkChariot":
+        ROOT = parent
+sys.path.append(str(ROOT))
+
+import argparse
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+from uploader.helpers import durability, files, multipart
+
+MODULE_NAME = "bench_durability"
+
+logger = logging.getLogger(MODULE_NAME)
+logargs = {
+    "level": logging.INFO,
+    "format": "%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s",
+}
+logging.basicConfig(**logargs)
+
+MB = 1024 * 1024
+
+
+class Flusher:
+    """
+    Flushes files like `durability._flush`, counting the flushes, and
+    optionally emulating a disk whose flushes take `latency_s` seconds
+    longer. Like cache flushes sent to one device, the emulated flushes are
+    served one at a time.
+    """
+
+    def __init__(self, latency_s: float = 0.0):
+        self.latency_s = latency_s
+        self.count = 0
+        self._device = threading.Lock()
+
+    def __call__(self, path: Path, is_dir: bool = False) -> None:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if is_dir:
+                os.fsync(fd)
+            else:
+                os.fdatasync(fd)
+        finally:
+            os.close(fd)
+        if self.latency_s > 0:
+            with self._device:
+                time.sleep(self.latency_s)
+        self.count += 1
+
+
+def run(
+    directory: Path,
+    file_size: int,
+    chunk_size: int,
+    writers: int,
+    mode: str,
+    flusher: Flusher,
+    delay_s: float = 0.0,
+) -> Dict[str, float]:
+    """
+    Uploads one file, and measures its throughput.
+
+    Args:
+        directory (Path): Where to write the file.
+        file_size (int): The size of the file in bytes.
+        chunk_size (int): The size of each chunk in bytes.
+        writers (int): The number of concurrent writers.
+        mode (str): 'none', 'finalize', 'chunk' (ungrouped) or 'group'.
+        flusher (Flusher): Flushes the file.
+        delay_s (float): Seconds a group commit leader waits for others.
+
+    Returns:
+        Dict[str, float]: The 'throughput' in MB/s, the 'seconds' taken, and
+            the number of 'flushes' made per chunk.
+    """
+    file_path = directory / "bench.bin"
+    files.preallocate_file(file_path, file_size)
+    durability.sync_new_file(file_path)
+
+    chunk_count = (file_size + chunk_size - 1) // chunk_size
+    next_chunk = [0]
+    lock = threading.Lock()
+    block = os.urandom(multipart.READ_SIZE)
+    committer = durability.GroupCommitter(flush=flusher)
+    flusher.count = 0
+
+    def write_chunks() -> None:
+        while True:
+            with lock:
+                index = next_chunk[0]
+                next_chunk[0] += 1
+            if index >= chunk_count:
+                return
+            offset = index * chunk_size
+            length = min(chunk_size, file_size - offset)
+            writer = files.OffsetWriter(file_path, offset, limit=length)
+            while writer.written < length:
+                writer.write(block[: length - writer.written])
+            writer.close()
+            if mode == "chunk":
+                flusher(file_path)
+            elif mode == "group":
+                committer.sync(file_path, delay_s=delay_s)
+
+    started_at = time.monotonic()
+    threads = [threading.Thread(target=write_chunks) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    chunk_flushes = flusher.count
+    if mode != "none":
+        flusher(file_path)
+        flusher(directory, True)
+    seconds = time.monotonic() - started_at
+
+    file_path.unlink()
+
+    return {
+        "throughput": file_size / MB / seconds,
+        "seconds": seconds,
+        "flushes": chunk_flushes / chunk_count,
+    }
+
+
+def benchmark(
+    directory: Path,
+    file_size: int,
+    chunk_size: int,
+    writers: int,
+    delay_s: float,
+    latency_s: float,
+    rounds: int,
+) -> List[List[str]]:
+    """
+    Runs every durability mode `rounds` times, and keeps the median run.
+
+    Returns:
+        List[List[str]]: The rows of the results table.
+    """
+    modes = [
+        ("none", "none", 0.0),
+        ("finalize", "finalize", 0.0),
+        ("chunk", "chunk", 0.0),
+        ("chunk, group commit", "group", 0.0),
+        (f"chunk, group commit, {delay_s * 1000:g} ms delay", "group", delay_s),
+    ]
+    flusher = Flusher(latency_s=latency_s)
+
+    rows: List[List[str]] = []
+    baseline = None
+    for name, mode, mode_delay_s in modes:
+        results = sorted(
+            (
+                run(
+                    directory,
+                    file_size,
+                    chunk_size,
+                    writers,
+                    mode,
+                    flusher,
+                    delay_s=mode_delay_s,
+                )
+                for _ in range(rounds)
+            ),
+            key=lambda result: result["throughput"],
+        )
+        result = results[len(results) // 2]
+        if baseline is None:
+            baseline = result["throughput"]
+        rows.append(
+            [
+                name,
+                f"{result['throughput']:.0f}",
+                f"{result['throughput'] / baseline:.0%}",
+                f"{result['flushes']:.2f}" if mode in ("chunk", "group") else "-",
+            ]
+        )
+        logger.info(f"{name}: {result['throughput']:.0f} MB/s")
+
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the throughput cost of each durability mode."
+    )
+    parser.add_argument(
+        "--dir", type=Path, default=None, help="directory on the disk to measure"
+    )
+    parser.add_argument("--size", type=int, default=512, help="file size in MB")
+    parser.add_argument("--chunk-size", type=int, default=8, help="chunk size in MB")
+    parser.add_argument("--writers", type=int, default=4, help="concurrent writers")
+    parser.add_argument(
+        "--delay", type=float, default=2, help="group commit delay in ms"
+    )
+    parser.add_argument(
+        "--flush-latency",
+        type=float,
+        default=0,
+        help="ms added to each flush, to emulate a slower disk",
+    )
+    parser.add_argument("--rounds", type=int, default=3, help="runs of each mode")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as bench_dir:
+        table = benchmark(
+            directory=Path(bench_dir),
+            file_size=args.size * MB,
+            chunk_size=args.chunk_size * MB,
+            writers=args.writers,
+            delay_s=args.delay / 1000,
+            latency_s=args.flush_latency / 1000,
+            rounds=args.rounds,
+        )
+
+    print(
+        f"\n{args.size} MB file, {args.chunk_size} MB chunks, "
+        f"{args.writers} writers, {args.flush_latency:g} ms added per flush\n"
+    )
+    print("| Mode | MB/s | vs none | Flushes per chunk |")
+    print("| --- | ---: | ---: | ---: |")
+    for row in table:
+        print("| " + " | ".join(row) + " |")
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+"""
+Measures how receiving and sending a large upload affects other data in the
+page cache, with and without dropping the upload from the cache (see
+`helpers/pagecache.py`).
+
+Another workload on the node is stood in for by a 'hot' file, read (once by
+default) into the cache, then read at random offsets while a large file is
+uploaded (written in chunks at their offsets, 'direct' style) and
+downloaded (read front to back), and by small writes committed to a log
+file with `fdatasync`, as a database would. Reported, per mode:
+- the upload and download throughput.
+- the latency of the random reads and of the commits during the transfers.
+- how much of the hot file is still cached afterwards, and how long reading
+    it all again takes.
+
+Make the upload larger than the memory available for the page cache (see
+`free -m`), or the kernel has no reason to evict anything.
+
+Does not need a config file or a database.
+"""
+
+import sys
+from pathlib import Path
+
+file = Path(__file__)
+parent = file.parent
+ROOT = None
+for parent in file.parents:
+    if parent.name == "ChunkChariot":
+        ROOT = parent
+sys.path.append(str(ROOT))
+
+import argparse
+import ctypes
+import ctypes.util
+import logging
+import mmap
+import os
+import random
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from uploader.helpers import files, multipart, pagecache
+
+MODULE_NAME = "bench_pagecache"
+
+logger = logging.getLogger(MODULE_NAME)
+logargs = {
+    "level": logging.INFO,
+    "format": "%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s",
+}
+logging.basicConfig(**logargs)
+
+MB = 1024 * 1024
+PAGE_SIZE = mmap.PAGESIZE
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+
+def get_cached_fraction(file_path: Path) -> Optional[float]:
+    """
+    Returns the fraction of a file's pages that are in the page cache.
+
+    Args:
+        file_path (Path): The path to the file.
+
+    Returns:
+        Optional[float]: The fraction, or None if `mincore` is not available.
+    """
+    if not hasattr(_libc, "mincore"):
+        return None
+
+    size = file_path.stat().st_size
+    pages = (size + PAGE_SIZE - 1) // PAGE_SIZE
+    with open(file_path, "rb") as f:
+        mapping = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_COPY)
+        try:
+            address = ctypes.c_char.from_buffer(mapping)
+            vector = (ctypes.c_ubyte * pages)()
+            result = _libc.mincore(
+                ctypes.c_void_p(ctypes.addressof(address)),
+                ctypes.c_size_t(size),
+                vector,
+            )
+            del address
+        finally:
+            mapping.close()
+    if result != 0:
+        return None
+
+    return sum(page & 1 for page in vector) / pages
+
+
+def read_all(file_path: Path) -> float:
+    """
+    Reads a whole file, and returns the seconds it took.
+    """
+    started_at = time.monotonic()
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        while os.read(fd, files.BUFFER_SIZE):
+            pass
+    finally:
+        os.close(fd)
+
+    return time.monotonic() - started_at
+
+
+class Neighbour(threading.Thread):
+    """
+    Stands in for another workload on the node: reads pages of the hot file
+    at random, and commits small writes to a log file (as a database
+    would), recording how long each read and each commit takes.
+    """
+
+    def __init__(self, hot_path: Path, log_path: Path, interval_s: float = 0.001):
+        super().__init__(daemon=True)
+        self.hot_path = hot_path
+        self.log_path = log_path
+        self.interval_s = interval_s
+        self.reads: List[float] = []
+        self.commits: List[float] = []
+        self._done = threading.Event()
+
+    def run(self) -> None:
+        pages = self.hot_path.stat().st_size // PAGE_SIZE
+        record = os.urandom(PAGE_SIZE)
+        hot_fd = os.open(self.hot_path, os.O_RDONLY)
+        log_fd = os.open(self.log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        try:
+            while not self._done.is_set():
+                started_at = time.monotonic()
+                os.pread(hot_fd, PAGE_SIZE, random.randrange(pages) * PAGE_SIZE)
+                self.reads.append(time.monotonic() - started_at)
+
+                started_at = time.monotonic()
+                os.write(log_fd, record)
+                os.fdatasync(log_fd)
+                self.commits.append(time.monotonic() - started_at)
+
+                time.sleep(self.interval_s)
+        finally:
+            os.close(hot_fd)
+            os.close(log_fd)
+
+    def stop(self) -> None:
+        self._done.set()
+        self.join()
+        self.reads.sort()
+        self.commits.sort()
+
+
+def upload(
+    file_path: Path, file_size: int, chunk_size: int, drop_cache_above: Optional[int]
+) -> float:
+    """
+    Writes a file in chunks, as the uploads of its chunks would, and returns
+    the seconds it took.
+    """
+    block = os.urandom(multipart.READ_SIZE)
+    started_at = time.monotonic()
+    files.preallocate_file(file_path, file_size)
+    for offset in range(0, file_size, chunk_size):
+        length = min(chunk_size, file_size - offset)
+        writer = files.OffsetWriter(
+            file_path, offset, limit=length, drop_cache_above=drop_cache_above
+        )
+        while writer.written < length:
+            writer.write(block[: length - writer.written])
+        writer.close()
+    if drop_cache_above is not None:
+        # As the finalizer does
+        pagecache.drop_file(file_path)
+
+    return time.monotonic() - started_at
+
+
+def download(file_path: Path, drop_cache: bool) -> float:
+    """
+    Reads a file front to back, as a download would, and returns the seconds
+    it took.
+    """
+    started_at = time.monotonic()
+    if drop_cache:
+        stream = pagecache.SequentialReader(file_path, drop_cache=True)
+    else:
+        stream = open(file_path, "rb", buffering=0)  # type: ignore
+    try:
+        while stream.read(files.BUFFER_SIZE):
+            pass
+    finally:
+        stream.close()
+
+    return time.monotonic() - started_at
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """
+    Returns a percentile of sorted values.
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(
+    directory: Path,
+    hot_path: Path,
+    file_size: int,
+    chunk_size: int,
+    drop_cache: bool,
+    hot_reads: int = 1,
+) -> Dict[str, float]:
+    """
+    Uploads and downloads a file while the neighbouring workload runs.
+
+    Returns:
+        Dict[str, float]: The measures.
+    """
+    # Read more than once, the kernel protects the hot file from eviction
+    pagecache.drop_file(hot_path)
+    for _ in range(hot_reads):
+        read_all(hot_path)
+
+    neighbour = Neighbour(hot_path, directory / "log.bin")
+    neighbour.start()
+    file_path = directory / "upload.bin"
+    upload_s = upload(
+        file_path, file_size, chunk_size, drop_cache_above=1 if drop_cache else None
+    )
+    download_s = download(file_path, drop_cache=drop_cache)
+    neighbour.stop()
+    file_path.unlink()
+    (directory / "log.bin").unlink()
+
+    cached = get_cached_fraction(hot_path)
+    reread_s = read_all(hot_path)
+
+    return {
+        "upload": file_size / MB / upload_s,
+        "download": file_size / MB / download_s,
+        "read_p99": percentile(neighbour.reads, 0.99) * 1e3,
+        "commit_p50": percentile(neighbour.commits, 0.5) * 1e3,
+        "commit_p99": percentile(neighbour.commits, 0.99) * 1e3,
+        "cached": -1.0 if cached is None else cached,
+        "reread": reread_s,
+    }
+
+
+def benchmark(
+    directory: Path, hot_size: int, hot_reads: int, file_size: int, chunk_size: int
+) -> List[List[str]]:
+    """
+    Runs the transfer with the page cache left alone, then with the upload
+    dropped from it.
+
+    Returns:
+        List[List[str]]: The rows of the results table.
+    """
+    hot_path = directory / "hot.bin"
+    with open(hot_path, "wb") as f:
+        for _ in range(hot_size // MB):
+            f.write(os.urandom(MB))
+
+    rows: List[List[str]] = []
+    for name, drop_cache in (("cached", False), ("dropped", True)):
+        result = run(
+            directory, hot_path, file_size, chunk_size, drop_cache, hot_reads
+        )
+        cached = "-" if result["cached"] < 0 else f"{result['cached']:.0%}"
+        rows.append(
+            [
+                name,
+                f"{result['upload']:.0f}",
+                f"{result['download']:.0f}",
+                f"{result['read_p99']:.2f}",
+                f"{result['commit_p50']:.2f} / {result['commit_p99']:.2f}",
+                cached,
+                f"{result['reread']:.2f}",
+            ]
+        )
+        logger.info(f"{name}: {result}")
+    hot_path.unlink()
+
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure how large uploads affect the page cache."
+    )
+    parser.add_argument(
+        "--dir", type=Path, default=None, help="directory on the disk to measure"
+    )
+    parser.add_argument("--hot-size", type=int, default=1024, help="hot file in MB")
+    parser.add_argument(
+        "--hot-reads", type=int, default=1, help="times the hot file is read first"
+    )
+    parser.add_argument("--size", type=int, default=8192, help="upload size in MB")
+    parser.add_argument("--chunk-size", type=int, default=8, help="chunk size in MB")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as bench_dir:
+        table = benchmark(
+            directory=Path(bench_dir),
+            hot_size=args.hot_size * MB,
+            hot_reads=args.hot_reads,
+            file_size=args.size * MB,
+            chunk_size=args.chunk_size * MB,
+        )
+
+    print(
+        f"\n{args.size} MB upload in {args.chunk_size} MB chunks, "
+        f"{args.hot_size} MB hot file read {args.hot_reads} time(s)\n"
+    )
+    print(
+        "| Upload | Upload MB/s | Download MB/s | Hot read p99 (ms) "
+        "| Commit p50 / p99 (ms) | Hot file cached after | Hot file read after (s) |"
+    )
+    print("| --- | ---: | ---: | ---: | ---: | ---: | ---: |")
+    for row in table:
+        print("| " + " | ".join(row) + " |")
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""
+Measures the latency of the queries behind each login (looking a user up by
+email) and the history page (a user's files), run three ways (see
+`helpers/statements.py`):
+- 'inline': with the values formatted into the SQL, as the models used to.
+- 'parameters': with bind parameters, unprepared.
+- 'prepared': prepared once per pooled connection, then executed.
+
+Runs against the database of the config file, read only. The user looked up
+is the one with the most files, unless given.
+"""
+
+import sys
+from pathlib import Path
+
+file = Path(__file__)
+parent = file.parent
+ROOT = None
+for parent in file.parents:
+    if parent.name == "ChunkChariot":
+        ROOT = parent
+sys.path.append(str(ROOT))
+
+import argparse
+import functools
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import psycopg2.extensions
+
+from uploader.helpers import db, utils
+from uploader.helpers.statements import Statement
+from uploader.models import submitted_files_map, user
+
+MODULE_NAME = "bench_statements"
+
+logger = logging.getLogger(MODULE_NAME)
+logargs = {
+    "level": logging.INFO,
+    "format": "%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s",
+}
+logging.basicConfig(**logargs)
+
+
+def inline(statement: Statement, params: Sequence[Any]) -> str:
+    """
+    Returns the SQL of a statement with its values formatted in.
+    """
+    sql, order = statement.unprepared_query()
+    values = tuple(
+        psycopg2.extensions.adapt(params[index]).getquoted().decode("utf-8")
+        for index in order
+    )
+
+    return sql.replace("%%", "%") % values if values else sql
+
+
+def find_user(config_file: Path) -> Optional[Tuple[str, str]]:
+    """
+    Returns the username and email of the user with the most files.
+    """
+    rows = db.fetch_rows(
+        config_file=config_file,
+        query="""
+        SELECT users.username, users.email
+        FROM submitted_files_map
+        JOIN submissions ON submissions.id = submitted_files_map.submission_id
+        JOIN users ON users.username = submissions.uploaded_by
+        GROUP BY users.username, users.email
+        ORDER BY count(*) DESC
+        LIMIT 1
+        """,
+    )
+    if not rows:
+        return None
+
+    return rows[0][0], rows[0][1]
+
+
+def measure(
+    ways: Dict[str, Callable[[], Any]], iterations: int
+) -> Dict[str, List[float]]:
+    """
+    Runs each way of a query in turn, so that they share any drift in the
+    load of the host, and returns their sorted latencies in milliseconds.
+    """
+    latencies: Dict[str, List[float]] = {way: [] for way in ways}
+    # Once first, so every way starts with a connection (and a plan) at hand
+    for query in ways.values():
+        query()
+    for _ in range(iterations):
+        for way, query in ways.items():
+            started_at = time.perf_counter()
+            query()
+            latencies[way].append((time.perf_counter() - started_at) * 1e3)
+
+    return {way: sorted(values) for way, values in latencies.items()}
+
+
+def benchmark(
+    config_file: Path, username: str, email: str, iterations: int
+) -> List[List[str]]:
+    """
+    Runs the lookups every way.
+
+    Returns:
+        List[List[str]]: The rows of the results table.
+    """
+    lookups: Dict[str, Tuple[Statement, Sequence[Any]]] = {
+        "user by email": (user.FIND_BY_EMAIL, (email,)),
+        "history": (submitted_files_map.FIND_BY_USER, (username,)),
+    }
+
+    rows: List[List[str]] = []
+    for name, (statement, params) in lookups.items():
+        sql, order = statement.unprepared_query()
+        ordered = [params[index] for index in order]
+        ways: Dict[str, Callable[[], Any]] = {
+            "inline": functools.partial(
+                db.fetch_dicts, config_file, inline(statement, params)
+            ),
+            "parameters": functools.partial(db.fetch_dicts, config_file, sql, ordered),
+            "prepared": functools.partial(
+                db.fetch_dicts, config_file, statement, params
+            ),
+        }
+        result_count = len(ways["prepared"]())
+        for way, latencies in measure(ways, iterations).items():
+            p50 = latencies[len(latencies) // 2]
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            rows.append([name, str(result_count), way, f"{p50:.3f}", f"{p99:.3f}"])
+            logger.info(f"{name}, {way}: p50 {p50:.3f} ms, p99 {p99:.3f} ms")
+
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the latency of the login and history queries."
+    )
+    parser.add_argument("--username", type=str, default=None, help="user to look up")
+    parser.add_argument("--email", type=str, default=None, help="email to look up")
+    parser.add_argument(
+        "--iterations", type=int, default=2000, help="runs of each query, each way"
+    )
+    args = parser.parse_args()
+
+    config_file = utils.get_config_file_path()
+
+    username, email = args.username, args.email
+    if username is None or email is None:
+        found = find_user(config_file)
+        if found is None:
+            logger.error("No user has uploaded files, pass --username and --email")
+            sys.exit(1)
+        username, email = found
+
+    table = benchmark(config_file, username, email, args.iterations)
+
+    print(f"\n{args.iterations} runs of each query, latency in ms\n")
+    print("| Query | Rows | Sent as | p50 | p99 |")
+    print("| --- | ---: | --- | ---: | ---: |")
+    for row in table:
+        print("| " + " | ".join(row) + " |")
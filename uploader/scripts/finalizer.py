@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""
+Runs a dedicated worker process that finalizes queued uploads.
+"""
+
+import sys
+from pathlib import Path
+
+file = Path(__file__)
+parent = file.parent
+ROOT = None
+for parent in file.parents:
+    if parent.name == "ChunkChariot":
+        ROOT = parent
+sys.path.append(str(ROOT))
+
+import logging
+
+from uploader.finalizer import FinalizeWorker
+from uploader.helpers import utils
+from uploader.helpers.config import install_reload_signal
+
+MODULE_NAME = "finalizer"
+
+logger = logging.getLogger(MODULE_NAME)
+logargs = {
+    "level": logging.DEBUG,
+    "format": "%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s",
+}
+logging.basicConfig(**logargs)
+
+
+if __name__ == "__main__":
+    config_file = utils.get_config_file_path()
+
+    utils.configure_logging(
+        config_file=config_file, module_name=MODULE_NAME, logger=logger
+    )
+
+    logger.info(f"Using config file: {config_file}")
+    install_reload_signal()
+
+    worker = FinalizeWorker.from_config(config_file=config_file)
+    logger.info(f"Starting {worker}...")
+
+    worker.run_forever()
+
+    logger.info("Done!")
@@ -22,6 +22,8 @@ from uploader.models.user import User
 from uploader.models.uploaded_file import UploadedFile
 from uploader.models.submission import Submission
 from uploader.models.submitted_files_map import SubmittedFilesMap
+from uploader.models.finalize_job import FinalizeJob
+from uploader.models.blob import Blob
 
 MODULE_NAME = "init_db"
 
@@ -45,10 +47,12 @@ def init_db(config_file: Path):
     """
 
     drop_queries: List[str] = [
+        FinalizeJob.drop_table_query(),
         SubmittedFilesMap.drop_table_query(),
         Submission.drop_table_query(),
         UploadedFile.drop_table_query(),
         User.drop_table_query(),
+        Blob.drop_table_query(),
     ]
 
     create_queries: List[str] = [
@@ -56,6 +60,8 @@ def init_db(config_file: Path):
         UploadedFile.create_table_query(),
         Submission.create_table_query(),
         SubmittedFilesMap.create_table_query(),
+        FinalizeJob.create_table_query(),
+        Blob.create_table_query(),
     ]
 
     sql_queries: List[str] = drop_queries + create_queries
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""
+Removes abandoned uploads once, and reports what was reclaimed.
+"""
+
+import sys
+from pathlib import Path
+
+file = Path(__file__)
+parent = file.parent
+ROOT = None
+for parent in file.parents:
+    if parent.name == "ChunkChariot":
+        ROOT = parent
+sys.path.append(str(ROOT))
+
+import logging
+
+from uploader.helpers import utils
+from uploader.janitor import Janitor
+
+MODULE_NAME = "janitor"
+
+logger = logging.getLogger(MODULE_NAME)
+logargs = {
+    "level": logging.DEBUG,
+    "format": "%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s",
+}
+logging.basicConfig(**logargs)
+
+
+if __name__ == "__main__":
+    config_file = utils.get_config_file_path()
+
+    utils.configure_logging(
+        config_file=config_file, module_name=MODULE_NAME, logger=logger
+    )
+
+    logger.info(f"Using config file: {config_file}")
+
+    janitor = Janitor.from_config(config_file=config_file)
+    logger.info(f"Sweeping with {janitor}...")
+
+    report = janitor.sweep()
+    logger.info(f"Reclaimed {report.bytes_reclaimed} bytes: {report}")
+
+    logger.info("Done!")
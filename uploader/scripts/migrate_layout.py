@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""
+Moves uploaded files to the storage layout set in the config file
+(`[upload] shard_depth` and `shard_width`), and rewrites their paths in
+`uploaded_files`.
+
+Files are moved and updated in batches, one UPDATE per batch. An interrupted
+migration can be run again: files already at their new path only have
+their row updated.
+"""
+
+import sys
+from pathlib import Path
+
+file = Path(__file__)
+parent = file.parent
+ROOT = None
+for parent in file.parents:
+    if parent.name == "ChunkChariot":
+        ROOT = parent
+sys.path.append(str(ROOT))
+
+import argparse
+import logging
+import os
+from typing import List, Tuple
+
+from uploader import orchestrator
+from uploader.helpers import cache, db, files, utils
+from uploader.models import uploaded_file
+from uploader.models.blob import BLOBS_DIR_NAME
+
+MODULE_NAME = "migrate_layout"
+
+logger = logging.getLogger(MODULE_NAME)
+logargs = {
+    "level": logging.DEBUG,
+    "format": "%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s",
+}
+logging.basicConfig(**logargs)
+
+
+def plan_moves(
+    config_file: Path, storage_path: Path, storage_layout: Tuple[int, int]
+) -> List[Tuple[str, Path, Path]]:
+    """
+    Lists the uploaded files that are not at their path in the layout.
+
+    Blobs of the content-addressed store have their own layout, and are
+    left where they are.
+
+    Args:
+        config_file (Path): Path to the config file.
+        storage_path (Path): The path uploaded files are stored in.
+        storage_layout (Tuple[int, int]): The shard depth and width.
+
+    Returns:
+        List[Tuple[str, Path, Path]]: The UUID, current path and new path of
+            each file to move.
+    """
+    rows = db.fetch_rows(
+        config_file=config_file, query="SELECT uuid, file_path FROM uploaded_files"
+    )
+
+    blobs_path = storage_path / BLOBS_DIR_NAME
+    moves: List[Tuple[str, Path, Path]] = []
+    for uuid, stored_path in rows:
+        file_path = Path(stored_path)
+        if not file_path.is_relative_to(storage_path):
+            logger.warning(f"{file_path} is outside {storage_path}, skipping")
+            continue
+        if file_path.is_relative_to(blobs_path):
+            continue
+
+        shard_dir = files.get_shard_dir(storage_path, uuid, *storage_layout)
+        new_path = shard_dir / file_path.name
+        if new_path != file_path:
+            moves.append((uuid, file_path, new_path))
+
+    return moves
+
+
+def update_paths_query(moved: List[Tuple[str, Path]]) -> str:
+    """
+    Returns the SQL query to update the paths of a batch of files at once.
+
+    Args:
+        moved (List[Tuple[str, Path]]): The UUID and new path of each file.
+
+    Returns:
+        str: The SQL query.
+    """
+    values = ",\n".join(
+        f"('{db.santize_string(file_uuid)}', '{db.santize_string(str(new_path))}')"
+        for file_uuid, new_path in moved
+    )
+
+    sql_query = f"""
+    UPDATE uploaded_files AS u
+    SET file_path = v.file_path
+    FROM (VALUES
+    {values}
+    ) AS v(uuid, file_path)
+    WHERE u.uuid = v.uuid
+    """
+
+    return sql_query
+
+
+def remove_empty_dirs(directory: Path, storage_path: Path) -> None:
+    """
+    Removes a directory and its parents, up to the storage path, while
+    they are empty.
+
+    Args:
+        directory (Path): The directory to start from.
+        storage_path (Path): The path uploaded files are stored in.
+    """
+    while directory != storage_path and directory.is_relative_to(storage_path):
+        try:
+            directory.rmdir()
+        except OSError:
+            break
+        directory = directory.parent
+
+    return None
+
+
+def migrate_layout(
+    config_file: Path, batch_size: int = 1000, dry_run: bool = False
+) -> int:
+    """
+    Moves uploaded files to the configured layout.
+
+    Args:
+        config_file (Path): Path to the config file.
+        batch_size (int): The number of files moved per database update.
+        dry_run (bool): Only log the moves.
+
+    Returns:
+        int: The number of files moved.
+    """
+    storage_path = orchestrator.get_storage_path(config_file=config_file)
+    storage_layout = orchestrator.get_storage_layout(config_file=config_file)
+
+    moves = plan_moves(config_file, storage_path, storage_layout)
+    logger.info(
+        f"{len(moves)} files to move to {storage_layout[0]} levels "
+        f"of {storage_layout[1]} hex digits"
+    )
+
+    moved_count = 0
+    for start in range(0, len(moves), batch_size):
+        moved: List[Tuple[str, Path]] = []
+        for file_uuid, file_path, new_path in moves[start : start + batch_size]:
+            if dry_run:
+                logger.info(f"Would move {file_path} to {new_path}")
+                continue
+
+            if file_path.exists():
+                if new_path.exists():
+                    logger.error(f"{new_path} already exists, not moving {file_path}")
+                    continue
+                new_path.parent.mkdir(parents=True, exist_ok=True)
+                os.rename(file_path, new_path)
+                remove_empty_dirs(file_path.parent, storage_path)
+            elif not new_path.exists():
+                logger.error(f"{file_path} is missing, skipping")
+                continue
+            # else: moved by an earlier, interrupted run
+            moved.append((file_uuid, new_path))
+
+        if moved:
+            db.execute_queries(
+                config_file=config_file,
+                queries=[update_paths_query(moved)],
+                show_commands=False,
+            )
+            # The app's workers may have the old paths cached
+            calls = cache.invalidation_calls(
+                name=uploaded_file.CACHE,
+                keys=[file_uuid for file_uuid, _ in moved],
+                config_file=config_file,
+            )
+            if calls:
+                db.execute_statements(config_file=config_file, calls=calls)
+            moved_count += len(moved)
+            logger.info(f"Moved {moved_count}/{len(moves)} files")
+
+    return moved_count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Move uploaded files to the configured storage layout."
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only log the files to move"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="number of files moved per database update",
+    )
+    args = parser.parse_args()
+
+    config_file = utils.get_config_file_path()
+
+    utils.configure_logging(
+        config_file=config_file, module_name=MODULE_NAME, logger=logger
+    )
+
+    logger.info(f"Using config file: {config_file}")
+
+    logger.info("Migrating storage layout...")
+    logger.warning("Stop the app before migrating, uploads in progress are not moved")
+
+    migrate_layout(
+        config_file=config_file, batch_size=args.batch_size, dry_run=args.dry_run
+    )
+
+    logger.info("Done!")
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+"""
+Serves the app with Gunicorn: `python -m uploader serve` (or `start.sh`).
+
+The worker model is picked from the `[server]` section of the config file,
+and options left out there are picked from the number of CPUs available:
+- 'gthread' (the default): one worker process per CPU, each serving requests
+    on a pool of threads, enough for the upload slots (see `[limits]`) plus
+    a few for the pages and the healthcheck.
+- 'sync': 2 * CPUs + 1 worker processes serving one request at a time.
+- 'asgi': one Uvicorn worker per CPU (see `uploader/asgi.py`).
+
+With `preload` (the default), the app is created once in the master process
+and the workers are forked from it, so the config, repo root and hostname
+are resolved once. Per-process state is made fork-safe: caches holding
+connections (storage clients, database connection pools) are cleared in the
+children (see `os.register_at_fork`), and the background threads are started
+in each worker after it is forked.
+
+A SIGHUP to the master process reloads the config file, and gracefully
+replaces the workers. Workers also pick up changes to the config file on
+their own (see `helpers/config.py`), except for those that need a restart
+(see `app.RELOADABLE_CONFIG`).
+"""
+
+import sys
+from pathlib import Path
+
+file = Path(__file__)
+parent = file.parent
+ROOT = None
+for parent in file.parents:
+    if parent.name == "ChunkChariot":
+        ROOT = parent
+sys.path.append(str(ROOT))
+
+import argparse
+import logging
+import math
+import os
+from typing import Any, Dict, List, Optional
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = object  # type: ignore
+
+from uploader import orchestrator
+from uploader.helpers import cli, db, utils
+from uploader.helpers.config import reload_settings
+
+MODULE_NAME = "uploader.app"
+
+logger = logging.getLogger(__name__)
+
+WORKER_CLASSES = {
+    "gthread": "gthread",
+    "sync": "sync",
+    "asgi": "uvicorn.workers.UvicornWorker",
+}
+
+# Threads per gthread worker kept for requests other than uploads
+SPARE_THREADS = 4
+
+
+def get_cpu_count() -> int:
+    """
+    Returns the number of CPUs this process may run on.
+
+    Returns:
+        int: The number of CPUs.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def get_topology(
+    options: Dict[str, Any],
+    cpu_count: int,
+    upload_limits: Optional[Dict[str, float]] = None,
+) -> Dict[str, Any]:
+    """
+    Fills in the server options left out with defaults for the CPUs available.
+
+    A sync worker is busy for as long as a chunk takes to arrive, so its
+    timeout must cover the slowest chunk. gthread and Uvicorn workers keep
+    reporting to the master while requests run, so theirs only needs to catch
+    a hung worker.
+
+    Args:
+        options (Dict[str, Any]): The server options (see
+            `orchestrator.get_server_options`).
+        cpu_count (int): The number of CPUs available.
+        upload_limits (Optional[Dict[str, float]]): The upload limits (see
+            `orchestrator.get_upload_limits`), if any.
+
+    Returns:
+        Dict[str, Any]: The server options, none of them left out.
+    """
+    topology = dict(options)
+    worker_class = topology["worker_class"]
+
+    if topology["workers"] is None:
+        if worker_class == "sync":
+            topology["workers"] = 2 * cpu_count + 1
+        else:
+            topology["workers"] = max(cpu_count, 2)
+
+    if worker_class != "gthread":
+        topology["threads"] = 1
+    elif topology["threads"] is None:
+        threads = 8
+        if upload_limits is not None:
+            # Any worker may be handed all the uploads in progress
+            uploads_per_worker = math.ceil(
+                upload_limits["max_concurrent"] / topology["workers"]
+            )
+            threads = max(threads, uploads_per_worker + SPARE_THREADS)
+        topology["threads"] = threads
+
+    if topology["timeout"] is None:
+        topology["timeout"] = 300 if worker_class == "sync" else 60
+    if topology["graceful_timeout"] is None:
+        topology["graceful_timeout"] = 120
+    if topology["keepalive"] is None:
+        # Dropzone sends the chunks of a file back to back, on one connection
+        topology["keepalive"] = 75
+
+    return topology
+
+
+def describe_topology(
+    topology: Dict[str, Any],
+    cpu_count: int,
+    upload_limits: Optional[Dict[str, float]] = None,
+    pool_options: Optional[Dict[str, Any]] = None,
+) -> List[str]:
+    """
+    Describes how the app is served, one line per aspect.
+
+    Args:
+        topology (Dict[str, Any]): The server options (see `get_topology`).
+        cpu_count (int): The number of CPUs available.
+        upload_limits (Optional[Dict[str, float]]): The upload limits, if any.
+        pool_options (Optional[Dict[str, Any]]): The database connection pool
+            options (see `db.get_pool_options`), if known.
+
+    Returns:
+        List[str]: The lines.
+    """
+    workers = topology["workers"]
+    worker_class = topology["worker_class"]
+    if worker_class == "gthread":
+        threads = topology["threads"]
+        capacity = (
+            f"{workers} gthread workers x {threads} threads "
+            f"({workers * threads} requests at once)"
+        )
+    elif worker_class == "sync":
+        capacity = f"{workers} sync workers ({workers} requests at once)"
+    else:
+        capacity = f"{workers} Uvicorn workers (uploads received on event loops)"
+
+    lines = [
+        f"Serving on {topology['bind']}, {cpu_count} CPU(s)",
+        f"Workers: {capacity}",
+        "Preload: "
+        + (
+            "on, app created once and workers forked from it"
+            if topology["preload"]
+            else "off, app created in each worker"
+        ),
+        f"Timeouts: worker {topology['timeout']}s, "
+        f"graceful {topology['graceful_timeout']}s, "
+        f"keep-alive {topology['keepalive']}s",
+    ]
+    if upload_limits is not None:
+        max_concurrent = int(upload_limits["max_concurrent"])
+        lines.append(f"Uploads: at most {max_concurrent} at once (see [limits])")
+        if worker_class != "asgi" and max_concurrent >= workers * topology["threads"]:
+            lines.append(
+                "Warning: uploads may hold every worker thread, "
+                "lower [limits] max_concurrent or add threads"
+            )
+    if pool_options is not None:
+        connections = pool_options["pool_size"] + pool_options["max_overflow"]
+        lines.append(
+            f"Database: up to {connections} connections per worker "
+            f"({workers * connections} in all, see [postgresql_pool])"
+        )
+
+    return lines
+
+
+class Server(BaseApplication):  # type: ignore
+    """
+    Gunicorn application serving the app, configured from a topology.
+
+    Attributes:
+        config_file (Path): The path to the config file.
+        topology (Dict[str, Any]): The server options (see `get_topology`).
+    """
+
+    def __init__(self, config_file: Path, topology: Dict[str, Any]):
+        if BaseApplication is object:
+            raise RuntimeError("gunicorn is needed to serve the app")
+
+        self.config_file = config_file
+        self.topology = topology
+        super().__init__()
+
+    def __repr__(self) -> str:
+        return (
+            f"<Server {self.topology['bind']} "
+            f"{self.topology['workers']}x{self.topology['worker_class']}>"
+        )
+
+    def load_config(self) -> None:
+        config_file = self.config_file
+        preload = self.topology["preload"]
+
+        def post_fork(server: Any, worker: Any) -> None:
+            # The app was created (without its threads) before the fork
+            if preload:
+                from uploader.app import (  # pylint: disable=import-outside-toplevel
+                    start_background_workers,
+                )
+
+                start_background_workers(config_file=config_file)
+
+        def on_reload(server: Any) -> None:
+            # SIGHUP to the master: workers are replaced, and with preload,
+            # forked from the master, which must read the settings again
+            reload_settings()
+
+        settings = {
+            "bind": [self.topology["bind"]],
+            "worker_class": WORKER_CLASSES[self.topology["worker_class"]],
+            "workers": self.topology["workers"],
+            "threads": self.topology["threads"],
+            "preload_app": preload,
+            "timeout": self.topology["timeout"],
+            "graceful_timeout": self.topology["graceful_timeout"],
+            "keepalive": self.topology["keepalive"],
+            "post_fork": post_fork,
+            "on_reload": on_reload,
+        }
+        if Path("/dev/shm").is_dir():
+            # Heartbeat files on tmpfs, so a slow disk does not kill workers
+            settings["worker_tmp_dir"] = "/dev/shm"
+
+        for key, value in settings.items():
+            self.cfg.set(key, value)
+
+    def load(self) -> Any:
+        # Called once in the master with preload, in each worker otherwise
+        start_workers = not self.topology["preload"]
+        if self.topology["worker_class"] == "asgi":
+            from uploader.asgi import (  # pylint: disable=import-outside-toplevel
+                create_asgi_app,
+            )
+
+            return create_asgi_app(
+                config_file=self.config_file, start_workers=start_workers
+            )
+
+        from uploader.app import (  # pylint: disable=import-outside-toplevel
+            create_app,
+        )
+
+        return create_app(config_file=self.config_file, start_workers=start_workers)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Adds the options of `serve`, overriding the `[server]` section.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser.
+    """
+    parser.add_argument("--bind", help="address to listen on, e.g. 0.0.0.0:15000")
+    parser.add_argument(
+        "--worker-class", choices=sorted(WORKER_CLASSES), help="worker model"
+    )
+    parser.add_argument("--workers", type=int, help="number of worker processes")
+    parser.add_argument("--threads", type=int, help="threads per gthread worker")
+    parser.add_argument("--timeout", type=int, help="worker timeout in seconds")
+    parser.add_argument(
+        "--preload",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="create the app once, before forking the workers",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only print the topology"
+    )
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    Serves the app.
+
+    Args:
+        args (argparse.Namespace): The parsed options (see `add_arguments`).
+    """
+    config_file = utils.get_config_file_path()
+    utils.configure_logging(
+        config_file=config_file, module_name=MODULE_NAME, logger=logger
+    )
+    logger.info(f"Using config file: {config_file}")
+    # Resolved once here, and inherited by the forked workers
+    cli.get_hostname()
+
+    options = orchestrator.get_server_options(config_file=config_file)
+    for key in ("bind", "worker_class", "workers", "threads", "timeout", "preload"):
+        if getattr(args, key) is not None:
+            options[key] = getattr(args, key)
+
+    cpu_count = get_cpu_count()
+    upload_limits = orchestrator.get_upload_limits(config_file=config_file)
+    topology = get_topology(options, cpu_count, upload_limits)
+    pool_options = db.get_pool_options(config_file=config_file)
+    for line in describe_topology(topology, cpu_count, upload_limits, pool_options):
+        logger.info(line)
+
+    if args.dry_run:
+        return None
+
+    Server(config_file=config_file, topology=topology).run()
+
+    return None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s",
+    )
+    arg_parser = argparse.ArgumentParser(description="Serve the app with Gunicorn.")
+    add_arguments(arg_parser)
+    main(arg_parser.parse_args())
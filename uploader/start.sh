@@ -1 +1,2 @@
-gunicorn -w 4 -b 0.0.0.0:15000 _wsgi:app
+# Serves the app with Gunicorn, see uploader/serve.py (and [server] in config.ini)
+cd "$(dirname "$0")/.." && exec python -m uploader serve "$@"
@@ -0,0 +1 @@
+uvicorn --workers 4 --host 0.0.0.0 --port 15000 --timeout-keep-alive 75 _asgi:app
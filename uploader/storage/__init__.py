@@ -0,0 +1,97 @@
+"""
+Storage backends for uploaded files.
+
+The backend is chosen with `[storage] backend` in the config file:
+- 'local': files are stored under `[upload] storage_path` (the default).
+- 's3': files are stored in the bucket configured in the `[s3]` section.
+"""
+
+import functools
+import logging
+import os
+from pathlib import Path
+from typing import Optional
+
+from uploader import orchestrator
+from uploader.helpers import utils
+from uploader.helpers.config import config
+from uploader.storage.base import (
+    StorageBackend,
+    begin_upload_once,
+    read_upload_state,
+)
+from uploader.storage.local import LocalBackend
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "StorageBackend",
+    "LocalBackend",
+    "begin_upload_once",
+    "read_upload_state",
+    "get_backend",
+]
+
+
+@functools.lru_cache(maxsize=None)
+def _get_backend(name: str, config_file: Path) -> StorageBackend:
+    storage_path = orchestrator.get_storage_path(config_file=config_file)
+    storage_layout = orchestrator.get_storage_layout(config_file=config_file)
+
+    if name == "local":
+        return LocalBackend(
+            storage_path=storage_path,
+            storage_layout=storage_layout,
+            drop_cache_above=orchestrator.get_drop_cache_above(config_file=config_file),
+        )
+
+    from uploader.storage.s3 import (  # pylint: disable=import-outside-toplevel
+        S3Backend,
+    )
+
+    params = config(path=config_file, section="s3")
+    client_params = {
+        "endpoint_url": params.get("endpoint_url"),
+        "region_name": params.get("region"),
+        "aws_access_key_id": params.get("access_key_id"),
+        "aws_secret_access_key": params.get("secret_access_key"),
+    }
+    backend = S3Backend(
+        bucket=params["bucket"],
+        prefix=params.get("prefix", ""),
+        storage_layout=storage_layout,
+        spool_dir=orchestrator.get_chunk_path(config_file=config_file),
+        client_params={
+            key: value for key, value in client_params.items() if value
+        },
+    )
+    logger.info(f"Using storage backend: {backend}")
+
+    return backend
+
+
+# Clients (e.g. boto3's connection pool) must not be shared with forked
+# workers, which create their own on first use
+os.register_at_fork(after_in_child=_get_backend.cache_clear)
+
+
+def get_backend(
+    name: Optional[str] = None, config_file: Optional[Path] = None
+) -> StorageBackend:
+    """
+    Returns the storage backend, created once per process.
+
+    Args:
+        name (Optional[str]): The name of the backend, defaults to the one
+            configured with `[storage] backend`.
+        config_file (Optional[Path]): The path to the config file.
+
+    Returns:
+        StorageBackend: The storage backend.
+    """
+    if config_file is None:
+        config_file = utils.get_config_file_path()
+    if name is None:
+        name = orchestrator.get_storage_backend(config_file=config_file)
+
+    return _get_backend(name, Path(config_file))
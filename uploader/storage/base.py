@@ -0,0 +1,244 @@
+"""
+Interface of the storage backends uploaded files are written to.
+
+An upload is written as numbered parts: Dropzone chunk `i` is part `i + 1`,
+and a file that is not chunked is a single part. Parts may arrive in any
+order, and from different processes. Once all of them are written, the
+upload is completed, after which the file can be read back by range.
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, Optional
+
+from uploader.helpers.multipart import FileSink
+
+UPLOAD_STATE_NAME = "storage.json"
+
+
+class RangeReader:
+    """
+    Read-only stream over a range of a file.
+    """
+
+    def __init__(self, stream: BinaryIO, length: Optional[int] = None):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Reads up to `size` bytes (or the rest of the range) from the stream.
+        """
+        if self.remaining is not None:
+            if size < 0 or size > self.remaining:
+                size = self.remaining
+        data = self.stream.read(size)
+        if self.remaining is not None:
+            self.remaining -= len(data)
+
+        return data
+
+    def close(self) -> None:
+        """
+        Closes the underlying stream.
+        """
+        self.stream.close()
+
+    def __enter__(self) -> "RangeReader":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+class StorageBackend(ABC):
+    """
+    Where uploaded files are stored.
+
+    Files are addressed by a key, from `get_key`, which is what UploadedFile
+    records as its `file_path`.
+    """
+
+    name: str = ""
+
+    @abstractmethod
+    def get_key(self, file_uuid: str, file_name: str) -> str:
+        """
+        Returns the key to store a new file at.
+
+        Args:
+            file_uuid (str): The UUID of the file.
+            file_name (str): The (secure) name of the file.
+
+        Returns:
+            str: The key.
+        """
+
+    @abstractmethod
+    def begin_upload(self, key: str, total_size: int, part_count: int) -> str:
+        """
+        Prepares to receive the parts of a file. Called once per upload,
+        see `begin_upload_once`.
+
+        Args:
+            key (str): The key of the file.
+            total_size (int): The size of the file in bytes, if known.
+            part_count (int): The number of parts.
+
+        Returns:
+            str: The handle the parts of the upload are written with.
+
+        Raises:
+            ValueError: If the backend cannot store a file in that many parts.
+        """
+
+    @abstractmethod
+    def open_part(
+        self,
+        key: str,
+        upload_handle: str,
+        part_number: int,
+        offset: int,
+        length: Optional[int] = None,
+    ) -> FileSink:
+        """
+        Opens a sink that writes one part of an upload.
+
+        Args:
+            key (str): The key of the file.
+            upload_handle (str): The handle from `begin_upload`.
+            part_number (int): The number of the part, from 1.
+            offset (int): The byte offset of the part in the file.
+            length (Optional[int]): The size of the part, if known. Writing
+                more raises ValueError, and so does closing the sink with
+                less on backends that upload the part when it is closed.
+
+        Returns:
+            FileSink: The sink.
+        """
+
+    @abstractmethod
+    def complete(self, key: str, upload_handle: str, part_count: int) -> None:
+        """
+        Completes an upload once all of its parts are written. Safe to call
+        again for an upload that was already completed.
+
+        Args:
+            key (str): The key of the file.
+            upload_handle (str): The handle from `begin_upload`.
+            part_count (int): The number of parts.
+        """
+
+    @abstractmethod
+    def abort(self, key: str, upload_handle: str) -> None:
+        """
+        Discards an unfinished upload and the parts written so far.
+
+        Args:
+            key (str): The key of the file.
+            upload_handle (str): The handle from `begin_upload`.
+        """
+
+    @abstractmethod
+    def open_range(
+        self, key: str, start: int = 0, length: Optional[int] = None
+    ) -> BinaryIO:
+        """
+        Opens a file for reading, from `start` and for `length` bytes.
+
+        Args:
+            key (str): The key of the file.
+            start (int): The offset to read from.
+            length (Optional[int]): The number of bytes to read, or None to
+                read to the end of the file.
+
+        Returns:
+            BinaryIO: The stream.
+        """
+
+    @abstractmethod
+    def get_size(self, key: str) -> int:
+        """
+        Returns the size of a stored file in bytes.
+
+        Args:
+            key (str): The key of the file.
+
+        Returns:
+            int: The size of the file.
+        """
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        """
+        Deletes a stored file.
+
+        Args:
+            key (str): The key of the file.
+        """
+
+
+def read_upload_state(save_dir: Path) -> Optional[Dict[str, str]]:
+    """
+    Reads the backend state of an unfinished upload.
+
+    Args:
+        save_dir (Path): The chunk directory of the upload.
+
+    Returns:
+        Optional[Dict[str, str]]: The 'backend', 'key' and 'upload_handle'
+            of the upload, or None if it has not begun.
+    """
+    try:
+        return json.loads((save_dir / UPLOAD_STATE_NAME).read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+@contextlib.contextmanager
+def _locked(save_dir: Path) -> Iterator[None]:
+    fd = os.open(save_dir / f"{UPLOAD_STATE_NAME}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def begin_upload_once(
+    backend: StorageBackend,
+    save_dir: Path,
+    key: str,
+    total_size: int,
+    part_count: int,
+) -> str:
+    """
+    Begins an upload the first time one of its parts arrives, and returns
+    its handle to every later part, across processes.
+
+    Args:
+        backend (StorageBackend): The storage backend.
+        save_dir (Path): The chunk directory of the upload.
+        key (str): The key of the file.
+        total_size (int): The size of the file in bytes.
+        part_count (int): The number of parts.
+
+    Returns:
+        str: The upload handle.
+    """
+    with _locked(save_dir):
+        state = read_upload_state(save_dir)
+        if state is not None:
+            return state["upload_handle"]
+
+        upload_handle = backend.begin_upload(key, total_size, part_count)
+        state = {"backend": backend.name, "key": key, "upload_handle": upload_handle}
+        temp_path = save_dir / f"{UPLOAD_STATE_NAME}.tmp"
+        temp_path.write_text(json.dumps(state))
+        os.replace(temp_path, save_dir / UPLOAD_STATE_NAME)
+
+    return upload_handle
@@ -0,0 +1,95 @@
+"""
+Stores uploaded files on a local (or mounted) filesystem, under the storage
+path. Parts are written straight into the preallocated file at their offset.
+"""
+
+import logging
+from pathlib import Path
+from typing import BinaryIO, Optional, Tuple
+
+from uploader.helpers import files
+from uploader.helpers.multipart import FileSink
+from uploader.storage.base import RangeReader, StorageBackend
+
+logger = logging.getLogger(__name__)
+
+
+class LocalBackend(StorageBackend):
+    """
+    Local filesystem storage. Keys are absolute file paths.
+
+    Attributes:
+        storage_path (Path): The path to store uploaded files in.
+        storage_layout (Tuple[int, int]): The shard depth and width (see
+            `files.get_shard_dir`).
+        drop_cache_above (Optional[int]): The size from which files are kept
+            out of the page cache (see `helpers/pagecache.py`), or None.
+    """
+
+    name = "local"
+
+    def __init__(
+        self,
+        storage_path: Path,
+        storage_layout: Tuple[int, int] = (0, 2),
+        drop_cache_above: Optional[int] = None,
+    ):
+        self.storage_path = storage_path
+        self.storage_layout = storage_layout
+        self.drop_cache_above = drop_cache_above
+
+    def __repr__(self) -> str:
+        return f"<LocalBackend {self.storage_path}>"
+
+    def get_key(self, file_uuid: str, file_name: str) -> str:
+        file_path = files.get_storage_file_path(
+            self.storage_path,
+            file_uuid,
+            file_name,
+            shard_depth=self.storage_layout[0],
+            shard_width=self.storage_layout[1],
+        )
+
+        return str(file_path)
+
+    def begin_upload(self, key: str, total_size: int, part_count: int) -> str:
+        files.preallocate_file(Path(key), max(total_size, 0))
+
+        return ""
+
+    def open_part(
+        self,
+        key: str,
+        upload_handle: str,
+        part_number: int,
+        offset: int,
+        length: Optional[int] = None,
+    ) -> FileSink:
+        return files.OffsetWriter(
+            Path(key), offset, limit=length, drop_cache_above=self.drop_cache_above
+        )
+
+    def complete(self, key: str, upload_handle: str, part_count: int) -> None:
+        return None
+
+    def abort(self, key: str, upload_handle: str) -> None:
+        Path(key).unlink(missing_ok=True)
+
+        return None
+
+    def open_range(
+        self, key: str, start: int = 0, length: Optional[int] = None
+    ) -> BinaryIO:
+        stream = open(key, "rb")
+        stream.seek(start)
+
+        return RangeReader(stream, length)  # type: ignore
+
+    def get_size(self, key: str) -> int:
+        return Path(key).stat().st_size
+
+    def delete(self, key: str) -> None:
+        logger.info(f"Deleting file {key}")
+        Path(key).unlink()
+
+        return None
@@ -0,0 +1,241 @@
+"""
+Stores uploaded files in an S3-compatible object store (AWS S3, MinIO, ...).
+
+Each upload is an S3 multipart upload, and each Dropzone chunk is uploaded
+as one part of it as soon as it arrives, so files are never assembled
+locally. A chunk is spooled (in memory, or on disk when large) until it is
+complete, since a part must be sent with its length.
+
+S3 needs every part but the last to be at least 5 MB, and at most 10,000
+parts per upload, which bounds the Dropzone chunk size from both sides.
+
+Needs the optional `boto3` package. Set `endpoint_url` to use a local
+stand-in, such as MinIO or moto's server mode.
+"""
+
+import logging
+import tempfile
+from pathlib import Path, PurePosixPath
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None  # type: ignore
+    ClientError = Exception  # type: ignore
+
+from uploader.helpers import files
+from uploader.helpers.multipart import FileSink
+from uploader.storage.base import StorageBackend
+
+logger = logging.getLogger(__name__)
+
+MIN_PART_SIZE = 5 * 1024 * 1024  # 5 MB
+MAX_PARTS = 10000
+
+SPOOL_MEMORY_SIZE = 16 * 1024 * 1024  # 16 MB
+
+
+class S3PartWriter:
+    """
+    File sink that uploads one part of a multipart upload when closed.
+    """
+
+    def __init__(
+        self,
+        client: Any,
+        bucket: str,
+        key: str,
+        upload_id: str,
+        part_number: int,
+        length: Optional[int] = None,
+        spool_dir: Optional[Path] = None,
+    ):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.upload_id = upload_id
+        self.part_number = part_number
+        self.length = length
+        self.written = 0
+        self._spool = tempfile.SpooledTemporaryFile(
+            max_size=SPOOL_MEMORY_SIZE, dir=spool_dir
+        )
+
+    def write(self, data: bytes) -> None:
+        """
+        Spools a block of data.
+
+        Args:
+            data (bytes): The data to write.
+
+        Raises:
+            ValueError: If the data exceeds the length of the part.
+        """
+        if self.length is not None and self.written + len(data) > self.length:
+            raise ValueError(f"Part {self.part_number} exceeds its {self.length} bytes")
+        self._spool.write(data)
+        self.written += len(data)
+
+    def close(self) -> None:
+        """
+        Uploads the spooled part.
+
+        Raises:
+            ValueError: If less data than the length of the part was written.
+        """
+        try:
+            if self.length is not None and self.written != self.length:
+                raise ValueError(
+                    f"Part {self.part_number} is incomplete: "
+                    f"{self.written}/{self.length} bytes"
+                )
+            self._spool.seek(0)
+            self.client.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=self.part_number,
+                ContentLength=self.written,
+                Body=self._spool,
+            )
+            logger.debug(f"Uploaded part {self.part_number} of {self.key}")
+        finally:
+            self._spool.close()
+
+
+class S3Backend(StorageBackend):
+    """
+    S3-compatible object storage. Keys are object keys in the bucket.
+
+    Attributes:
+        bucket (str): The bucket to store uploaded files in.
+        prefix (str): The prefix of the object keys.
+        storage_layout (Tuple[int, int]): The shard depth and width of the
+            keys (see `files.get_shard_dir`).
+        spool_dir (Optional[Path]): Where large parts are spooled.
+    """
+
+    name = "s3"
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        storage_layout: Tuple[int, int] = (0, 2),
+        spool_dir: Optional[Path] = None,
+        client_params: Optional[Dict[str, str]] = None,
+    ):
+        if boto3 is None:
+            raise RuntimeError("boto3 is needed for the s3 storage backend")
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.storage_layout = storage_layout
+        self.spool_dir = spool_dir
+        # boto3 clients are thread-safe, share one per process
+        self.client = boto3.client("s3", **(client_params or {}))
+
+    def __repr__(self) -> str:
+        return f"<S3Backend s3://{self.bucket}/{self.prefix}>"
+
+    def get_key(self, file_uuid: str, file_name: str) -> str:
+        shard_dir = files.get_shard_dir(
+            PurePosixPath(self.prefix), file_uuid, *self.storage_layout  # type: ignore
+        )
+
+        return str(shard_dir / f"{file_uuid}_{file_name}")
+
+    def begin_upload(self, key: str, total_size: int, part_count: int) -> str:
+        if part_count > MAX_PARTS:
+            raise ValueError(f"S3 uploads have at most {MAX_PARTS} parts")
+        if part_count > 1 and total_size / (part_count - 1) <= MIN_PART_SIZE:
+            raise ValueError(f"S3 parts must be at least {MIN_PART_SIZE} bytes")
+
+        response = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)
+        logger.debug(f"Began multipart upload of {key} in {part_count} parts")
+
+        return response["UploadId"]
+
+    def open_part(
+        self,
+        key: str,
+        upload_handle: str,
+        part_number: int,
+        offset: int,
+        length: Optional[int] = None,
+    ) -> FileSink:
+        return S3PartWriter(
+            client=self.client,
+            bucket=self.bucket,
+            key=key,
+            upload_id=upload_handle,
+            part_number=part_number,
+            length=length,
+            spool_dir=self.spool_dir,
+        )
+
+    def complete(self, key: str, upload_handle: str, part_count: int) -> None:
+        parts: List[Dict[str, Any]] = []
+        try:
+            paginator = self.client.get_paginator("list_parts")
+            for page in paginator.paginate(
+                Bucket=self.bucket, Key=key, UploadId=upload_handle
+            ):
+                for part in page.get("Parts", []):
+                    parts.append(
+                        {"PartNumber": part["PartNumber"], "ETag": part["ETag"]}
+                    )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchUpload":
+                raise
+            # Completed by an earlier attempt
+            self.get_size(key)
+            return None
+
+        if len(parts) != part_count:
+            raise ValueError(f"{key} has {len(parts)} of {part_count} parts")
+
+        parts.sort(key=lambda part: part["PartNumber"])
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=key,
+            UploadId=upload_handle,
+            MultipartUpload={"Parts": parts},
+        )
+        logger.debug(f"Completed multipart upload of {key}")
+
+        return None
+
+    def abort(self, key: str, upload_handle: str) -> None:
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_handle
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchUpload":
+                raise
+
+        return None
+
+    def open_range(
+        self, key: str, start: int = 0, length: Optional[int] = None
+    ) -> BinaryIO:
+        byte_range = f"bytes={start}-"
+        if length is not None:
+            byte_range += str(start + length - 1)
+        response = self.client.get_object(Bucket=self.bucket, Key=key, Range=byte_range)
+
+        return response["Body"]
+
+    def get_size(self, key: str) -> int:
+        response = self.client.head_object(Bucket=self.bucket, Key=key)
+
+        return int(response["ContentLength"])
+
+    def delete(self, key: str) -> None:
+        logger.info(f"Deleting s3://{self.bucket}/{key}")
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+        return None